@@ -196,6 +196,7 @@ BuildArch: noarch
 Requires: microshift = %{version}
 Requires: tuned-profiles-cpu-partitioning
 Requires: python3-pyyaml
+Requires: python3-gobject-base
 
 %description low-latency
 The microshift-low-latency package provides a baseline configuration prepared for
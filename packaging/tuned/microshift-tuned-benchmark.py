@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Benchmark startup latency of microshift-tuned without a real TuneD.
+
+The harness generates synthetic profile trees of different sizes and runs
+microshift-tuned's main() against them with stub `tuned-adm` and `systemctl`
+executables on the PATH. For each size, one cold run (no cache, profile not
+active) and a number of warm runs (cache present, nothing changed) are
+measured using the --timings output of the program.
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+
+SCRIPTDIR = os.path.dirname(os.path.abspath(__file__))
+
+TUNED_ADM_STUB = """#!/bin/bash
+state="{state}"
+case "$1" in
+active)
+    [ -s "${{state}}" ] || exit 1
+    echo "Current active profile: $(cat "${{state}}")"
+    ;;
+profile)
+    echo -n "$2" > "${{state}}"
+    ;;
+esac
+"""
+
+SYSTEMCTL_STUB = """#!/bin/bash
+exit 0
+"""
+
+
+def load_microshift_tuned():
+    """Imports microshift-tuned.py as a module (its file name is not a valid module name)."""
+    spec = importlib.util.spec_from_file_location("microshift_tuned", os.path.join(SCRIPTDIR, "microshift-tuned.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_file(path: str, content: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def create_environment(basedir: str, files: int, file_size: int):
+    """Creates configuration, synthetic profile (including a parent profile), variables file, and stub executables."""
+    write_file(os.path.join(basedir, "etc/microshift/tuned.yaml"), "profile: bench\nreboot_after_apply: True\n")
+    write_file(os.path.join(basedir, "etc/tuned/bench-variables.conf"), "isolated_cores=1-3\nhugepages=0\n")
+    write_file(os.path.join(basedir, "etc/tuned/bench/tuned.conf"), f"""[main]
+include=bench-parent
+
+[variables]
+include={basedir}/etc/tuned/bench-variables.conf
+
+[bootloader]
+cmdline_bench=isolcpus=${{isolated_cores}} hugepages=${{hugepages}}
+
+[sysctl]
+kernel.sched_rt_runtime_us=-1
+""")
+    write_file(os.path.join(basedir, "usr/lib/tuned/bench-parent/tuned.conf"), "[sysctl]\nvm.stat_interval=10\n")
+    # Spread the generated files over a few nested directories
+    for i in range(files):
+        write_file(os.path.join(basedir, f"etc/tuned/bench/data{i % 4}/file{i}.sh"), "#" * file_size)
+
+    bindir = os.path.join(basedir, "bin")
+    write_file(os.path.join(bindir, "tuned-adm"), TUNED_ADM_STUB.format(state=os.path.join(basedir, "active_profile")))
+    write_file(os.path.join(bindir, "systemctl"), SYSTEMCTL_STUB)
+    for stub in ["tuned-adm", "systemctl"]:
+        os.chmod(os.path.join(bindir, stub), 0o755)
+    return bindir
+
+
+def run_once(module) -> dict:
+    """Runs main() and returns its timings record."""
+    stdout = io.StringIO()
+    sys.argv = ["microshift-tuned", "--timings"]
+    with contextlib.redirect_stdout(stdout):
+        try:
+            module.main()
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                raise Exception(f"microshift-tuned exited with {e.code}")
+    # Timings are printed as the last line of the standard output
+    return json.loads(stdout.getvalue().strip().splitlines()[-1])
+
+
+def benchmark(module, files: int, file_size: int, runs: int) -> dict:
+    with tempfile.TemporaryDirectory(prefix="microshift-tuned-bench-") as basedir:
+        bindir = create_environment(basedir, files, file_size)
+        os.environ["PATH"] = f"{bindir}:{os.environ['PATH']}"
+
+        # Point the program to the synthetic environment
+        module.Config.PATH = os.path.join(basedir, "etc/microshift/tuned.yaml")
+        module.Checksums.PATH = os.path.join(basedir, "microshift-tuned.yaml")
+        module.TUNED_PROFILE_DIRS = [os.path.join(basedir, "etc/tuned"), os.path.join(basedir, "usr/lib/tuned")]
+        module.should_run_as_root = lambda: None
+        # Use the stub executables instead of talking to D-Bus
+        module.get_dbus_client = lambda: None
+
+        try:
+            cold = run_once(module)
+            warm = [run_once(module) for _ in range(runs)]
+        finally:
+            os.environ["PATH"] = os.environ["PATH"].removeprefix(f"{bindir}:")
+
+    warm_phases = {}
+    for record in warm:
+        for phase, duration in record["phases_ms"].items():
+            warm_phases.setdefault(phase, []).append(duration)
+    return {
+        "files": files,
+        "cold": cold,
+        "warm": {
+            "total_ms": statistics.median(record["total_ms"] for record in warm),
+            "phases_ms": {phase: statistics.median(durations) for phase, durations in warm_phases.items()},
+        },
+    }
+
+
+def print_report(results: list):
+    print(f"{'files':>8} {'run':>5} {'total_ms':>10}  phases_ms")
+    for result in results:
+        for run in ["cold", "warm"]:
+            record = result[run]
+            phases = ", ".join(f"{phase}={duration:.2f}" for phase, duration in record["phases_ms"].items())
+            print(f"{result['files']:>8} {run:>5} {record['total_ms']:>10.2f}  {phases}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark microshift-tuned against synthetic profiles using stub TuneD tools.")
+    parser.add_argument("-s", "--sizes", type=str, default="10,100,1000",
+                        help="Comma-separated list of numbers of files in the synthetic profile (default: %(default)s)")
+    parser.add_argument("-b", "--file-size", type=int, default=4096, help="Size of each generated file in bytes (default: %(default)s)")
+    parser.add_argument("-r", "--runs", type=int, default=5, help="Number of warm runs for each size (default: %(default)s)")
+    parser.add_argument("-j", "--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show logs of microshift-tuned")
+    args = parser.parse_args()
+
+    module = load_microshift_tuned()
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    results = [benchmark(module, int(size), args.file_size, args.runs) for size in args.sizes.split(",")]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,75 @@
 #!/usr/bin/env python
 
 import argparse
+import contextlib
+import ctypes
+import functools
+import hashlib
+import json
 import os.path
+import re
+import select
+import struct
 import subprocess
+import time
 import configparser
 import sys
 import yaml
 import logging
+from typing import Optional
+
+try:
+    from gi.repository import Gio, GLib
+except ImportError:
+    Gio = None
+    GLib = None
 
 logging.basicConfig(level=logging.DEBUG, format='L#%(lineno)-4d %(levelname)-8s %(message)s')
 
+HASH_CHUNK_SIZE = 64 * 1024
+TUNED_PROFILE_DIRS = ["/etc/tuned", "/usr/lib/tuned"]
+# Time without any new events after which the burst of changes is considered finished
+WATCH_DEBOUNCE_SECONDS = 0.5
+# Profile sections applied by TuneD at runtime - changing them does not require a reboot.
+# Changes in any other section (e.g. bootloader, systemd) are considered to require a reboot.
+LIVE_SECTIONS = {"main", "sysctl", "vm", "scheduler", "cpu", "sysfs", "irqbalance", "disk", "net",
+                 "audio", "video", "usb", "scsi_host", "script"}
+# Variables known to end up on kernel's command line even if the profile using them is not part of the graph
+REBOOT_VARIABLES = {"isolated_cores", "hugepages", "hugepages_size"}
+VARIABLE_REFERENCE = re.compile(r"\$\{(\w+)\}")
+# Cache grows with the number of files in the profile - use libyaml bindings if available
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+
+class Timings:
+    """Collects monotonic durations of program's phases."""
+
+    def __init__(self):
+        self.start = time.monotonic_ns()
+        self.phases = {}
+
+    def reset(self):
+        self.__init__()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.monotonic_ns()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.monotonic_ns() - start
+
+    def to_json(self) -> str:
+        record = {
+            "total_ms": (time.monotonic_ns() - self.start) / 1e6,
+            "phases_ms": {name: duration / 1e6 for name, duration in self.phases.items()},
+        }
+        return json.dumps(record)
+
+
+TIMINGS = Timings()
+
 
 class Config:
     PATH = "/etc/microshift/tuned.yaml"
@@ -59,16 +119,38 @@ class Config:
 class Checksums:
     PATH = "/var/lib/microshift-tuned.yaml"
 
-    def __init__(self, profile_checksum, variables_checksum):
+    def __init__(self, profile_checksum, variables_checksum, files=None, stats=None, graph_checksum=None, graph=None,
+                 settings=None):
         self.profile_checksum = profile_checksum
         self.variables_checksum = variables_checksum
+        # Manifest of individual file digests: {path: digest}
+        self.files = files if files is not None else {}
+        # Metadata of hashed files: {path: [size, mtime_ns, inode]}
+        self.stats = stats if stats is not None else {}
+        # Fingerprint of all the files the profile depends on (including parent profiles)
+        self.graph_checksum = graph_checksum
+        # Memoized parsing results of profiles' tuned.conf files (see ProfileGraph)
+        self.graph = graph if graph is not None else {}
+        # Snapshot of settings of the profiles and variables files: {path: {section: {key: value}}}
+        self.settings = settings if settings is not None else {}
 
     def __eq__(self, other):
+        if self.graph_checksum is not None and other.graph_checksum is not None:
+            if self.graph_checksum != other.graph_checksum:
+                return False
+        # Caches written by older versions do not have the graph checksum - compare only the requested
+        # profile's checksums, so the profile is not reactivated (and the host rebooted) after upgrade.
         return ((self.profile_checksum, self.variables_checksum)
                 == (other.profile_checksum, other.variables_checksum))
 
     def __repr__(self):
-        return f"Checksums(profile: '{self.profile_checksum}', variables: '{self.variables_checksum}')"
+        return (f"Checksums(profile: '{self.profile_checksum}', variables: '{self.variables_checksum}', "
+                f"graph: '{self.graph_checksum}')")
+
+    def changed_files(self, other) -> list[str]:
+        """Returns sorted list of files which were added, removed, or modified compared to other Checksums."""
+        paths = set(self.files) | set(other.files)
+        return sorted(path for path in paths if self.files.get(path) != other.files.get(path))
 
     @staticmethod
     def load_from_cache():
@@ -77,8 +159,11 @@ class Checksums:
             return None
 
         with open(Checksums.PATH, 'r') as cache_file:
-            cache = yaml.safe_load(cache_file)
-            checksums = Checksums(cache["profile_checksum"], cache["variables_checksum"])
+            cache = yaml.load(cache_file, Loader=YAML_LOADER)
+            # Caches written by older versions do not contain the files' manifest, stats, nor graph
+            checksums = Checksums(cache["profile_checksum"], cache["variables_checksum"],
+                                  cache.get("files", {}), cache.get("stats", {}),
+                                  cache.get("graph_checksum"), cache.get("graph", {}), cache.get("settings", {}))
             logging.debug(f"Loaded cache: {checksums}")
             return checksums
 
@@ -87,12 +172,127 @@ class Checksums:
         cache = {
             "profile_checksum": self.profile_checksum,
             "variables_checksum": self.variables_checksum,
+            "files": self.files,
+            "stats": self.stats,
+            "graph_checksum": self.graph_checksum,
+            "graph": self.graph,
+            "settings": self.settings,
         }
         with open(Checksums.PATH, 'w') as cache_file:
-            yaml.dump(cache, cache_file)
+            yaml.dump(cache, cache_file, Dumper=YAML_DUMPER)
+
+
+class DBusClient:
+    """In-process client of TuneD's and systemd's D-Bus APIs sharing a single system bus connection.
+
+    Bus address can be overridden with DBUS_SYSTEM_BUS_ADDRESS environment variable,
+    e.g. to talk to mock services on a private bus.
+    """
+    TUNED_NAME = "com.redhat.tuned"
+    TUNED_PATH = "/Tuned"
+    TUNED_INTERFACE = "com.redhat.tuned.control"
+    SYSTEMD_NAME = "org.freedesktop.systemd1"
+    SYSTEMD_PATH = "/org/freedesktop/systemd1"
+    SYSTEMD_MANAGER_INTERFACE = "org.freedesktop.systemd1.Manager"
+    SYSTEMD_UNIT_INTERFACE = "org.freedesktop.systemd1.Unit"
+    PROPERTIES_INTERFACE = "org.freedesktop.DBus.Properties"
+    CALL_TIMEOUT_MS = 60 * 1000
+    # Same as default timeout of `tuned-adm profile`
+    PROFILE_APPLY_TIMEOUT_SECONDS = 600
+
+    def __init__(self):
+        self.bus = Gio.bus_get_sync(Gio.BusType.SYSTEM, None)
+
+    def call(self, name: str, path: str, interface: str, method: str, args, reply_type: str) -> tuple:
+        logging.debug(f"Calling D-Bus method '{interface}.{method}' of '{name}{path}' with {args}")
+        reply = self.bus.call_sync(name, path, interface, method, args, GLib.VariantType.new(reply_type),
+                                   Gio.DBusCallFlags.NONE, DBusClient.CALL_TIMEOUT_MS, None)
+        result = reply.unpack()
+        logging.debug(f"Result of '{interface}.{method}': {result}")
+        return result
+
+    def is_unit_active(self, unit: str) -> bool:
+        try:
+            (unit_path,) = self.call(DBusClient.SYSTEMD_NAME, DBusClient.SYSTEMD_PATH, DBusClient.SYSTEMD_MANAGER_INTERFACE,
+                                     "GetUnit", GLib.Variant("(s)", (unit,)), "(o)")
+        except GLib.Error as e:
+            if "NoSuchUnit" in e.message:
+                logging.debug(f"Unit '{unit}' is not loaded")
+                return False
+            raise
+        (state,) = self.call(DBusClient.SYSTEMD_NAME, unit_path, DBusClient.PROPERTIES_INTERFACE,
+                             "Get", GLib.Variant("(ss)", (DBusClient.SYSTEMD_UNIT_INTERFACE, "ActiveState")), "(v)")
+        return state == "active"
+
+    def active_profile(self) -> str:
+        (profile,) = self.call(DBusClient.TUNED_NAME, DBusClient.TUNED_PATH, DBusClient.TUNED_INTERFACE,
+                               "active_profile", None, "(s)")
+        return profile
+
+    def switch_profile(self, profile: str) -> tuple[bool, str]:
+        """Switches the profile and waits until TuneD signals that it was applied."""
+        loop = GLib.MainLoop()
+        outcome = (False, f"Timed out waiting for profile '{profile}' to be applied")
+        timed_out = False
+
+        def on_profile_changed(_conn, _sender, _path, _iface, _signal, params, _data):
+            nonlocal outcome
+            changed_profile, result, message = params.unpack()
+            logging.debug(f"Received profile_changed signal: {(changed_profile, result, message)}")
+            if changed_profile == profile:
+                outcome = (result, message)
+                loop.quit()
+
+        def on_timeout():
+            nonlocal timed_out
+            timed_out = True
+            loop.quit()
+            return GLib.SOURCE_REMOVE
+
+        # Subscribe before switching so the signal cannot be missed
+        subscription = self.bus.signal_subscribe(DBusClient.TUNED_NAME, DBusClient.TUNED_INTERFACE, "profile_changed",
+                                                 DBusClient.TUNED_PATH, None, Gio.DBusSignalFlags.NONE,
+                                                 on_profile_changed, None)
+        try:
+            ((success, message),) = self.call(DBusClient.TUNED_NAME, DBusClient.TUNED_PATH, DBusClient.TUNED_INTERFACE,
+                                              "switch_profile", GLib.Variant("(s)", (profile,)), "((bs))")
+            if not success:
+                return (False, message)
+            timeout = GLib.timeout_add_seconds(DBusClient.PROFILE_APPLY_TIMEOUT_SECONDS, on_timeout)
+            loop.run()
+            if not timed_out:
+                GLib.source_remove(timeout)
+            return outcome
+        finally:
+            self.bus.signal_unsubscribe(subscription)
+
+
+@functools.lru_cache(maxsize=None)
+def get_dbus_client() -> Optional[DBusClient]:
+    """Returns D-Bus client or None if D-Bus is not available and CLI tools should be used instead."""
+    if Gio is None:
+        logging.debug("Python GObject bindings are not available, falling back to CLI tools")
+        return None
+    try:
+        return DBusClient()
+    except GLib.Error as e:
+        logging.warning(f"Failed to connect to system D-Bus, falling back to CLI tools: {e.message}")
+        return None
 
 
 def get_active_profile() -> tuple[str, bool]:
+    client = get_dbus_client()
+    if client is not None:
+        try:
+            profile = client.active_profile()
+            if profile == "":
+                logging.debug("No active TuneD profile")
+                return ("", False)
+            logging.debug(f"Active TuneD profile: '{profile}'")
+            return (profile, True)
+        except GLib.Error as e:
+            logging.warning(f"Failed to get active TuneD profile over D-Bus, falling back to tuned-adm: {e.message}")
+
     stdout, success = run_command(["tuned-adm", "active"])
     if not success:
         logging.debug("No active TuneD profile")
@@ -115,7 +315,7 @@ def run_command(cmd: list[str], failure_fatal=False) -> tuple[str, bool]:
 
 
 def get_profile_path(profile: str) -> str:
-    paths = [f"/etc/tuned/{profile}", f"/usr/lib/tuned/{profile}"]
+    paths = [os.path.join(d, profile) for d in TUNED_PROFILE_DIRS]
     for path in paths:
         if os.path.exists(path):
             logging.debug(f"Found profile '{profile}' in '{path}'")
@@ -124,35 +324,344 @@ def get_profile_path(profile: str) -> str:
     sys.exit(1)
 
 
-def get_variables_file_path(profile_path: str) -> str:
-    profile = configparser.ConfigParser()
-    profile.read(os.path.join(profile_path, "tuned.conf"))
-    if "variables" in profile and "include" in profile["variables"]:
-        variables_file = profile["variables"]["include"]
-        logging.debug(f"Profile '{profile_path}' includes '{variables_file}'")
-        if not os.path.exists(variables_file):
-            logging.error(f"'{variables_file}' doesn't exist")
+class ProfileGraph:
+    """Files the TuneD profile depends on: the profile itself, its parent profiles ([main] include),
+    variables files ([variables] include), and scripts ([script] script) - followed recursively.
+
+    Parsing results of each tuned.conf are memoized in nodes and reused as long as the file's metadata
+    does not change: {tuned.conf path: {"stat": [...], "includes": [...], "variables": "...", "scripts": [...]}}
+    """
+    PROFILE_DIR_VAR = "${i:PROFILE_DIR}"
+
+    def __init__(self, profile: str, path: str, variables_path: str, profile_paths: list[str],
+                 extra_files: list[str], nodes: dict):
+        self.profile = profile
+        self.path = path
+        self.variables_path = variables_path
+        # Directories of the profile and all its parents, parents first
+        self.profile_paths = profile_paths
+        # Referenced files outside of the profiles' directories
+        self.extra_files = extra_files
+        self.nodes = nodes
+
+    @property
+    def profiles(self) -> list[str]:
+        return [os.path.basename(path) for path in self.profile_paths]
+
+    @staticmethod
+    def resolve(profile: str, memoized: dict) -> 'ProfileGraph':
+        nodes = {}
+        profile_paths = []
+        referenced = []
+        visiting = []
+
+        def visit(name: str) -> str:
+            path = get_profile_path(name)
+            if path in visiting:
+                cycle = [os.path.basename(p) for p in visiting[visiting.index(path):]] + [name]
+                logging.error(f"Profile include cycle detected: {' -> '.join(cycle)}")
+                sys.exit(1)
+            if path in profile_paths:
+                return path
+            visiting.append(path)
+            node = ProfileGraph.load_node(path, memoized)
+            nodes[os.path.join(path, "tuned.conf")] = node
+            for parent in node["includes"]:
+                visit(parent)
+            visiting.pop()
+            profile_paths.append(path)
+            referenced.extend(([node["variables"]] if node["variables"] else []) + node["scripts"])
+            return path
+
+        path = visit(profile)
+        variables_path = nodes[os.path.join(path, "tuned.conf")]["variables"]
+        extra_files = []
+        for file in referenced:
+            in_profile = any(file.startswith(os.path.join(p, "")) for p in profile_paths)
+            if not in_profile and file not in extra_files:
+                extra_files.append(file)
+        graph = ProfileGraph(profile, path, variables_path, profile_paths, extra_files, nodes)
+        logging.debug(f"Profile '{profile}' depends on profiles {graph.profiles} and files {extra_files}")
+        return graph
+
+    @staticmethod
+    def load_node(profile_path: str, memoized: dict) -> dict:
+        conf_path = os.path.join(profile_path, "tuned.conf")
+        stat = get_file_stat(conf_path)
+        node = memoized.get(conf_path)
+        if node is not None and node.get("stat") == stat:
+            logging.debug(f"Reusing memoized parsing results of '{conf_path}'")
+        else:
+            node = ProfileGraph.parse_node(profile_path)
+            node["stat"] = stat
+        for file in ([node["variables"]] if node["variables"] else []) + node["scripts"]:
+            if not os.path.exists(file):
+                logging.error(f"'{file}' referenced by '{conf_path}' doesn't exist")
+                sys.exit(1)
+        return node
+
+    @staticmethod
+    def parse_node(profile_path: str) -> dict:
+        conf_path = os.path.join(profile_path, "tuned.conf")
+        logging.debug(f"Parsing '{conf_path}'")
+        conf = configparser.ConfigParser(interpolation=None, strict=False)
+        conf.read(conf_path)
+
+        includes = []
+        if "main" in conf and "include" in conf["main"]:
+            includes = [name for name in re.split(r"\s*[,;]\s*", conf["main"]["include"].strip()) if name]
+            logging.debug(f"Profile '{profile_path}' includes profiles {includes}")
+
+        variables = ""
+        if "variables" in conf and "include" in conf["variables"]:
+            variables = ProfileGraph.expand_path(profile_path, conf["variables"]["include"])
+            logging.debug(f"Profile '{profile_path}' includes '{variables}'")
+        else:
+            logging.debug(f"Profile '{profile_path}' does not include variables")
+
+        scripts = []
+        if "script" in conf and "script" in conf["script"]:
+            for script in conf["script"]["script"].split():
+                script = ProfileGraph.expand_path(profile_path, script)
+                if script:
+                    scripts.append(script)
+
+        return {"includes": includes, "variables": variables, "scripts": scripts}
+
+    @staticmethod
+    def expand_path(profile_path: str, value: str) -> str:
+        """Expands profile directory variable in the path and makes it absolute.
+        Returns empty string if the path depends on other variables which cannot be resolved statically.
+        """
+        path = value.strip().replace(ProfileGraph.PROFILE_DIR_VAR, profile_path)
+        if "${" in path:
+            logging.warning(f"Cannot resolve '{value}' referenced by '{profile_path}', changes to it will not be detected")
+            return ""
+        return os.path.normpath(os.path.join(profile_path, path))
+
+
+def list_profile_files(profile_path: str) -> list[str]:
+    """Returns paths of all files within the profile directory (including nested ones) in a deterministic order."""
+    files = []
+    for root, dirs, names in os.walk(profile_path):
+        # Sort in place so os.walk descends into subdirectories in a stable order
+        dirs.sort()
+        files.extend(os.path.join(root, name) for name in names)
+    return sorted(files, key=lambda path: os.path.relpath(path, profile_path))
+
+
+def hash_files(paths: list[str], manifest: dict) -> str:
+    """Streams contents of the files through a single aggregate digest.
+
+    Digest of each individual file is stored in the manifest.
+    Aggregate digest is equal to `cat <paths> | md5sum`.
+    """
+    aggregate = hashlib.md5()
+    for path in paths:
+        file_digest = hashlib.md5()
+        try:
+            with open(path, 'rb') as f:
+                while chunk := f.read(HASH_CHUNK_SIZE):
+                    aggregate.update(chunk)
+                    file_digest.update(chunk)
+        except OSError as e:
+            logging.error(f"Failed to read '{path}': {e}")
             sys.exit(1)
-        return variables_file
-    logging.debug(f"Profile '{profile_path}' does not include variables")
-    return ""
+        manifest[path] = file_digest.hexdigest()
+    return aggregate.hexdigest()
 
 
-def get_profile_checksum(profile_path: str, variables_path: str) -> Checksums:
-    # Get md5sum of /{etc,usr/lib}/tuned/PROFILE/* contents.
-    # Alternative would be to use `tar c` to get contents, ownership, permissions, and timestamps,
+def get_file_stat(path: str) -> list[int]:
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        logging.error(f"Failed to stat '{path}': {e}")
+        sys.exit(1)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def get_graph_checksum(files: dict) -> str:
+    """Returns fingerprint combining digests of all the files from the manifest."""
+    graph_digest = hashlib.md5()
+    for path in sorted(files):
+        graph_digest.update(f"{path}\0{files[path]}\n".encode())
+    return graph_digest.hexdigest()
+
+
+def reuse_cached_checksums(cache: Checksums, graph: ProfileGraph, profile_files: list[str], stats: dict) -> Optional[Checksums]:
+    """Returns checksums based on the cache, hashing only the files whose metadata (size, mtime, inode)
+    changed or which are not in the cache. Digests of the other files are reused from the cache's manifest.
+
+    The requested profile's checksum is a digest of its files' concatenated contents, so it is only
+    recalculated from its files if some of them changed. Returns None for caches without the manifest.
+    """
+    if cache.graph_checksum is None:
+        logging.debug("Cache does not contain the files' manifest")
+        return None
+
+    files = {path: cache.files[path] for path in stats if path in cache.files and cache.stats.get(path) == stats[path]}
+    changed = [path for path in stats if path not in files]
+    if not changed and set(stats) == set(cache.files):
+        logging.info("Metadata of all files match the cache, skipping hashing")
+        return Checksums(cache.profile_checksum, cache.variables_checksum, files, stats, cache.graph_checksum)
+
+    logging.debug(f"Metadata changed for files: {changed}")
+    hash_files(changed, files)
+    removed = set(cache.files) - set(stats)
+    profile_checksum = cache.profile_checksum
+    if (any(files[path] != cache.files.get(path) for path in profile_files)
+            or any(path.startswith(os.path.join(graph.path, "")) for path in removed)):
+        logging.debug("Contents of the requested profile changed")
+        profile_checksum = hash_files(profile_files, {})
+    variables_checksum = files[graph.variables_path] if graph.variables_path != "" else ""
+    return Checksums(profile_checksum, variables_checksum, files, stats, get_graph_checksum(files))
+
+
+def get_profile_checksum(graph: ProfileGraph, cache: Optional[Checksums] = None) -> Checksums:
+    # Get md5 of /{etc,usr/lib}/tuned/PROFILE/ contents.
+    # Alternative would be to hash `tar c` to get contents, ownership, permissions, and timestamps,
     # but that could cause unnecessary reboots if files' timestamps got updated without changes to contents.
-    profile_checksum, _ = run_command(["bash", "-c", f"set -o pipefail && cat {os.path.join(profile_path, '*')} | md5sum"], failure_fatal=True)
-    if variables_path != "":
-        variables_checksum, _ = run_command(["bash", "-c", f"set -o pipefail && cat {variables_path} | md5sum"], failure_fatal=True)
-    else:
-        variables_checksum = ""
-    checksums = Checksums(profile_checksum.split(' ')[0], variables_checksum.split(' ')[0])
-    logging.info(f"Calculated checksums of requested profile: {checksums}")
+    # Files are concatenated in the order of their relative paths, so for flat profiles the checksum
+    # remains compatible with the one calculated by older versions (`cat PROFILE/* | md5sum`).
+    profile_files = list_profile_files(graph.path)
+    variables_files = [graph.variables_path] if graph.variables_path != "" else []
+    # Files of parent profiles and other referenced files only contribute to the graph checksum
+    dependency_files = []
+    for path in [p for p in graph.profile_paths if p != graph.path]:
+        dependency_files.extend(list_profile_files(path))
+    dependency_files.extend(graph.extra_files)
+    dependency_files = [f for f in dependency_files if f not in variables_files]
+    stats = {path: get_file_stat(path) for path in profile_files + variables_files + dependency_files}
+
+    checksums = None
+    if cache is not None:
+        checksums = reuse_cached_checksums(cache, graph, profile_files, stats)
+        if checksums is not None:
+            logging.info(f"Reusing cached checksums of requested profile: {checksums}")
+
+    if checksums is None:
+        files = {}
+        profile_checksum = hash_files(profile_files, files)
+        variables_checksum = hash_files(variables_files, files) if variables_files else ""
+        hash_files(dependency_files, files)
+        checksums = Checksums(profile_checksum, variables_checksum, files, stats, get_graph_checksum(files))
+        logging.info(f"Calculated checksums of requested profile: {checksums}")
+
+    checksums.graph = graph.nodes
     return checksums
 
 
+def read_settings(path: str, section: str = "") -> dict:
+    """Parses settings of the profile's tuned.conf or, if section is given, variables file without sections."""
+    conf = configparser.ConfigParser(interpolation=None, strict=False)
+    # Keep keys' case, e.g. sysctl names
+    conf.optionxform = str
+    with open(path) as f:
+        content = f.read()
+    if section != "":
+        content = f"[{section}]\n{content}"
+    conf.read_string(content, source=path)
+    return {name: dict(conf[name]) for name in conf.sections()}
+
+
+def read_profile_settings(graph: ProfileGraph) -> dict:
+    """Returns snapshot of settings of all the profiles and variables files in the graph."""
+    settings = {}
+    for conf_path, node in graph.nodes.items():
+        files = [(conf_path, "")] + ([(node["variables"], "variables")] if node["variables"] else [])
+        for path, section in files:
+            try:
+                settings[path] = read_settings(path, section)
+            except (OSError, configparser.Error) as e:
+                # Changes to the file will be considered as requiring a reboot
+                logging.warning(f"Failed to parse '{path}': {e}")
+    return settings
+
+
+def get_reboot_variables(settings: list[dict]) -> set[str]:
+    """Returns names of variables which (transitively) affect reboot-requiring sections."""
+    definitions = {}
+    referenced = set(REBOOT_VARIABLES)
+    for file_settings in settings:
+        for section, values in file_settings.items():
+            if section == "variables":
+                for key, value in values.items():
+                    definitions.setdefault(key, set()).update(VARIABLE_REFERENCE.findall(value))
+            elif section not in LIVE_SECTIONS:
+                for value in values.values():
+                    referenced.update(VARIABLE_REFERENCE.findall(value))
+
+    pending = list(referenced)
+    while pending:
+        for name in definitions.get(pending.pop(), set()) - referenced:
+            referenced.add(name)
+            pending.append(name)
+    return referenced
+
+
+def classify_changes(graph: ProfileGraph, old: Checksums, new: Checksums) -> tuple[list[str], list[str]]:
+    """Diffs old and new settings of changed files and returns lists of live-applicable
+    and reboot-requiring changes."""
+    scripts = {script for node in graph.nodes.values() for script in node["scripts"]}
+    reboot_variables = get_reboot_variables(list(old.settings.values()) + list(new.settings.values()))
+    live, reboot = [], []
+    for path in new.changed_files(old):
+        if path in new.settings or path in old.settings:
+            if path in old.files and path not in old.settings:
+                reboot.append(f"{path}: previous settings are unknown")
+                continue
+            old_settings = old.settings.get(path, {})
+            new_settings = new.settings.get(path, {})
+            for section in sorted(set(old_settings) | set(new_settings)):
+                old_values = old_settings.get(section, {})
+                new_values = new_settings.get(section, {})
+                for key in sorted(set(old_values) | set(new_values)):
+                    if old_values.get(key) == new_values.get(key):
+                        continue
+                    change = f"{path}: [{section}] {key}"
+                    if section == "variables":
+                        requires_reboot = key in reboot_variables
+                    else:
+                        requires_reboot = section not in LIVE_SECTIONS
+                    (reboot if requires_reboot else live).append(change)
+        elif path in scripts:
+            # Scripts are executed by TuneD when the profile is applied
+            live.append(f"{path}: script")
+        else:
+            reboot.append(f"{path}: unknown file")
+    return (live, reboot)
+
+
+def print_plan(profile: str, activate: bool, reboot_required: bool, live: list[str], reboot: list[str]) -> None:
+    if not activate:
+        decision = "nothing to do"
+    elif reboot_required:
+        decision = f"activate profile '{profile}' and reboot"
+    else:
+        decision = f"activate profile '{profile}' without reboot"
+    print(f"Decision: {decision}")
+    print("Live-applicable changes:")
+    for change in live:
+        print(f"  {change}")
+    print("Reboot-requiring changes:")
+    for change in reboot:
+        print(f"  {change}")
+
+
 def activate_profile(profile: str) -> None:
+    client = get_dbus_client()
+    if client is not None:
+        try:
+            success, message = client.switch_profile(profile)
+        except GLib.Error as e:
+            logging.warning(f"Failed to activate TuneD profile over D-Bus, falling back to tuned-adm: {e.message}")
+        else:
+            if not success:
+                logging.error(f"Failed to activate profile '{profile}': {message}")
+                sys.exit(1)
+            logging.info(f"Activated profile '{profile}'")
+            return
+
     run_command(["tuned-adm", "profile", profile], failure_fatal=True)
 
 
@@ -161,12 +670,92 @@ def reboot() -> None:
 
 
 def tuned_daemon_should_be_running():
-    _, success = run_command(["systemctl", "is-active", "tuned.service"])
+    client = get_dbus_client()
+    success = None
+    if client is not None:
+        try:
+            success = client.is_unit_active("tuned.service")
+        except GLib.Error as e:
+            logging.warning(f"Failed to get tuned.service state over D-Bus, falling back to systemctl: {e.message}")
+    if success is None:
+        _, success = run_command(["systemctl", "is-active", "tuned.service"])
     if not success:
         logging.error("TuneD service is not running")
         sys.exit(1)
 
 
+class Inotify:
+    """Minimal inotify(7) bindings - Python's standard library does not provide any."""
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+    # struct inotify_event: int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[];
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1 failed: {os.strerror(errno)}")
+        # {watch descriptor: (directory, names of relevant entries or None for all)}
+        self.watches = {}
+
+    def add_watch(self, directory: str, names: Optional[set[str]] = None) -> None:
+        """Watches the directory for changes of the specified entries (or all entries if names is None)."""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), Inotify.MASK)
+        if wd < 0:
+            logging.debug(f"Cannot watch '{directory}': {os.strerror(ctypes.get_errno())}")
+            return
+        if wd in self.watches:
+            # Same directory is already watched - merge the names of interest
+            _, existing = self.watches[wd]
+            names = None if existing is None or names is None else existing | names
+        self.watches[wd] = (directory, names)
+        logging.debug(f"Watching '{directory}' for changes of: {names if names is not None else 'all entries'}")
+
+    def clear(self) -> None:
+        for wd in self.watches:
+            self.libc.inotify_rm_watch(self.fd, wd)
+        self.watches = {}
+
+    def wait(self, timeout: Optional[float]) -> Optional[list[str]]:
+        """Waits for events up to timeout (forever if None) and returns paths of relevant changed entries.
+
+        Returns None if there were no events at all before the timeout.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return None
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, _, _, length = Inotify.EVENT.unpack_from(data, offset)
+            offset += Inotify.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if wd not in self.watches:
+                continue
+            directory, names = self.watches[wd]
+            if names is not None and name not in names:
+                continue
+            changed.append(os.path.join(directory, name) if name else directory)
+        return changed
+
+
 def should_run_as_root():
     if os.getuid() != 0:
         logging.error("Program must run with root privileges")
@@ -182,11 +771,15 @@ def main():
 When program starts, it compares configuration and system state.
 If the requested profile is not activate, it will be activated,
 and if reboot_after_apply is True, the node will be rebooted.
-When profile is being activated, checksums of the profile contents
-and its variables are stored in separate location.
+When profile is being activated, checksums of the profile contents,
+its variables, and all the profiles it includes are stored in separate location.
 Later, when program starts again, it compares stored checksums with
 current state of the profile and only reactivate and (optionally)
 reboot the host if the profile has changed.
+Reboot is skipped if only settings applied by TuneD at runtime changed
+(e.g. sysctl), use --plan to print the decision without applying it.
+With --watch, program keeps running and repeats the comparison
+whenever the configuration, profile, or variables file change.
 
 Configuration file is at {Config.PATH} and it has following schema:
     profile: <name of the tuned profile>
@@ -195,35 +788,149 @@ Configuration file is at {Config.PATH} and it has following schema:
     parser.add_argument("--live-run",
                         action='store_true',
                         help="Allows program to reboot the node if it was requested in the configuration file (reboot_after_apply)")
+    parser.add_argument("--watch",
+                        action='store_true',
+                        help="Keep running and reconcile the profile whenever the configuration, profile, or variables change")
+    parser.add_argument("--plan",
+                        action='store_true',
+                        help="Only print the decision and the list of changed settings without activating the profile")
+    parser.add_argument("--timings",
+                        action='store_true',
+                        help="Print JSON record with durations of program's phases to the standard output")
 
     args = parser.parse_args()
 
-    should_run_as_root()
-    tuned_daemon_should_be_running()
-    cfg = Config.load()
+    TIMINGS.reset()
+    try:
+        should_run_as_root()
+        with TIMINGS.phase("tuned-check"):
+            tuned_daemon_should_be_running()
+
+        if args.watch:
+            watch(args.live_run, args.timings)
+        else:
+            cfg, graph, cache = resolve_profile()
+            reconcile(cfg, graph, cache, args.live_run, args.plan)
+    finally:
+        # Also print timings when the program exits early (e.g. no changes detected)
+        if args.timings and not args.watch:
+            print(TIMINGS.to_json())
+
+
+def resolve_profile() -> tuple[Config, ProfileGraph, Optional[Checksums]]:
+    """Loads the configuration, the cache, and resolves dependency graph of the requested profile."""
+    with TIMINGS.phase("config-load"):
+        cfg = Config.load()
+    with TIMINGS.phase("cache-load"):
+        cache = Checksums.load_from_cache()
+    with TIMINGS.phase("profile-lookup"):
+        graph = ProfileGraph.resolve(cfg.profile, cache.graph if cache is not None else {})
+    return (cfg, graph, cache)
+
 
-    profile_path = get_profile_path(cfg.profile)
-    vars_path = get_variables_file_path(profile_path)
-    checksums = get_profile_checksum(profile_path, vars_path)
+def reconcile(cfg: Config, graph: ProfileGraph, cache: Optional[Checksums], live_run: bool, plan: bool = False) -> None:
+    """Activates requested profile (and optionally reboots the host) if it's not active or it changed.
 
-    active_profile, active = get_active_profile()
+    Reboot is skipped if all changes since the last activation are applied by TuneD at runtime.
+    """
+    with TIMINGS.phase("hashing"):
+        checksums = get_profile_checksum(graph, cache)
+    live, reboot_changes = [], []
+    reboot_required = True
+
+    with TIMINGS.phase("tuned-active"):
+        active_profile, active = get_active_profile()
     if active and cfg.profile == active_profile:
         logging.info(f"Active profile and requested profile are the same: '{active_profile}'.")
-        cache = Checksums.load_from_cache()
         if cache is not None and cache == checksums:
-            logging.info("No changes to profile or variables detected. Exiting...")
-            sys.exit(0)
+            checksums.settings = cache.settings
+            if plan:
+                print_plan(cfg.profile, False, False, [], [])
+                return
+            if (cache.stats, cache.graph, cache.graph_checksum) != (checksums.stats, checksums.graph, checksums.graph_checksum):
+                # Refresh the metadata so the files are not hashed nor parsed again on the next run
+                with TIMINGS.phase("cache-write"):
+                    checksums.write_to_cache()
+            logging.info("No changes to profile or variables detected.")
+            return
+        with TIMINGS.phase("classify"):
+            checksums.settings = read_profile_settings(graph)
+            if cache is not None:
+                logging.info(f"Changed files: {checksums.changed_files(cache)}")
+                live, reboot_changes = classify_changes(graph, cache, checksums)
+                reboot_required = len(reboot_changes) > 0
+                logging.info(f"Live-applicable changes: {live}")
+                logging.info(f"Reboot-requiring changes: {reboot_changes}")
+    else:
+        with TIMINGS.phase("classify"):
+            checksums.settings = read_profile_settings(graph)
 
-    activate_profile(cfg.profile)
-    checksums.write_to_cache()
+    if plan:
+        print_plan(cfg.profile, True, reboot_required and cfg.reboot_after_apply, live, reboot_changes)
+        return
+
+    with TIMINGS.phase("tuned-activate"):
+        activate_profile(cfg.profile)
+    with TIMINGS.phase("cache-write"):
+        checksums.write_to_cache()
 
     if cfg.reboot_after_apply:
-        if args.live_run:
+        if not reboot_required:
+            logging.info("Only live-applicable settings changed, reboot is not needed.")
+        elif live_run:
             logging.info("Rebooting the host")
             reboot()
         else:
             logging.info("Reboot is skipped because --live-run was not provided.")
 
 
+def watch_profile(inotify: Inotify, graph: ProfileGraph) -> None:
+    """Sets up inotify watches for the configuration file and all the files the profile depends on."""
+    inotify.clear()
+    inotify.add_watch(os.path.dirname(Config.PATH), {os.path.basename(Config.PATH)})
+    # Profiles can be created in, or removed from, any of TuneD's directories changing the profiles' paths
+    for tuned_dir in TUNED_PROFILE_DIRS:
+        inotify.add_watch(tuned_dir, set(graph.profiles))
+    for profile_path in graph.profile_paths:
+        for root, _, _ in os.walk(profile_path):
+            inotify.add_watch(root)
+    for file in [graph.variables_path] + graph.extra_files:
+        if file != "":
+            inotify.add_watch(os.path.dirname(file), {os.path.basename(file)})
+
+
+def watch(live_run: bool, timings: bool = False) -> None:
+    """Reconciles the profile on start and then after every burst of changes to the relevant files."""
+    inotify = Inotify()
+    while True:
+        TIMINGS.reset()
+        resolved = False
+        try:
+            cfg, graph, cache = resolve_profile()
+            # Watches are set up before reconciling, so changes made in the meantime are not missed
+            watch_profile(inotify, graph)
+            resolved = True
+            reconcile(cfg, graph, cache, live_run)
+        except SystemExit:
+            # Errors are already logged - wait for the user to fix the configuration or the profile
+            logging.error("Failed to reconcile TuneD profile, waiting for changes")
+            if not resolved:
+                # Profile or its variables file cannot be determined - watch everything they may depend on
+                inotify.clear()
+                inotify.add_watch(os.path.dirname(Config.PATH), {os.path.basename(Config.PATH)})
+                for tuned_dir in TUNED_PROFILE_DIRS:
+                    inotify.add_watch(tuned_dir)
+        if timings:
+            print(TIMINGS.to_json(), flush=True)
+
+        changed = []
+        while not changed:
+            changed = inotify.wait(None)
+        # Debounce: keep collecting events until there are none for WATCH_DEBOUNCE_SECONDS
+        while (events := inotify.wait(WATCH_DEBOUNCE_SECONDS)) is not None:
+            changed.extend(events)
+        logging.info(f"Detected changes: {sorted(set(changed))}")
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,365 @@
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+SPEC = importlib.util.spec_from_file_location(
+    "microshift_tuned", os.path.join(os.path.dirname(os.path.abspath(__file__)), "microshift-tuned.py"))
+mt = importlib.util.module_from_spec(SPEC)
+SPEC.loader.exec_module(mt)
+
+
+class StopWatch(Exception):
+    pass
+
+
+@pytest.fixture
+def profile_env(tmp_path, monkeypatch):
+    """Requested 'test' profile in a temporary TuneD directory with its configuration and cache files."""
+    tuned_dir = tmp_path / "tuned"
+    profile_dir = tuned_dir / "test"
+    profile_dir.mkdir(parents=True)
+    (profile_dir / "tuned.conf").write_text("[main]\nsummary=test\n\n[sysctl]\nvm.swappiness=10\n")
+    config = tmp_path / "tuned.yaml"
+    config.write_text("profile: test\nreboot_after_apply: False\n")
+
+    monkeypatch.setattr(mt, "TUNED_PROFILE_DIRS", [str(tuned_dir)])
+    monkeypatch.setattr(mt.Config, "PATH", str(config))
+    monkeypatch.setattr(mt.Checksums, "PATH", str(tmp_path / "microshift-tuned.yaml"))
+    return profile_dir
+
+
+def test_watch_debounces_burst_of_writes(profile_env, monkeypatch):
+    activations = []
+    active = {"profile": ""}
+
+    def activate_profile(profile):
+        activations.append(profile)
+        active["profile"] = profile
+
+    monkeypatch.setattr(mt, "activate_profile", activate_profile)
+    monkeypatch.setattr(mt, "get_active_profile", lambda: (active["profile"], active["profile"] != ""))
+
+    # The watch loop runs forever - stop it from the inotify wait once the test is done
+    stop = threading.Event()
+    wait = mt.Inotify.wait
+
+    def stoppable_wait(self, timeout):
+        if stop.is_set():
+            raise StopWatch()
+        return wait(self, timeout)
+
+    monkeypatch.setattr(mt.Inotify, "wait", stoppable_wait)
+    errors = []
+
+    def run():
+        try:
+            mt.watch(live_run=False)
+        except StopWatch:
+            pass
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    def wait_for_activations(count, timeout=5):
+        deadline = time.monotonic() + timeout
+        while len(activations) < count and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    # Initial activation of the requested profile
+    wait_for_activations(1)
+    assert activations == ["test"]
+
+    # Burst of writes shorter than the debounce period between each of them
+    conf = profile_env / "tuned.conf"
+    for i in range(20):
+        conf.write_text(f"[main]\nsummary=test\n\n[sysctl]\nvm.swappiness={i}\n")
+        time.sleep(mt.WATCH_DEBOUNCE_SECONDS / 10)
+
+    wait_for_activations(2)
+    # Nothing else is activated after the burst settles
+    time.sleep(mt.WATCH_DEBOUNCE_SECONDS * 3)
+    assert activations == ["test", "test"]
+
+    stop.set()
+    # Wake up the loop waiting for changes
+    conf.touch()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert errors == []
+
+
+def test_checksums_rehash_only_changed_files(profile_env, monkeypatch):
+    parent = profile_env.parent / "parent"
+    parent.mkdir()
+    (parent / "tuned.conf").write_text("[sysctl]\nvm.dirty_ratio=10\n")
+    (profile_env / "tuned.conf").write_text("[main]\ninclude=parent\n\n[sysctl]\nvm.swappiness=10\n")
+    (profile_env / "script.sh").write_text("#!/bin/sh\n")
+    cache = mt.get_profile_checksum(mt.ProfileGraph.resolve("test", {}))
+
+    hashed = []
+    hash_files = mt.hash_files
+
+    def recording_hash_files(paths, manifest):
+        hashed.append(list(paths))
+        return hash_files(paths, manifest)
+
+    monkeypatch.setattr(mt, "hash_files", recording_hash_files)
+
+    # Only the parent profile changed, the requested profile's checksum is reused
+    (parent / "tuned.conf").write_text("[sysctl]\nvm.dirty_ratio=100\n")
+    graph = mt.ProfileGraph.resolve("test", cache.graph)
+    checksums = mt.get_profile_checksum(graph, cache)
+    assert hashed == [[str(parent / "tuned.conf")]]
+    assert checksums.profile_checksum == cache.profile_checksum
+    assert checksums.changed_files(cache) == [str(parent / "tuned.conf")]
+    monkeypatch.setattr(mt, "hash_files", hash_files)
+    full = mt.get_profile_checksum(graph)
+    assert (checksums.files, checksums.graph_checksum) == (full.files, full.graph_checksum)
+
+    # The requested profile's checksum is recalculated from its files
+    monkeypatch.setattr(mt, "hash_files", recording_hash_files)
+    hashed.clear()
+    (profile_env / "tuned.conf").write_text("[main]\ninclude=parent\n\n[sysctl]\nvm.swappiness=100\n")
+    graph = mt.ProfileGraph.resolve("test", checksums.graph)
+    updated = mt.get_profile_checksum(graph, checksums)
+    assert hashed == [[str(profile_env / "tuned.conf")], [str(profile_env / "script.sh"), str(profile_env / "tuned.conf")]]
+    assert updated == mt.get_profile_checksum(graph)
+    assert updated.profile_checksum != checksums.profile_checksum
+
+
+PROFILE_CONF = """[main]
+summary=test
+
+[variables]
+include=${i:PROFILE_DIR}/variables.conf
+
+[sysctl]
+vm.swappiness=%s
+kernel.sched_rt_runtime_us=${rt_runtime}
+
+[bootloader]
+cmdline=isolcpus=${cpus}
+"""
+VARIABLES_CONF = """isolated_cores=%s
+cpus=${isolated_cores}
+rt_runtime=%s
+"""
+
+
+def get_checksums(cache=None):
+    """Checksums of the 'test' profile with the settings snapshot, as written to the cache on activation."""
+    graph = mt.ProfileGraph.resolve("test", cache.graph if cache else {})
+    checksums = mt.get_profile_checksum(graph, cache)
+    checksums.settings = mt.read_profile_settings(graph)
+    return graph, checksums
+
+
+def test_classify_live_and_reboot_changes(profile_env):
+    conf = profile_env / "tuned.conf"
+    variables = profile_env / "variables.conf"
+    conf.write_text(PROFILE_CONF % "10")
+    variables.write_text(VARIABLES_CONF % ("1", "950000"))
+    _, old = get_checksums()
+
+    # Settings of the sections applied by TuneD at runtime and the variables they use
+    conf.write_text(PROFILE_CONF % "20")
+    variables.write_text(VARIABLES_CONF % ("1", "-1"))
+    graph, new = get_checksums()
+    assert mt.classify_changes(graph, old, new) == (
+        [f"{conf}: [sysctl] vm.swappiness", f"{variables}: [variables] rt_runtime"], [])
+
+    # The variable ends up on the kernel command line through another variable
+    variables.write_text(VARIABLES_CONF % ("2-3", "-1"))
+    graph, newer = get_checksums()
+    assert mt.classify_changes(graph, new, newer) == ([], [f"{variables}: [variables] isolated_cores"])
+
+
+def test_include_cycle(profile_env):
+    tuned_dir = profile_env.parent
+    for name, parent in [("test", "a"), ("a", "b"), ("b", "a")]:
+        (tuned_dir / name).mkdir(exist_ok=True)
+        (tuned_dir / name / "tuned.conf").write_text(f"[main]\ninclude={parent}\n")
+    with pytest.raises(SystemExit):
+        mt.ProfileGraph.resolve("test", {})
+
+
+def test_checksums_reused_for_unchanged_metadata(profile_env, monkeypatch):
+    (profile_env / "tuned.conf").write_text(PROFILE_CONF % "10")
+    (profile_env / "variables.conf").write_text(VARIABLES_CONF % ("1", "950000"))
+    _, cache = get_checksums()
+
+    hashed = []
+    hash_files = mt.hash_files
+
+    def recording_hash_files(paths, manifest):
+        hashed.append(list(paths))
+        return hash_files(paths, manifest)
+
+    monkeypatch.setattr(mt, "hash_files", recording_hash_files)
+    _, checksums = get_checksums(cache)
+    assert hashed == []
+    assert checksums == cache
+    assert checksums.files == cache.files
+
+    # Only the touched file is hashed, its contents match the cache
+    os.utime(profile_env / "variables.conf", ns=(0, 0))
+    _, checksums = get_checksums(cache)
+    assert hashed == [[str(profile_env / "variables.conf")]]
+    assert checksums == cache
+    assert checksums.changed_files(cache) == []
+    assert checksums.stats != cache.stats
+
+
+FAKE_SERVICES = '''
+import sys
+from gi.repository import Gio, GLib
+
+XML = """<node>
+  <interface name="com.redhat.tuned.control">
+    <method name="active_profile"><arg type="s" direction="out"/></method>
+    <method name="switch_profile"><arg type="s" direction="in"/><arg type="(bs)" direction="out"/></method>
+    <signal name="profile_changed"><arg type="s"/><arg type="b"/><arg type="s"/></signal>
+  </interface>
+  <interface name="org.freedesktop.systemd1.Manager">
+    <method name="GetUnit"><arg type="s" direction="in"/><arg type="o" direction="out"/></method>
+  </interface>
+  <interface name="org.freedesktop.systemd1.Unit">
+    <property name="ActiveState" type="s" access="read"/>
+  </interface>
+</node>"""
+UNIT_PATH = "/org/freedesktop/systemd1/unit/tuned_2eservice"
+state = {"profile": ""}
+
+
+def method_call(conn, sender, path, iface, method, params, invocation):
+    if method == "active_profile":
+        invocation.return_value(GLib.Variant("(s)", (state["profile"],)))
+    elif method == "switch_profile":
+        (profile,) = params.unpack()
+        state["profile"] = profile
+        invocation.return_value(GLib.Variant("((bs))", ((True, "OK"),)))
+
+        def emit():
+            conn.emit_signal(None, "/Tuned", "com.redhat.tuned.control", "profile_changed",
+                             GLib.Variant("(sbs)", (profile, True, "OK")))
+            return GLib.SOURCE_REMOVE
+        # TuneD signals the result after the profile is applied
+        GLib.timeout_add(100, emit)
+    elif method == "GetUnit":
+        (unit,) = params.unpack()
+        if unit == "tuned.service":
+            invocation.return_value(GLib.Variant("(o)", (UNIT_PATH,)))
+        else:
+            invocation.return_dbus_error("org.freedesktop.systemd1.NoSuchUnit", f"Unit {unit} not loaded.")
+
+
+def get_property(conn, sender, path, iface, name):
+    return GLib.Variant("s", "active")
+
+
+conn = Gio.DBusConnection.new_for_address_sync(
+    sys.argv[1], Gio.DBusConnectionFlags.AUTHENTICATION_CLIENT | Gio.DBusConnectionFlags.MESSAGE_BUS_CONNECTION,
+    None, None)
+node = Gio.DBusNodeInfo.new_for_xml(XML)
+conn.register_object_with_closures("/Tuned", node.lookup_interface("com.redhat.tuned.control"),
+                                   method_call, None, None)
+conn.register_object_with_closures("/org/freedesktop/systemd1", node.lookup_interface("org.freedesktop.systemd1.Manager"),
+                                   method_call, None, None)
+conn.register_object_with_closures(UNIT_PATH, node.lookup_interface("org.freedesktop.systemd1.Unit"),
+                                   None, get_property, None)
+for name in ["com.redhat.tuned", "org.freedesktop.systemd1"]:
+    conn.call_sync("org.freedesktop.DBus", "/org/freedesktop/DBus", "org.freedesktop.DBus", "RequestName",
+                   GLib.Variant("(su)", (name, 0)), None, Gio.DBusCallFlags.NONE, -1, None)
+print("ready", flush=True)
+GLib.MainLoop().run()
+'''
+
+
+@pytest.fixture(scope="module")
+def private_bus():
+    """Private message bus used as the system bus of the D-Bus client."""
+    if mt.Gio is None or shutil.which("dbus-daemon") is None:
+        pytest.skip("Python GObject bindings or dbus-daemon are not available")
+    daemon = subprocess.Popen(["dbus-daemon", "--session", "--nofork", "--print-address"],
+                              stdout=subprocess.PIPE, text=True)
+    address = daemon.stdout.readline().strip()
+    # The system bus connection is a singleton, so the bus is shared by all the tests
+    previous = os.environ.get("DBUS_SYSTEM_BUS_ADDRESS")
+    os.environ["DBUS_SYSTEM_BUS_ADDRESS"] = address
+    yield address
+    if previous is None:
+        del os.environ["DBUS_SYSTEM_BUS_ADDRESS"]
+    else:
+        os.environ["DBUS_SYSTEM_BUS_ADDRESS"] = previous
+    daemon.terminate()
+    daemon.wait()
+
+
+@pytest.fixture
+def dbus_client():
+    mt.get_dbus_client.cache_clear()
+    yield
+    mt.get_dbus_client.cache_clear()
+
+
+@pytest.fixture
+def fake_services(private_bus, tmp_path):
+    """Fake TuneD and systemd services on the private bus."""
+    script = tmp_path / "fake_services.py"
+    script.write_text(FAKE_SERVICES)
+    services = subprocess.Popen([sys.executable, str(script), private_bus], stdout=subprocess.PIPE, text=True)
+    assert services.stdout.readline().strip() == "ready"
+    yield
+    services.terminate()
+    services.wait()
+
+
+@pytest.fixture
+def cli_tools(monkeypatch):
+    """Records the commands of the CLI tools fallback instead of running them."""
+    commands = []
+
+    def run_command(cmd, failure_fatal=False):
+        commands.append(cmd)
+        if cmd[:2] == ["tuned-adm", "active"]:
+            return ("Current active profile: cli-profile\n", True)
+        return ("", True)
+
+    monkeypatch.setattr(mt, "run_command", run_command)
+    return commands
+
+
+def test_dbus_switch_profile(fake_services, dbus_client, cli_tools):
+    assert mt.get_dbus_client() is not None
+    assert mt.get_active_profile() == ("", False)
+    mt.activate_profile("test")
+    assert mt.get_active_profile() == ("test", True)
+    mt.tuned_daemon_should_be_running()
+    assert not mt.get_dbus_client().is_unit_active("missing.service")
+    # Nothing fell back to the CLI tools
+    assert cli_tools == []
+
+
+def test_dbus_fallback_when_service_is_absent(private_bus, dbus_client, cli_tools):
+    assert mt.get_dbus_client() is not None
+    assert mt.get_active_profile() == ("cli-profile", True)
+    mt.activate_profile("test")
+    mt.tuned_daemon_should_be_running()
+    assert cli_tools == [["tuned-adm", "active"], ["tuned-adm", "profile", "test"],
+                         ["systemctl", "is-active", "tuned.service"]]
+
+
+def test_cli_fallback_without_gobject_bindings(dbus_client, cli_tools, monkeypatch):
+    monkeypatch.setattr(mt, "Gio", None)
+    assert mt.get_dbus_client() is None
+    assert mt.get_active_profile() == ("cli-profile", True)
+    mt.activate_profile("test")
+    assert cli_tools == [["tuned-adm", "active"], ["tuned-adm", "profile", "test"]]
@@ -17,7 +17,12 @@ ${BASH_SOURCE[0]} (upload|download|verify|setlast|getlast|keep) [options]
 
 Manage build cache at the '${AWS_BUCKET_NAME}' AWS S3 bucket. The script
 assumes that the bucket exists and it is configured for read-write access
-using 'aws s3 (ls|sync|rm)' operations.
+using 'aws s3 (ls|sync|rm)' operations. The upload, download and verify
+operations transfer files concurrently. They read the AWS credentials from
+the AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY and AWS_SESSION_TOKEN environment
+variables, the static keys of the AWS_PROFILE profile in the shared credentials
+or config file, or the EC2 instance role. The credentials of profiles using SSO,
+assumed roles or credential processes must be exported to the environment.
 
 The cache directory structure is '${AWS_BUCKET_NAME}/<branch>/<arch>/<tag>'.
 
@@ -59,6 +64,14 @@ Options:
 EOF
 }
 
+run_build_cache() {
+    if ! python3 "${SCRIPTDIR}/pyutils/build_cache.py" "$@" ; then
+        echo "ERROR: Failed to run build cache command: $*" >&2
+        return 1
+    fi
+    return 0
+}
+
 run_aws_cli() {
     if ! "${AWSCLI}" "$@" ; then
         echo "ERROR: Failed to run AWS CLI command: $*" >&2
@@ -69,19 +82,13 @@ run_aws_cli() {
 
 check_contents(){
     local -r src_dir="s3://${AWS_BUCKET_NAME}/${BCH_SUBDIR}/${UNAME_M}/${TAG_SUBDIR}"
-    local -r must_contain_array=("repo\.tar$" "${VM_POOL_BASENAME}/.*\.iso$")
-    
-    echo "Checking contents of '${src_dir}'"
-    local s3_stdout
-    s3_stdout=$(${AWSCLI} s3 ls "${src_dir}" --recursive) || return 1
-
-    for item in "${must_contain_array[@]}"; do 
-        if ! echo "${s3_stdout}" | grep -qE "${item}";  then
-            return 1
-        fi
-    done
 
-    return 0
+    # The manifest of the cache entry lists its files, so that a single
+    # request is enough for checking the contents
+    echo "Checking contents of '${src_dir}'"
+    run_build_cache verify -l "${src_dir}" \
+        -r "repo\.tar$" \
+        -r "${VM_POOL_BASENAME}/.*\.iso$"
 }
 
 action_upload() {
@@ -93,25 +100,25 @@ action_upload() {
         return
     fi
 
-    # Upload ISO images
     local -r iso_base="${src_base}/${VM_POOL_BASENAME}"
     local -r iso_size="$(du -csh "${iso_base}" | awk 'END{print $1}')"
     local -r iso_dest="${dst_base}/${VM_POOL_BASENAME}"
 
-    echo "Uploading ${iso_size} of ISO images to '${iso_dest}'"
-    run_aws_cli s3 sync --quiet --include '*.iso' "${iso_base}" "${iso_dest}"
-
-    # Upload ostree commits
+    # Archive the ostree commits before the upload
     local -r repo_src="${src_base}/repo.tar"
     local -r repo_dst="${dst_base}/repo.tar"
 
-    # Archive the repo files before the upload
     rm -f "${repo_src}"
     tar cf "${repo_src}" -C "${src_base}" repo
-
     local -r repo_size="$(du -csh "${repo_src}" | awk 'END{print $1}')"
+
+    # Upload ISO images with their manifests and ostree commits concurrently
+    echo "Uploading ${iso_size} of ISO images to '${iso_dest}'"
     echo "Uploading ${repo_size} of ostree commits to '${repo_dst}'"
-    run_aws_cli s3 cp --quiet "${repo_src}" "${repo_dst}"
+    run_build_cache upload -l "${dst_base}" -d "${src_base}" \
+        -i "${VM_POOL_BASENAME}/*.iso" \
+        -i "${VM_POOL_BASENAME}/*.iso.json" \
+        -i "repo.tar"
     rm -f "${repo_src}"
 }
 
@@ -119,24 +126,19 @@ action_download() {
     local -r src_base="s3://${AWS_BUCKET_NAME}/${BCH_SUBDIR}/${UNAME_M}/${TAG_SUBDIR}"
     local -r dst_base="${IMAGEDIR}"
 
-    # Download ISO images
     local -r iso_base="${src_base}/${VM_POOL_BASENAME}"
     local -r iso_dest="${dst_base}/${VM_POOL_BASENAME}"
-
-    echo "Downloading ISO images from '${iso_base}'"
-    run_aws_cli s3 sync --quiet --include '*.iso' "${iso_base}" "${iso_dest}"
-
-    local -r iso_size="$(du -csh "${iso_dest}" | awk 'END{print $1}')"
-    echo "Downloaded ${iso_size} of ISO images"
-
-    # Download ostree commits
     local -r repo_src="${src_base}/repo.tar"
     local -r repo_dst="${dst_base}/repo.tar"
     local -r repo_dir="${dst_base}/repo"
 
+    echo "Downloading ISO images from '${iso_base}'"
     echo "Downloading ostree commits from '${repo_src}'"
-    rm -f "${repo_dst}"
-    run_aws_cli s3 cp --quiet "${repo_src}" "${repo_dst}"
+    # Download ISO images and ostree commits concurrently
+    run_build_cache download -l "${src_base}" -d "${dst_base}"
+
+    local -r iso_size="$(du -csh "${iso_dest}" | awk 'END{print $1}')"
+    echo "Downloaded ${iso_size} of ISO images"
 
     # Unarchive the repo files after the download
     rm -rf "${repo_dir}"
@@ -2,15 +2,27 @@
 
 import argparse
 import concurrent.futures
+import fcntl
 import getpass
 import glob
+import hashlib
+import heapq
+import json
+import multiprocessing
 import os
+import pathlib
 import platform
+import psutil
 import re
+import shutil
 import sys
+import tempfile
+import time
 import traceback
 
 import common
+import registry_client
+import rpm_utils
 
 # Global environment variables
 #
@@ -33,15 +45,56 @@ PULL_SECRET = common.get_env_var('PULL_SECRET', f"{HOME_DIR}/.pull-secret.json")
 BIB_IMAGE = "registry.redhat.io/rhel9/bootc-image-builder:latest"
 GOMPLATE = common.get_env_var('GOMPLATE')
 MIRROR_REGISTRY = common.get_env_var('MIRROR_REGISTRY_URL')
+# Keys of the rendered templates and environment variables they reference
+RENDER_MANIFEST = os.path.join(BOOTC_IMAGE_DIR, "render-manifest.json")
+TEMPLATE_ENV_REFERENCE = re.compile(r'\.Env\.(\w+)|[gG]etenv\s+"(\w+)"')
 FORCE_REBUILD = False
+# Repository of the mirror registry storing the intermediate layers of container
+# builds when the layer cache is enabled with the --layer-cache option
+LAYER_CACHE = False
+LAYER_CACHE_REPO = f"{MIRROR_REGISTRY}/microshift-layer-cache"
+# Resources reserved for the tasks of each build type: number of CPUs, memory
+# in GiB and the maximum number of tasks of the type running at the same time
+# (0 for no limit). Overridden with the --task-resources command line option.
+TASK_RESOURCES = {
+    "containerfile": {"cpus": 1, "memory": 2, "limit": 0},
+    "image-bootc": {"cpus": 2, "memory": 6, "limit": 2},
+    "container-encapsulate": {"cpus": 1, "memory": 2, "limit": 0},
+}
+# ISO images keyed by the digests of the images they were built from, linked
+# from the VM disk directory so that they can be reused under other names
+ISO_STORE_DIR = os.path.join(IMAGEDIR, "bootc-iso-store")
+# Linux FICLONE ioctl request for creating reflink copies
+FICLONE = 0x40049409
+# Image pulls shared by the tasks, initialized in main
+PULL_COORDINATOR = None
+# Durations of the tasks which performed their builds in earlier runs, used for
+# predicting the build time in the plan mode, and the defaults for new tasks
+TASK_DURATIONS_FILE = os.path.join(IMAGEDIR, "build-logs", "task-durations.json")
+DEFAULT_TASK_DURATIONS = {"containerfile": 600, "image-bootc": 900, "container-encapsulate": 300}
+# Input fingerprints of the groups processed successfully, used for skipping
+# the groups whose inputs did not change since
+GROUP_FINGERPRINTS_FILE = os.path.join(IMAGEDIR, "build-logs", "group-fingerprints.json")
+# Trace phases of the tasks which were not skipped
+BUILD_PHASES = {"build-container", "build-bootc-image"}
+# Labels of the mirror registry images read before scheduling the tasks,
+# inherited by the worker processes
+REGISTRY_LABELS = {}
+# Registry digests of the upstream images resolved for the group fingerprints
+UPSTREAM_DIGESTS = {}
+# Image label storing the cache key of the inputs a container image was built from
+CACHE_KEY_LABEL = "microshift.test.cache-key"
+# Number of output lines of failed commands to display, or 0 to stream all the output
+LOG_TAIL = 0
 
 
 def cleanup_atexit(dry_run):
     common.print_msg("Running atexit cleanup")
-    # Terminating any running subprocesses
-    for pid in common.find_subprocesses():
-        common.print_msg(f"Terminating {pid} PID")
-        common.terminate_process(pid)
+    # Terminating any running subprocesses at once with a common deadline
+    pids = common.find_subprocesses()
+    if pids:
+        common.print_msg(f"Terminating {pids} PIDs")
+        common.terminate_processes(pids)
 
     # Terminate running bootc image builder containers
     podman_args = [
@@ -58,11 +111,13 @@ def cleanup_atexit(dry_run):
 
 
 def find_latest_rpm(repo_path, version=""):
-    rpms = glob.glob(f"{repo_path}/**/microshift-release-info-{version}*.rpm", recursive=True)
-    if not rpms:
+    """Return the latest microshift-release-info package with the version prefix
+    in the repository, ordered by the rpm version comparison rules"""
+    index = rpm_utils.RepoIndex(repo_path, os.path.join(IMAGEDIR, "rpm-index-cache"))
+    rpm = index.latest("microshift-release-info", version)
+    if not rpm:
         raise Exception(f"Failed to find 'microshift-release-info-{version}*' RPM in {repo_path}")
-    rpms.sort()
-    return rpms[-1]
+    return rpm
 
 
 def is_rhocp_available(ver):
@@ -120,16 +175,13 @@ def set_rpm_version_info_vars():
     release_info_rpm = find_latest_rpm(LOCAL_REPO)
     release_info_rpm_base = find_latest_rpm(BASE_REPO)
 
-    SOURCE_VERSION = common.run_command_in_shell(f"rpm -q --queryformat '%{{version}}-%{{release}}' {release_info_rpm}")
-    SOURCE_VERSION_BASE = common.run_command_in_shell(f"rpm -q --queryformat '%{{version}}-%{{release}}' {release_info_rpm_base}")
+    SOURCE_VERSION = f"{release_info_rpm['version']}-{release_info_rpm['release']}"
+    SOURCE_VERSION_BASE = f"{release_info_rpm_base['version']}-{release_info_rpm_base['release']}"
 
     # The source images are used in selected container image builds
     global SOURCE_IMAGES
 
-    src_img_cmd = f"rpm2cpio {release_info_rpm}"
-    src_img_cmd += f' | cpio -i --to-stdout "*release-{UNAME_M}.json" 2>/dev/null'
-    src_img_cmd += ' | jq -r \'[ .images[] ] | join(",")\''
-    SOURCE_IMAGES = common.run_command_in_shell(src_img_cmd)
+    SOURCE_IMAGES = ",".join(get_release_info_images(release_info_rpm["path"]))
 
     global SSL_CLIENT_KEY_FILE
     global SSL_CLIENT_CERT_FILE
@@ -154,20 +206,41 @@ def set_rpm_version_info_vars():
         os.environ[var] = str(value)
 
 
+def get_release_info_images(rpm_path):
+    """Return the list of images in the release info RPM, reading the release
+    file from the RPM payload and caching the list per RPM checksum"""
+    cache_dir = common.create_dir(f"{IMAGEDIR}/release-info-rpms/cache")
+    cache_file = os.path.join(cache_dir, f"{get_file_digest(rpm_path)}-{UNAME_M}.json")
+    if os.path.exists(cache_file):
+        return json.loads(common.read_file(cache_file))
+
+    member = f"release-{UNAME_M}.json"
+    try:
+        content = rpm_utils.read_payload_file(rpm_path, lambda name: name.endswith(member))
+    except rpm_utils.UnsupportedPayload as e:
+        # Fall back to the external tools if the payload cannot be decompressed in Python
+        common.print_msg(f"{e} in '{rpm_path}', using rpm2cpio")
+        content = common.run_command_in_shell(f"rpm2cpio '{rpm_path}' | cpio -i --to-stdout '*{member}' 2> /dev/null")
+    if not content:
+        raise Exception(f"Failed to find '{member}' file in '{rpm_path}'")
+
+    images = list(json.loads(content)["images"].values())
+    common.write_file_atomic(cache_file, json.dumps(images))
+    return images
+
+
 def get_container_images(path, version):
     # Find the last microshift-release-info RPM with the specified version
     release_info_rpm = find_latest_rpm(path, version)
-    # Extract list of image URIs and join them with a comma
-    cpio_cmd = f"rpm2cpio '{release_info_rpm}' | cpio -i --to-stdout '*release-{UNAME_M}.json' 2> /dev/null"
-    jq_cmd = "jq -r '[.images[]] | join(\",\")'"
-    return common.run_command_in_shell(f"{cpio_cmd} | {jq_cmd}")
+    return get_release_info_images(release_info_rpm["path"])
 
 
-def extract_container_images(version, repo_spec, outfile, dry_run=False):
+def extract_container_images(version, repo_spec, dry_run=False):
     common.print_msg(f"Extracting images from {version}")
-    # Create and change the directory for extracting RPMs
-    image_path = common.create_dir(f"{IMAGEDIR}/release-info-rpms")
-    common.pushd(str(image_path))
+    # Create a separate directory for the RPMs of each version as the
+    # extractions run in parallel
+    version_dir = re.sub(r'[^\w.-]', '_', version)
+    image_path = common.create_dir(f"{IMAGEDIR}/release-info-rpms/{version_dir}")
 
     repo_name = common.basename(repo_spec)
     dnf_options = []
@@ -185,28 +258,93 @@ def extract_container_images(version, repo_spec, outfile, dry_run=False):
         dnf_options.extend(["--repo", repo_spec])
 
     # Construct and execute the dnf download command
-    dnf_command = ["sudo", "dnf", "download"] + dnf_options + [f"microshift-release-info-{version}"]
+    images = []
+    dnf_command = ["sudo", "dnf", "download", "--destdir", str(image_path)] + dnf_options + [f"microshift-release-info-{version}"]
     if common.run_command(dnf_command, dry_run) is not None:
-        images_output = get_container_images(str(image_path), version)
-        with open(outfile, "a") as f:
-            f.write(images_output.replace(',', '\n'))
-            f.write('\n')
+        images = get_container_images(str(image_path), version)
 
         # Cleanup RPM files
         rpm_list = list(map(str, image_path.glob("microshift-release-info-*.rpm")))
         common.run_command(["sudo", "rm", "-f"] + rpm_list, dry_run)
-    # Restore the current directory
-    common.popd()
+    return images
 
 
-def run_template_cmd(ifile, ofile, dry_run):
-    # Run the templating command
-    gomplate_args = [
-        GOMPLATE,
-        "--file", ifile,
-        "--out", ofile
-    ]
-    common.run_command_in_shell(gomplate_args, dry_run)
+def extract_all_container_images(versions, outfile, dry_run=False):
+    """Extract the images of the (version, repo_spec) list of release info RPMs
+    in parallel and write their de-duplicated list to the output file"""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(versions)) as executor:
+        futures = [executor.submit(extract_container_images, version, repo_spec, dry_run) for version, repo_spec in versions]
+        results = [f.result() for f in futures]
+    if dry_run:
+        return
+    images = list(dict.fromkeys(image for result in results for image in result))
+    common.print_msg(f"Writing {len(images)} unique images to '{outfile}'")
+    common.write_file_atomic(outfile, "".join(f"{image}\n" for image in images))
+
+
+def get_file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def get_template_key(ifile):
+    """Compute a key of the template contents and the environment variables it references"""
+    content = common.read_file(ifile)
+    key = hashlib.sha256(content.encode())
+    env_vars = {m.group(1) or m.group(2) for m in TEMPLATE_ENV_REFERENCE.finditer(content)}
+    for var in sorted(env_vars):
+        # Unset and empty variables render differently with default values
+        key.update(f"{var}={os.environ.get(var)}\n".encode())
+    return key.hexdigest()
+
+
+def render_templates(files, dry_run):
+    """Render the list of input and output file pairs with a single templating
+    command, skipping the outputs whose templates and referenced environment
+    variables did not change since they were rendered"""
+    manifest = {}
+    if os.path.exists(RENDER_MANIFEST):
+        try:
+            manifest = json.loads(common.read_file(RENDER_MANIFEST))
+        except ValueError:
+            common.print_msg(f"Ignoring invalid '{RENDER_MANIFEST}' manifest")
+
+    gomplate_args = [GOMPLATE]
+    keys = {}
+    previous = {}
+    for ifile, ofile in files:
+        keys[ofile] = get_template_key(ifile)
+        if os.path.exists(ofile):
+            digest = get_file_digest(ofile)
+            entry = manifest.get(ofile, {})
+            if not FORCE_REBUILD and entry.get("key") == keys[ofile] and entry.get("digest") == digest:
+                continue
+            # Remember the modification time to be preserved if the contents do not change
+            previous[ofile] = (digest, os.stat(ofile))
+        gomplate_args += ["--file", ifile, "--out", ofile]
+
+    count = (len(gomplate_args) - 1) // 4
+    common.print_msg(f"Rendering {count} template(s), {len(files) - count} unchanged")
+    if count:
+        # Run the templating command
+        common.run_command_in_shell(gomplate_args, dry_run)
+    if dry_run:
+        return
+
+    for ofile, (digest, stat) in previous.items():
+        if get_file_digest(ofile) == digest:
+            os.utime(ofile, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    for ofile, key in keys.items():
+        manifest[ofile] = {"key": key, "digest": get_file_digest(ofile)}
+    common.write_file_atomic(RENDER_MANIFEST, json.dumps(manifest, indent=2))
+
+
+def run_logged_command(args, dry_run, logfile, prefix, attempts=1):
+    # Write the command output to the log file and stream it to the console
+    # with the prefix on each line, retrying the command if necessary
+    common.retry_on_exception(
+        attempts, common.run_command_in_shell, args, dry_run, logfile, logfile,
+        log_prefix=prefix, log_tail=LOG_TAIL)
 
 
 def get_process_file_names(idir, ifile, obasedir):
@@ -217,18 +355,213 @@ def get_process_file_names(idir, ifile, obasedir):
     return path, outname, outdir, logfile
 
 
+def get_local_image_id(imgref, dry_run):
+    inspect_args = [
+        "sudo", "podman", "image", "inspect",
+        "--format", "'{{.Id}}'", imgref
+    ]
+    return common.run_command_in_shell(inspect_args, dry_run)
+
+
+def get_local_image_label(imgref, label, dry_run):
+    """Return the label of the local image, or None if the image does not exist
+    or has no such label"""
+    try:
+        label_cmd = [
+            "sudo", "podman", "image", "inspect",
+            "--format", f"'{{{{ index .Labels \"{label}\" }}}}'",
+            imgref, "2>/dev/null"
+        ]
+        value = common.run_command_in_shell(label_cmd, dry_run)
+    except Exception:
+        return None
+    return value if value and value != "<no value>" else None
+
+
+def get_image_digest(imgref, dry_run):
+    """Return the identifier of a local image or the digest of a remote one"""
+    # Local images are built or copied by the tasks this one depends on
+    if imgref.startswith("localhost/"):
+        return get_local_image_id(imgref, dry_run)
+    inspect_args = [
+        "skopeo", "inspect",
+        "--authfile", PULL_SECRET,
+        "--format", "'{{.Digest}}'",
+        f"docker://{imgref}"
+    ]
+    return common.retry_on_exception(3, common.run_command_in_shell, inspect_args, dry_run)
+
+
+def get_image_key(imgref, dry_run):
+    """Return an identifier of the image content which is the same on all the
+    hosts: the cache key label of the images built from containerfiles, or the
+    registry digest of the remote images. The local image identifier differs
+    between hosts and it is only used when neither is available."""
+    cache_key = get_local_image_label(imgref, CACHE_KEY_LABEL, dry_run)
+    if cache_key:
+        return f"{CACHE_KEY_LABEL}={cache_key}"
+    if not imgref.startswith("localhost/"):
+        try:
+            return get_image_digest(imgref, dry_run)
+        except Exception as e:
+            common.print_msg(f"Cannot resolve '{imgref}' digest, using the local image ID: {e}")
+    return get_local_image_id(imgref, dry_run)
+
+
+def get_containerfile_sources(content):
+    """Return the build context paths copied by COPY and ADD instructions"""
+    build_args = {}
+    sources = []
+    # Join the continuation lines before parsing the instructions
+    for line in re.sub(r'\\\n', ' ', content).splitlines():
+        words = line.split()
+        if not words:
+            continue
+        if words[0].upper() == "ARG" and len(words) > 1:
+            name, _, value = words[1].partition("=")
+            build_args[name] = value
+        elif words[0].upper() in ["COPY", "ADD"]:
+            # Files copied from other images are covered by their digests
+            if any(w.startswith("--from=") for w in words):
+                continue
+            # The last argument is the destination
+            paths = [w for w in words[1:] if not w.startswith("--")]
+            for path in paths[:-1]:
+                # Expand the build arguments with default values
+                sources.append(re.sub(r'\$\{?(\w+)\}?', lambda m: build_args.get(m.group(1), m.group(0)), path))
+    return sources
+
+
+def get_containerfile_cache_key(cf_outfile, dry_run):
+    """Compute a key identifying all the inputs of a container image build:
+    the rendered containerfile, the source version and images, the digests of
+    the base images and the build context files including the local RPMs.
+    Return None if a base image digest cannot be resolved."""
+    content = common.read_file(cf_outfile)
+    key = hashlib.sha256(content.encode())
+    for var in ['SOURCE_VERSION', 'SOURCE_IMAGES']:
+        key.update(f"{var}={os.environ.get(var, '')}\n".encode())
+    for imgref in parse_containerfile_images(content):
+        imgref = normalize_image_ref(imgref)
+        try:
+            digest = get_image_digest(imgref, dry_run)
+        except Exception as e:
+            # The image is built without the cache key and cannot be skipped
+            common.print_msg(f"Cannot resolve '{imgref}' digest, building without cache key: {e}")
+            return None
+        key.update(f"{imgref}@{digest}\n".encode())
+
+    files = set()
+    for source in get_containerfile_sources(content):
+        for path in glob.glob(os.path.join(IMAGEDIR, source)):
+            if os.path.isdir(path):
+                files.update(str(p) for p in pathlib.Path(path).rglob("*") if p.is_file())
+            else:
+                files.add(path)
+    for file in sorted(files):
+        relpath = os.path.relpath(file, IMAGEDIR)
+        if "/repodata/" in file:
+            # Repository metadata is regenerated from the RPMs with new timestamps
+            continue
+        # RPMs rebuilt with the same version and size differ in their header digests
+        digest = rpm_utils.get_header_digest(file) if file.endswith(".rpm") else None
+        if digest is None:
+            digest = get_file_digest(file)
+        key.update(f"{relpath}:{digest}\n".encode())
+    return key.hexdigest()
+
+
+def get_registry_labels(imgref):
+    """Return the labels of the mirror registry image, or an empty dictionary if
+    the image does not exist or cannot be read. Labels prefetched before the
+    task scheduling are used when available."""
+    if imgref in REGISTRY_LABELS:
+        return REGISTRY_LABELS[imgref] or {}
+    client = registry_client.RegistryClient(MIRROR_REGISTRY)
+    try:
+        return client.get_labels(imgref) or {}
+    except Exception as e:
+        common.print_msg(f"Failed to read '{imgref}' labels: {e}")
+        return {}
+    finally:
+        client.close()
+
+
+def prefetch_registry_labels(tasks, dry_run):
+    """Read the labels of all the mirror registry images produced by the tasks
+    in one pass over pooled connections, before the tasks are scheduled"""
+    if dry_run or FORCE_REBUILD:
+        return
+    imgrefs = [f"{MIRROR_REGISTRY}/{task.name}:latest" for task in tasks if task.produced_image()]
+    start = time.monotonic()
+    client = registry_client.RegistryClient(MIRROR_REGISTRY)
+    try:
+        REGISTRY_LABELS.update(client.get_labels_many(imgrefs))
+    finally:
+        client.close()
+    found = sum(1 for i in imgrefs if REGISTRY_LABELS.get(i) is not None)
+    common.print_msg(f"Read labels of {found}/{len(imgrefs)} registry images in {time.monotonic() - start:.2f}s")
+
+
+def get_layer_cache_stats(log_path):
+    """Return the numbers of build steps reusing cached layers and the ones
+    executed in the last build attempt written to the log file"""
+    lines = common.read_file(log_path).splitlines()
+    # The failed build attempts are followed by the output of the retries
+    starts = [i for i, line in enumerate(lines) if line.startswith("STEP 1/")]
+    if starts:
+        lines = lines[starts[-1]:]
+    # Stage base images do not produce layers
+    steps = sum(1 for line in lines if re.match(r'STEP \d+/\d+: (?!FROM )', line))
+    hits = sum(1 for line in lines if line.startswith("--> Using cache "))
+    return hits, steps - hits
+
+
 def process_containerfile(groupdir, containerfile, dry_run):
     cf_path, cf_outname, _, cf_logfile = get_process_file_names(
         groupdir, containerfile, BOOTC_IMAGE_DIR)
+    cf_targetimg = f"{MIRROR_REGISTRY}/{cf_outname}:latest"
+    cf_localimg = f"localhost/{cf_outname}:latest"
 
-    # Run template command on the input file
+    def cache_key_in_registry(cf_key):
+        # Forcing the rebuild if needed
+        if FORCE_REBUILD:
+            common.print_msg(f"Forcing rebuild of '{cf_targetimg}'")
+            return False
+        dst_key = get_registry_labels(cf_targetimg).get(CACHE_KEY_LABEL)
+        if dst_key != cf_key:
+            return False
+        common.print_msg(f"The '{cf_targetimg}' already exists with '{cf_key}' cache key, skipping")
+        return True
+
+    # The input file is rendered by render_templates before the processing
     cf_outfile = os.path.join(BOOTC_IMAGE_DIR, containerfile)
-    run_template_cmd(cf_path, cf_outfile, dry_run)
 
     common.print_msg(f"Processing {containerfile} with logs in {cf_logfile}")
     try:
         # Redirect the output to the log file
         with open(cf_logfile, 'w') as logfile:
+            # Check if the target image already exists in registry with
+            # the same cache key
+            cf_key = None
+            if not dry_run:
+                with common.junit_step(cf_path, "compute-cache-key"):
+                    cf_key = get_containerfile_cache_key(cf_outfile, dry_run)
+            if cf_key and cache_key_in_registry(cf_key):
+                # Copy the image into the local containers storage unless it is up to
+                # date, as it might be necessary for subsequent builds and bootc images
+                local_key = get_local_image_label(cf_localimg, CACHE_KEY_LABEL, dry_run)
+                if local_key != cf_key:
+                    copy_args = [
+                        "sudo", "skopeo", "copy",
+                        f"docker://{cf_targetimg}",
+                        f"containers-storage:{cf_localimg}"
+                    ]
+                    with common.junit_step(cf_path, "copy-image"):
+                        run_logged_command(copy_args, dry_run, logfile, cf_outname, attempts=3)
+                common.record_junit(cf_path, "process-container", "SKIPPED")
+                return
+
             # Run the container build command.
             # Note: The pull secret is necessary in some builds for pulling embedded
             # container images specified by SOURCE_IMAGES environment variable.
@@ -237,25 +570,161 @@ def process_containerfile(groupdir, containerfile, dry_run):
                 "--authfile", PULL_SECRET,
                 "--secret", f"id=pullsecret,src={PULL_SECRET}",
                 "-t", cf_outname, "-f", cf_outfile,
-                IMAGEDIR
             ]
-            common.retry_on_exception(3, common.run_command_in_shell, build_args, dry_run, logfile, logfile)
-            common.record_junit(cf_path, "build-container", "OK")
+            # Images without a cache key must not inherit the label of their base image
+            build_args += ["--label", f"{CACHE_KEY_LABEL}={cf_key or ''}"]
+            if LAYER_CACHE:
+                build_args += [
+                    "--layers",
+                    "--cache-from", LAYER_CACHE_REPO,
+                    "--cache-to", LAYER_CACHE_REPO
+                ]
+            build_args += [IMAGEDIR]
+            with common.junit_step(cf_path, "build-container"):
+                run_logged_command(build_args, dry_run, logfile, cf_outname, attempts=3)
+            if LAYER_CACHE and not dry_run:
+                hits, misses = get_layer_cache_stats(cf_logfile)
+                common.print_msg(f"Layer cache of {containerfile}: {hits} hit(s), {misses} miss(es)")
+                common.record_junit(cf_path, "layer-cache", "OK", properties={"hits": hits, "misses": misses})
 
             push_args = [
                 "sudo", "podman", "push",
                 cf_outname,
                 f"{MIRROR_REGISTRY}/{cf_outname}"
             ]
-            common.run_command_in_shell(push_args, dry_run, logfile, logfile)
-            common.record_junit(cf_path, "push-container", "OK")
+            with common.junit_step(cf_path, "push-container"):
+                run_logged_command(push_args, dry_run, logfile, cf_outname)
     except Exception:
         common.record_junit(cf_path, "process-container", "FAILED")
         # Propagate the exception to the caller
         raise
-    finally:
-        # Always display the command logs with the prefix on each line
-        common.run_command(["sed", f"s/^/{cf_outname}: /", cf_logfile], dry_run)
+
+
+class PullCoordinator:
+    """Pull each image once per run, across the threads of the parent process
+    and the task worker processes. The first requester pulls the image holding
+    the lock of the image state file, concurrent requesters wait for the lock
+    and later requesters return the result recorded in the file. Failed pulls
+    are not attempted again, the requesters fail with the recorded error."""
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+
+    def close(self):
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+
+    def pull(self, imgref, dry_run, logfile=None, prefix=None):
+        os.makedirs(self.state_dir, exist_ok=True)
+        state_file = os.path.join(self.state_dir, hashlib.sha256(imgref.encode()).hexdigest())
+        with open(state_file, 'a+') as f:
+            # The lock is held by the requester pulling the image
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            state = json.loads(f.read() or "{}")
+            if state.get("status") == "OK":
+                return imgref
+            if state.get("status") == "FAILED":
+                raise Exception(f"Failed to pull '{imgref}' image earlier in the run: {state['error']}")
+
+            pull_args = [
+                "sudo", "podman", "pull",
+                "--authfile", PULL_SECRET, imgref
+            ]
+            try:
+                if logfile:
+                    run_logged_command(pull_args, dry_run, logfile, prefix, attempts=3)
+                else:
+                    common.retry_on_exception(3, common.run_command_in_shell, pull_args, dry_run)
+            except Exception as e:
+                f.write(json.dumps({"status": "FAILED", "error": str(e)}))
+                raise
+            f.write(json.dumps({"status": "OK"}))
+        return imgref
+
+    def pull_all(self, imgrefs, dry_run):
+        """Pull the distinct images in parallel. Failures are only reported, as
+        the tasks using the images record the errors."""
+        def pull(imgref):
+            try:
+                self.pull(imgref, dry_run)
+            except Exception as e:
+                common.print_msg(f"Failed to pull '{imgref}' image: {e}")
+
+        imgrefs = list(dict.fromkeys(imgrefs))
+        if not imgrefs:
+            return
+        common.print_msg(f"Pulling {len(imgrefs)} image(s) in parallel: {imgrefs}")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(imgrefs)) as executor:
+            list(executor.map(pull, imgrefs))
+
+
+def pull_task_images(tasks, dry_run):
+    """Pull the images required by the bootc image tasks before scheduling them,
+    so that the worker processes find them pulled"""
+    imgrefs = []
+    for task in tasks:
+        if task.func != process_image_bootc:
+            continue
+        # The images are necessary for checking if existing ISO images are up to date
+        imgrefs.append(BIB_IMAGE)
+        imgrefs += [i for i in task.referenced_images() if not i.startswith("localhost/")]
+    PULL_COORDINATOR.pull_all(imgrefs, dry_run)
+
+
+def copy_file_link(src, dst):
+    """Copy the file as a reflink if the file system supports it, or a hard link
+    otherwise, falling back to a regular copy. Return the method used."""
+    tmp_dst = f"{dst}.tmp.{os.getpid()}"
+    try:
+        with open(src, 'rb') as fsrc, open(tmp_dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        method = "reflink"
+    except OSError:
+        common.delete_file(tmp_dst)
+        try:
+            os.link(src, tmp_dst)
+            method = "hardlink"
+        except OSError:
+            shutil.copyfile(src, tmp_dst)
+            method = "copy"
+    os.replace(tmp_dst, dst)
+    return method
+
+
+def get_iso_key(src_digest, bib_digest):
+    """Return the key of the ISO image built from the source and builder images"""
+    return hashlib.sha256(f"{src_digest}\n{bib_digest}".encode()).hexdigest()
+
+
+def get_iso_manifest(iso_path):
+    """Return the sidecar manifest of the ISO image, or None if the ISO image
+    or its manifest do not exist"""
+    manifest_path = f"{iso_path}.json"
+    if not os.path.exists(iso_path) or not os.path.exists(manifest_path):
+        return None
+    try:
+        return json.loads(common.read_file(manifest_path))
+    except ValueError:
+        return None
+
+
+def store_iso(iso_path, manifest):
+    """Write the sidecar manifest of the ISO image and link the image into the
+    store under its digest key, removing older store entries of the same image"""
+    common.write_file_atomic(f"{iso_path}.json", json.dumps(manifest, indent=2))
+    os.makedirs(ISO_STORE_DIR, exist_ok=True)
+    store_iso_path = os.path.join(ISO_STORE_DIR, f"{manifest['key']}.iso")
+    for path in glob.glob(os.path.join(ISO_STORE_DIR, "*.iso.json")):
+        entry = json.loads(common.read_file(path))
+        if entry.get("iso") == manifest["iso"] and entry.get("key") != manifest["key"]:
+            common.delete_file(path.removesuffix(".json"))
+            common.delete_file(path)
+    if not os.path.exists(store_iso_path):
+        # Hard links do not use additional space and the ISO images are never modified
+        try:
+            os.link(iso_path, store_iso_path)
+        except OSError:
+            copy_file_link(iso_path, store_iso_path)
+    common.write_file_atomic(f"{store_iso_path}.json", json.dumps(manifest, indent=2))
 
 
 def process_image_bootc(groupdir, bootcfile, dry_run):
@@ -263,27 +732,33 @@ def process_image_bootc(groupdir, bootcfile, dry_run):
         groupdir, bootcfile, BOOTC_ISO_DIR)
     bf_targetiso = os.path.join(VM_DISK_BASEDIR, f"{bf_outname}.iso")
 
-    def should_skip(file):
+    def reuse_iso(manifest):
         # Forcing the rebuild if needed
         if FORCE_REBUILD:
-            common.print_msg(f"Forcing rebuild of '{file}'")
+            common.print_msg(f"Forcing rebuild of '{bf_targetiso}'")
             return False
-        if not os.path.exists(file):
+        # Skip the ISO image built from the same source and builder images
+        current = get_iso_manifest(bf_targetiso)
+        if current and current.get("key") == manifest["key"]:
+            common.print_msg(f"The '{bf_targetiso}' is up to date, skipping")
+            return True
+        # Reuse the ISO image built from the same images under another name
+        store_iso_path = os.path.join(ISO_STORE_DIR, f"{manifest['key']}.iso")
+        if not get_iso_manifest(store_iso_path):
+            if current:
+                common.print_msg(f"The '{bf_targetiso}' source or builder image digests changed, rebuilding")
             return False
-        common.print_msg(f"The '{file}' already exists, skipping")
+        with common.junit_step(bf_path, "reuse-bootc-image"):
+            method = copy_file_link(store_iso_path, bf_targetiso)
+            store_iso(bf_targetiso, manifest)
+        common.print_msg(f"The '{bf_targetiso}' was reused from '{store_iso_path}' ({method}), skipping")
         return True
 
-    # Check if the target artifact exists
-    if should_skip(bf_targetiso):
-        common.record_junit(bf_path, "process-bootc-image", "SKIPPED")
-        return
-
     # Create the output directories
     os.makedirs(bf_outdir, exist_ok=True)
     os.makedirs(VM_DISK_BASEDIR, exist_ok=True)
-    # Run template command on the input file
+    # The input file is rendered by render_templates before the processing
     bf_outfile = os.path.join(BOOTC_IMAGE_DIR, bootcfile)
-    run_template_cmd(bf_path, bf_outfile, dry_run)
 
     common.print_msg(f"Processing {bootcfile} with logs in {bf_logfile}")
     try:
@@ -291,31 +766,42 @@ def process_image_bootc(groupdir, bootcfile, dry_run):
         with open(bf_logfile, 'w') as logfile:
             # Download the bootc image builder itself in case
             # it requires authorization for accessing the image
-            pull_args = [
-                "sudo", "podman", "pull",
-                "--authfile", PULL_SECRET, BIB_IMAGE
-            ]
-            common.retry_on_exception(3, common.run_command_in_shell, pull_args, dry_run, logfile, logfile)
-            common.record_junit(bf_path, "pull-bootc-bib", "OK")
+            with common.junit_step(bf_path, "pull-bootc-bib"):
+                PULL_COORDINATOR.pull(BIB_IMAGE, dry_run, logfile, bf_outname)
 
             # Read the image reference
             bf_imgref = common.read_file(bf_outfile).strip()
 
             # If not already local, download the image to be used by bootc image builder
             if not bf_imgref.startswith('localhost/'):
-                pull_args = [
-                    "sudo", "podman", "pull",
-                    "--authfile", PULL_SECRET, bf_imgref
-                ]
-                common.retry_on_exception(3, common.run_command_in_shell, pull_args, dry_run, logfile, logfile)
-                common.record_junit(bf_path, "pull-bootc-image", "OK")
+                with common.junit_step(bf_path, "pull-bootc-image"):
+                    PULL_COORDINATOR.pull(bf_imgref, dry_run, logfile, bf_outname)
+
+            # Check if the target artifact is up to date with the image digests
+            bf_manifest = None
+            if not dry_run:
+                # The keys must match between hosts sharing the ISO images in the build cache
+                src_digest = get_image_key(bf_imgref, dry_run)
+                bib_digest = get_image_key(BIB_IMAGE, dry_run)
+                bf_manifest = {
+                    "iso": f"{bf_outname}.iso",
+                    "key": get_iso_key(src_digest, bib_digest),
+                    "source_image": bf_imgref,
+                    "source_digest": src_digest,
+                    "bib_image": BIB_IMAGE,
+                    "bib_digest": bib_digest
+                }
+                if reuse_iso(bf_manifest):
+                    common.record_junit(bf_path, "process-bootc-image", "SKIPPED")
+                    return
 
             # The podman command with security elevation and
             # mount of output / container storage
             build_args = [
                 "sudo", "podman", "run",
                 "--rm", "-i", "--privileged",
-                "--pull=newer",
+                # The image has just been pulled by the coordinator
+                "--pull=never",
                 "--security-opt", "label=type:unconfined_t",
                 "-v", f"{bf_outdir}:/output",
                 "-v", "/var/lib/containers/storage:/var/lib/containers/storage"
@@ -327,15 +813,12 @@ def process_image_bootc(groupdir, bootcfile, dry_run):
                 "--local",
                 bf_imgref
             ]
-            common.retry_on_exception(3, common.run_command_in_shell, build_args, dry_run, logfile, logfile)
-            common.record_junit(bf_path, "build-bootc-image", "OK")
+            with common.junit_step(bf_path, "build-bootc-image"):
+                run_logged_command(build_args, dry_run, logfile, bf_outname, attempts=3)
     except Exception:
         common.record_junit(bf_path, "process-bootc-image", "FAILED")
         # Propagate the exception to the caller
         raise
-    finally:
-        # Always display the command logs with the prefix on each line
-        common.run_command(["sed", f"s/^/{bf_outname}: /", bf_logfile], dry_run)
 
     # Fix the directory ownership and move the artifact
     if not dry_run:
@@ -343,6 +826,19 @@ def process_image_bootc(groupdir, bootcfile, dry_run):
             ["sudo", "chown", "-R", f"{getpass.getuser()}.", bf_outdir],
             dry_run)
         os.rename(f"{bf_outdir}/bootiso/install.iso", bf_targetiso)
+        store_iso(bf_targetiso, bf_manifest)
+
+
+def get_ostree_rev(ce_imgref, dry_run):
+    src_ref_cmd = [
+        "ostree", "rev-parse",
+        "--repo", os.path.join(IMAGEDIR, "repo"),
+        ce_imgref
+    ]
+    src_ref = common.run_command_in_shell(src_ref_cmd, dry_run)
+    if not src_ref:
+        raise Exception(f"Failed to find ostree revision with '{ce_imgref}' reference")
+    return src_ref
 
 
 def process_container_encapsulate(groupdir, containerfile, dry_run):
@@ -358,34 +854,17 @@ def process_container_encapsulate(groupdir, containerfile, dry_run):
             return False
 
         # Read the commit revision from the ostree repository (must succeed)
-        src_ref_cmd = [
-            "ostree", "rev-parse",
-            "--repo", os.path.join(IMAGEDIR, "repo"),
-            ce_imgref
-        ]
-        src_ref = common.run_command_in_shell(src_ref_cmd, dry_run)
-        if not src_ref:
-            raise Exception(f"Failed to find ostree revision with '{ce_imgref}' reference")
+        src_ref = get_ostree_rev(ce_imgref, dry_run)
 
-        # Read the commit revision from the registry (may fail, no error output)
-        try:
-            dst_ref_cmd = [
-                "skopeo", "inspect",
-                f"docker://{ce_targetimg}",
-                "2>/dev/null", "|",
-                "jq", "-r", "'.Labels[\"ostree.commit\"]'"
-            ]
-            dst_ref = common.run_command_in_shell(dst_ref_cmd, dry_run)
-            if src_ref == dst_ref:
-                common.print_msg(f"The '{ce_targetimg}' already exists, skipping")
-                return True
-        except Exception:
-            None
+        # Read the commit revision from the registry (may be missing)
+        dst_ref = get_registry_labels(ce_targetimg).get("ostree.commit")
+        if src_ref == dst_ref:
+            common.print_msg(f"The '{ce_targetimg}' already exists, skipping")
+            return True
         return False
 
-    # Run template command on the input file
+    # The input file is rendered by render_templates before the processing
     ce_outfile = os.path.join(BOOTC_IMAGE_DIR, containerfile)
-    run_template_cmd(ce_path, ce_outfile, dry_run)
 
     common.print_msg(f"Processing {containerfile} with logs in {ce_logfile}")
     try:
@@ -396,6 +875,17 @@ def process_container_encapsulate(groupdir, containerfile, dry_run):
             # Check if the target artifact already exists in registry with
             # the same ostree commit
             if ostree_rev_in_registry(ce_imgref):
+                # Copy the image into the local containers storage unless it is up to
+                # date, as it might be necessary for subsequent builds and bootc images
+                dst_ref = get_registry_labels(ce_targetimg).get("ostree.commit")
+                if get_local_image_label(ce_localimg, "ostree.commit", dry_run) != dst_ref:
+                    copy_args = [
+                        "sudo", "skopeo", "copy",
+                        f"docker://{ce_targetimg}",
+                        f"containers-storage:{ce_localimg}"
+                    ]
+                    with common.junit_step(ce_path, "copy-image"):
+                        run_logged_command(copy_args, dry_run, logfile, ce_outname, attempts=3)
                 common.record_junit(ce_path, "process-container-encapsulate", "SKIPPED")
                 return
 
@@ -407,8 +897,8 @@ def process_container_encapsulate(groupdir, containerfile, dry_run):
                 ce_imgref,
                 f"registry:{ce_targetimg}"
             ]
-            common.retry_on_exception(3, common.run_command_in_shell, build_args, dry_run, logfile, logfile)
-            common.record_junit(ce_path, "build-container", "OK")
+            with common.junit_step(ce_path, "build-container"):
+                run_logged_command(build_args, dry_run, logfile, ce_outname, attempts=3)
 
             # Copy the image into the local containers storage as it might be
             # necessary for subsequent builds that depend on this container image
@@ -417,72 +907,679 @@ def process_container_encapsulate(groupdir, containerfile, dry_run):
                 f"docker://{ce_targetimg}",
                 f"containers-storage:{ce_localimg}"
             ]
-            common.retry_on_exception(3, common.run_command_in_shell, copy_args, dry_run, logfile, logfile)
-            common.record_junit(ce_path, "copy-image", "OK")
+            with common.junit_step(ce_path, "copy-image"):
+                run_logged_command(copy_args, dry_run, logfile, ce_outname, attempts=3)
     except Exception:
         common.record_junit(ce_path, "process-container-encapsulate", "FAILED")
         # Propagate the exception to the caller
         raise
-    finally:
-        # Always display the command logs with the prefix on each line
-        common.run_command(["sed", f"s/^/{ce_outname}: /", ce_logfile], dry_run)
 
 
-def process_group(groupdir, build_type, dry_run=False):
-    futures = []
-    try:
-        # Open the junit file
-        common.start_junit(groupdir)
-        # Process all the template files in the current group directory
-        # before starting the parallel processing
-        for ifile in os.listdir(groupdir):
-            if not ifile.endswith(".template"):
+class BuildTask:
+    """A file of a group directory to be processed by one of the process_* functions"""
+    def __init__(self, groupdir, file, kind, func, order):
+        self.groupdir = groupdir
+        self.file = file
+        self.kind = kind
+        self.func = func
+        self.order = order
+        self.name = os.path.splitext(file)[0]
+        # Names of the tasks which must complete before this one starts
+        self.deps = set()
+
+    def __repr__(self):
+        return f"{common.basename(self.groupdir)}/{self.file}"
+
+    def produced_image(self):
+        """Return the local image produced by the task, if any"""
+        if self.func == process_image_bootc:
+            return None
+        return f"localhost/{self.name}:latest"
+
+    def referenced_images(self):
+        """Return the images referenced by the rendered task file"""
+        path = os.path.join(BOOTC_IMAGE_DIR, self.file)
+        if not os.path.exists(path):
+            # Rendered files do not exist in dry run mode
+            path = os.path.join(self.groupdir, self.file)
+        content = common.read_file(path)
+        if self.func == process_containerfile:
+            return [normalize_image_ref(i) for i in parse_containerfile_images(content)]
+        if self.func == process_image_bootc:
+            return [normalize_image_ref(content.strip())]
+        # The encapsulated images are built from the ostree repository
+        return []
+
+
+def normalize_image_ref(imgref):
+    # Local images are referenced with or without the default tag
+    if imgref.startswith("localhost/") and ":" not in imgref.split("/")[-1] and "@" not in imgref:
+        return f"{imgref}:latest"
+    return imgref
+
+
+def parse_containerfile_images(content):
+    """Return the images referenced in FROM instructions and --from options"""
+    images = []
+    stages = set()
+    # Join the continuation lines before parsing the instructions
+    for line in re.sub(r'\\\n', ' ', content).splitlines():
+        words = line.split()
+        if not words:
+            continue
+        if words[0].upper() == "FROM":
+            args = [w for w in words[1:] if not w.startswith("--")]
+            if args and args[0] not in stages:
+                images.append(args[0])
+            # Remember the stage names to skip references to them
+            if len(args) >= 3 and args[1].upper() == "AS":
+                stages.add(args[2])
+        elif words[0].upper() in ["COPY", "RUN"]:
+            for w in words[1:]:
+                if w.startswith("--from="):
+                    ref = w.removeprefix("--from=")
+                    if ref not in stages:
+                        images.append(ref)
+    return images
+
+
+def get_group_tasks(groupdir, group_order, build_type):
+    tasks = []
+    task_funcs = {
+        ".containerfile": ("containerfile", process_containerfile),
+        ".image-bootc": ("image-bootc", process_image_bootc),
+        ".container-encapsulate": ("container-encapsulate", process_container_encapsulate),
+    }
+    # Scan group directory contents sorted by length and then alphabetically
+    for file in sorted(os.listdir(groupdir), key=lambda i: (len(i), i)):
+        ext = os.path.splitext(file)[1]
+        if ext in task_funcs:
+            type, func = task_funcs[ext]
+            if build_type and build_type != type:
+                common.print_msg(f"Skipping '{file}' due to '{build_type}' filter")
                 continue
-            # Create full path for output and input file names
-            ofile = os.path.join(BOOTC_IMAGE_DIR, ifile)
-            ifile = os.path.join(groupdir, ifile)
-            # Strip the .template suffix from the output file name
-            ofile = ofile.removesuffix(".template")
-            run_template_cmd(ifile, ofile, dry_run)
-
-        # Parallel processing loop
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            # Scan group directory contents sorted by length and then alphabetically
-            for file in sorted(os.listdir(groupdir), key=lambda i: (len(i), i)):
-                if file.endswith(".containerfile"):
-                    if build_type and build_type != "containerfile":
-                        common.print_msg(f"Skipping '{file}' due to '{build_type}' filter")
-                        continue
-                    futures.append(executor.submit(process_containerfile, groupdir, file, dry_run))
-                elif file.endswith(".image-bootc"):
-                    if build_type and build_type != "image-bootc":
-                        common.print_msg(f"Skipping '{file}' due to '{build_type}' filter")
-                        continue
-                    futures.append(executor.submit(process_image_bootc, groupdir, file, dry_run))
-                elif file.endswith(".container-encapsulate"):
-                    if build_type and build_type != "container-encapsulate":
-                        common.print_msg(f"Skipping '{file}' due to '{build_type}' filter")
+            tasks.append(BuildTask(groupdir, file, type, func, (group_order, len(file), file)))
+        elif ext != ".template":
+            common.print_msg(f"Skipping unknown file {file}")
+    return tasks
+
+
+def get_group_templates(groupdir, tasks):
+    # Return the template and task files in the group directory
+    # to be rendered before starting the parallel processing
+    files = [f for f in os.listdir(groupdir) if f.endswith(".template")]
+    files += [t.file for t in tasks]
+    templates = []
+    for ifile in files:
+        # Create full path for output and input file names
+        ofile = os.path.join(BOOTC_IMAGE_DIR, ifile)
+        ifile = os.path.join(groupdir, ifile)
+        # Strip the .template suffix from the output file name
+        ofile = ofile.removesuffix(".template")
+        templates.append((ifile, ofile))
+    return templates
+
+
+def set_task_dependencies(tasks):
+    """Make each task depend on the tasks producing local images it references"""
+    producers = {}
+    for task in tasks:
+        image = task.produced_image()
+        if image:
+            if image in producers:
+                raise Exception(f"The '{image}' image is produced by both {producers[image]} and {task}")
+            producers[image] = task
+    for task in tasks:
+        for image in task.referenced_images():
+            # Images not produced in this run must already exist
+            if image in producers and producers[image] != task:
+                task.deps.add(producers[image].name)
+        if task.deps:
+            common.print_msg(f"Task {task} depends on {sorted(task.deps)}")
+
+
+class ResourceBudget:
+    """Admit tasks according to their build type resources, the per type limits
+    and the CPUs and memory of the host, keeping track of the utilization"""
+    def __init__(self, resources):
+        self.resources = resources
+        self.cpus, self.memory = common.get_host_resources()
+        self.used_cpus = 0
+        self.used_memory = 0
+        self.running = {kind: 0 for kind in resources}
+        # Time integrals and peaks of the used resources
+        self.start = self.last = time.monotonic()
+        self.cpu_seconds = 0
+        self.memory_seconds = 0
+        self.peak_cpus = 0
+        self.peak_memory = 0
+
+    def blocked_by(self, task):
+        """Return the reason why the task cannot start now, or None if it can"""
+        res = self.resources[task.kind]
+        if res["limit"] and self.running[task.kind] >= res["limit"]:
+            return f"{self.running[task.kind]} running '{task.kind}' task(s)"
+        # Tasks exceeding the budget on their own still run when nothing else is running
+        if not any(self.running.values()):
+            return None
+        if self.used_cpus + res["cpus"] > self.cpus:
+            return f"{self.used_cpus}/{self.cpus} CPUs in use"
+        if self.used_memory + res["memory"] > self.memory:
+            return f"{self.used_memory}/{self.memory} GiB memory in use"
+        return None
+
+    def acquire(self, task):
+        self._account()
+        res = self.resources[task.kind]
+        self.running[task.kind] += 1
+        self.used_cpus += res["cpus"]
+        self.used_memory += res["memory"]
+        self.peak_cpus = max(self.peak_cpus, self.used_cpus)
+        self.peak_memory = max(self.peak_memory, self.used_memory)
+
+    def release(self, task):
+        self._account()
+        res = self.resources[task.kind]
+        self.running[task.kind] -= 1
+        self.used_cpus -= res["cpus"]
+        self.used_memory -= res["memory"]
+
+    def usage(self):
+        running = ", ".join(f"{kind}={count}" for kind, count in self.running.items() if count)
+        return f"CPUs {self.used_cpus}/{self.cpus}, memory {self.used_memory}/{self.memory} GiB, running [{running}]"
+
+    def summary(self):
+        self._account()
+        elapsed = max(self.last - self.start, 1e-9)
+        avg_cpus = self.cpu_seconds / elapsed
+        avg_memory = self.memory_seconds / elapsed
+        return (f"average CPUs {avg_cpus:.1f}/{self.cpus} (peak {self.peak_cpus}), "
+                f"average memory {avg_memory:.1f}/{self.memory} GiB (peak {self.peak_memory}) "
+                f"in {elapsed:.0f}s")
+
+    def _account(self):
+        now = time.monotonic()
+        self.cpu_seconds += self.used_cpus * (now - self.last)
+        self.memory_seconds += self.used_memory * (now - self.last)
+        self.last = now
+
+
+def init_task_worker(queue, pull_coordinator):
+    """Process pool initializer of the task workers"""
+    common.init_junit_worker(queue)
+    global PULL_COORDINATOR
+    PULL_COORDINATOR = pull_coordinator
+
+
+def run_tasks(tasks, dry_run):
+    """Run each task in a shared worker pool as soon as all its dependencies
+    complete and the resources it requires are available"""
+    pending = {task.name: task for task in tasks}
+    running = {}
+    completed = set()
+    # Task paths are the objects of the trace events
+    paths = {task.name: os.path.join(task.groupdir, task.file) for task in tasks}
+    started = {}
+    budget = ResourceBudget(TASK_RESOURCES)
+    common.print_msg(f"Scheduling {len(tasks)} task(s) with {budget.cpus} CPUs and {budget.memory} GiB memory budget")
+    # Time when the tasks became ready, and the reasons they have been queued for
+    ready_since = {}
+    queued_for = {}
+    queue_seconds = 0
+    # Workers send their results to the parent process, which is the only junit writer.
+    # The number of running tasks is limited by the budget, not the pool size.
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max(1, len(tasks)),
+            initializer=init_task_worker,
+            initargs=(common.get_junit_queue(), PULL_COORDINATOR)) as executor:
+        try:
+            while pending or running:
+                ready = [t for t in pending.values() if t.deps <= completed]
+                for task in sorted(ready, key=lambda t: t.order):
+                    ready_since.setdefault(task.name, time.monotonic())
+                    reason = budget.blocked_by(task)
+                    if reason:
+                        # Only log the queueing reason when it changes
+                        if queued_for.get(task.name) != reason:
+                            common.print_msg(f"Task {task} queued: {reason}")
+                            queued_for[task.name] = reason
                         continue
-                    futures.append(executor.submit(process_container_encapsulate, groupdir, file, dry_run))
-                elif not file.endswith(".template"):
-                    common.print_msg(f"Skipping unknown file {file}")
-
-        # Wait for the parallel tasks to complete
-        for f in concurrent.futures.as_completed(futures):
-            common.print_msg(f"Task {f} completed")
-            # Result function generates an exception depending on the task state
-            f.result()
+                    budget.acquire(task)
+                    started[task.name] = time.monotonic()
+                    waited = started[task.name] - ready_since[task.name]
+                    queue_seconds += waited
+                    common.record_trace(paths[task.name], "queue-wait", ready_since[task.name], started[task.name])
+                    common.print_msg(f"Task {task} scheduled after {waited:.0f}s in queue: {budget.usage()}")
+                    future = executor.submit(task.func, task.groupdir, task.file, dry_run)
+                    running[future] = task
+                    del pending[task.name]
+                if not running:
+                    raise Exception(f"Unresolvable dependencies of tasks: {sorted(pending)}")
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                # Handle the failures first, so that no new task is scheduled after them
+                for f in sorted(done, key=lambda f: f.exception() is None):
+                    task = running.pop(f)
+                    budget.release(task)
+                    status = "FAILED" if f.exception() else "OK"
+                    common.record_trace(paths[task.name], "task", started[task.name], time.monotonic(), status,
+                                        {"kind": task.kind, "deps": sorted(paths[d] for d in task.deps)})
+                    # Result function generates an exception depending on the task state
+                    f.result()
+                    common.print_msg(f"Task {task} completed: {budget.usage()}")
+                    completed.add(task.name)
+        except Exception:
+            # Fail fast: cancel the tasks which did not start and stop the running
+            # ones, including the ISO builds of other groups, by terminating their
+            # commands. The workers are not signalled, so that they record the
+            # failures of their tasks and exit without losing junit or trace records.
+            executor.shutdown(wait=False, cancel_futures=True)
+            for f, task in running.items():
+                if f.cancel():
+                    common.print_msg(f"Task {task} cancelled")
+            active = [f for f in running if not f.cancelled()]
+            # The commands retried by the tasks are terminated again
+            while not all(f.done() for f in active):
+                pids = []
+                for worker in multiprocessing.active_children():
+                    try:
+                        pids += common.find_subprocesses(worker.pid)
+                    except psutil.NoSuchProcess:
+                        pass
+                if pids:
+                    common.terminate_processes(pids)
+                concurrent.futures.wait(active, timeout=1)
+            for f in active:
+                task = running[f]
+                status = "CANCELLED" if f.exception() else "OK"
+                common.print_msg(f"Task {task} {'terminated' if f.exception() else 'completed'}")
+                common.record_trace(paths[task.name], "task", started[task.name], time.monotonic(), status,
+                                    {"kind": task.kind, "deps": sorted(paths[d] for d in task.deps)})
+            executor.shutdown(wait=True, cancel_futures=True)
+            # Propagate the exception to the caller
+            raise
+    common.print_msg(f"Resource utilization: {budget.summary()}, "
+                     f"{len(queued_for)} task(s) queued for {queue_seconds:.0f}s in total")
+
+
+def get_trace_path(groupdirs):
+    # The trace of a layer is stored next to the build logs of its groups
+    if len(groupdirs) == 1:
+        trace_dir = common.basename(groupdirs[0])
+    else:
+        trace_dir = common.basename(os.path.dirname(groupdirs[0]))
+    return os.path.join(IMAGEDIR, "build-logs", trace_dir, "trace.jsonl")
+
+
+def get_tasks_and_templates(groupdirs, build_type):
+    tasks = []
+    templates = []
+    for order, groupdir in enumerate(groupdirs):
+        group_tasks = get_group_tasks(groupdir, order, build_type)
+        templates += get_group_templates(groupdir, group_tasks)
+        tasks += group_tasks
+    return tasks, templates
+
+
+def load_task_durations():
+    if not os.path.exists(TASK_DURATIONS_FILE):
+        return {}
+    return json.loads(common.read_file(TASK_DURATIONS_FILE))
+
+
+def update_task_durations(trace_path):
+    """Remember the durations of the traced tasks which performed their builds"""
+    if not os.path.exists(trace_path):
+        return
+    events = [json.loads(line) for line in common.read_file(trace_path).splitlines() if line]
+    built = {e["object"] for e in events if e["phase"] in BUILD_PHASES and e["status"] == "OK"}
+    durations = load_task_durations()
+    for e in events:
+        if e["phase"] == "task" and e["status"] == "OK" and e["object"] in built:
+            durations[e["object"]] = {"kind": e["args"]["kind"], "seconds": e["end"] - e["start"]}
+    common.write_file_atomic(TASK_DURATIONS_FILE, json.dumps(durations, indent=2))
+
+
+def get_group_fingerprint(groupdir, tasks, build_type):
+    """Compute a fingerprint of the group inputs: the group directory and package
+    source templates contents, the environment variables they reference, the
+    RPM versions and repositories, the ostree commits and the upstream base and
+    builder image digests the images are built from. Return None if an upstream
+    image digest cannot be resolved, as the group inputs are then unknown."""
+    fingerprint = hashlib.sha256(f"build_type={build_type}\n".encode())
+    env_vars = {"SOURCE_VERSION", "SOURCE_VERSION_BASE", "SOURCE_IMAGES"}
+    for dir in [groupdir, f"{SCRIPTDIR}/../package-sources-bootc"]:
+        for file in sorted(os.listdir(dir)):
+            path = os.path.join(dir, file)
+            if not os.path.isfile(path):
+                continue
+            content = common.read_file(path)
+            fingerprint.update(f"{file}\n{hashlib.sha256(content.encode()).hexdigest()}\n".encode())
+            env_vars.update(m.group(1) or m.group(2) for m in TEMPLATE_ENV_REFERENCE.finditer(content))
+    for var in sorted(env_vars):
+        fingerprint.update(f"{var}={os.environ.get(var)}\n".encode())
+    # The repository metadata changes whenever the RPMs are rebuilt
+    for repo in [LOCAL_REPO, BASE_REPO, NEXT_REPO]:
+        repomd = os.path.join(repo, "repodata", "repomd.xml")
+        digest = get_file_digest(repomd) if os.path.exists(repomd) else None
+        fingerprint.update(f"{repo}={digest}\n".encode())
+    # The ostree references of the encapsulated images move to new commits
+    for task in tasks:
+        if task.func != process_container_encapsulate:
+            continue
+        try:
+            ostree_ref = common.read_file(os.path.join(BOOTC_IMAGE_DIR, task.file)).strip()
+            rev = get_ostree_rev(ostree_ref, False)
+        except Exception:
+            rev = None
+        fingerprint.update(f"{task.file}={rev}\n".encode())
+    # The upstream images are updated under the same tags, while the local
+    # images are covered by the fingerprints of the groups building them
+    imgrefs = set()
+    for task in tasks:
+        imgrefs.update(i for i in task.referenced_images() if not i.startswith("localhost/"))
+        if task.func == process_image_bootc:
+            imgrefs.add(BIB_IMAGE)
+    for imgref in sorted(imgrefs):
+        digest = get_upstream_digest(imgref)
+        if digest is None:
+            return None
+        fingerprint.update(f"{imgref}@{digest}\n".encode())
+    return fingerprint.hexdigest()
+
+
+def get_upstream_digest(imgref):
+    """Return the registry digest of the upstream image, resolved once per run,
+    or None if it cannot be resolved"""
+    if imgref not in UPSTREAM_DIGESTS:
+        try:
+            UPSTREAM_DIGESTS[imgref] = get_image_digest(imgref, False)
+        except Exception as e:
+            common.print_msg(f"Cannot resolve '{imgref}' digest for the group fingerprint: {e}")
+            UPSTREAM_DIGESTS[imgref] = None
+    return UPSTREAM_DIGESTS[imgref]
+
+
+def load_group_fingerprints():
+    if not os.path.exists(GROUP_FINGERPRINTS_FILE):
+        return {}
+    return json.loads(common.read_file(GROUP_FINGERPRINTS_FILE))
+
+
+def save_group_fingerprints(fingerprints):
+    """Remember the fingerprints of the groups processed successfully"""
+    saved = load_group_fingerprints()
+    saved.update(fingerprints)
+    common.create_dir(os.path.dirname(GROUP_FINGERPRINTS_FILE))
+    common.write_file_atomic(GROUP_FINGERPRINTS_FILE, json.dumps(saved, indent=2))
+
+
+def registry_image_exists(imgref):
+    """Return whether the mirror registry image exists, using the labels
+    prefetched before the task scheduling when available"""
+    if imgref in REGISTRY_LABELS:
+        return REGISTRY_LABELS[imgref] is not None
+    client = registry_client.RegistryClient(MIRROR_REGISTRY)
+    try:
+        return client.get_labels(imgref) is not None
+    except Exception as e:
+        common.print_msg(f"Failed to read '{imgref}' labels: {e}")
+        return False
+    finally:
+        client.close()
+
+
+def local_image_exists(imgref):
+    """Return whether the image exists in the local containers storage"""
+    try:
+        common.run_command_in_shell(["sudo", "podman", "image", "exists", imgref])
+        return True
     except Exception:
-        # Cancel all pending tasks
-        for f in futures:
-            if not f.done():
-                f.cancel()
-                common.print_msg(f"Task {f} cancelled")
-        # Propagate the exception to the caller
-        raise
+        return False
+
+
+def get_missing_outputs(tasks):
+    """Return the ISO images, mirror registry images and local images produced
+    by the tasks which do not exist"""
+    missing = []
+    for task in tasks:
+        if task.func == process_image_bootc:
+            output = os.path.join(VM_DISK_BASEDIR, f"{task.name}.iso")
+            if not get_iso_manifest(output):
+                missing.append(output)
+            continue
+        output = f"{MIRROR_REGISTRY}/{task.name}:latest"
+        if not registry_image_exists(output):
+            missing.append(output)
+        # The images of the other groups are built from the local images
+        if not local_image_exists(task.produced_image()):
+            missing.append(task.produced_image())
+    return missing
+
+
+def get_changed_groups(groupdirs, tasks, build_type):
+    """Return the fingerprints of the groups and the groups to be processed:
+    the groups whose fingerprints changed since their last successful
+    processing and the groups with missing outputs"""
+    group_tasks = {groupdir: [t for t in tasks if t.groupdir == groupdir] for groupdir in groupdirs}
+    fingerprints = {g: get_group_fingerprint(g, group_tasks[g], build_type) for g in groupdirs}
+    saved = load_group_fingerprints()
+    changed = set()
+    for groupdir in groupdirs:
+        if FORCE_REBUILD or fingerprints[groupdir] is None or saved.get(groupdir) != fingerprints[groupdir]:
+            changed.add(groupdir)
+            continue
+        # The outputs may have been removed or never uploaded by this host.
+        # The tasks of such groups are processed with their own skip checks.
+        missing = get_missing_outputs(group_tasks[groupdir])
+        if missing:
+            common.print_msg(f"The {common.basename(groupdir)} group inputs are unchanged, but its outputs are missing: {missing}")
+            changed.add(groupdir)
+    return fingerprints, changed
+
+
+def get_rebuilt_groups(tasks, changed):
+    """Return the changed groups and the groups with tasks depending on the
+    tasks of the groups being rebuilt"""
+    groups = {task.name: task.groupdir for task in tasks}
+    rebuilt = set(changed)
+    while True:
+        dependent = {t.groupdir for t in tasks if any(groups[d] in rebuilt for d in t.deps)}
+        if dependent <= rebuilt:
+            return rebuilt
+        rebuilt |= dependent
+
+
+def process_groups(groupdirs, build_type, dry_run=False):
+    """Process the groups using a dependency graph of their tasks instead of
+    building the groups one after another"""
+    trace_path = get_trace_path(groupdirs)
+    try:
+        # Open the junit files
+        for groupdir in groupdirs:
+            common.start_junit(groupdir)
+        common.start_trace(trace_path)
+        # Objects of the trace events of the phases preceding the task processing
+        layer_path = os.path.dirname(groupdirs[0])
+
+        tasks, templates = get_tasks_and_templates(groupdirs, build_type)
+        with common.trace_phase(os.path.join(layer_path, "prepare"), "render-templates"):
+            render_templates(templates, dry_run)
+            set_task_dependencies(tasks)
+        with common.trace_phase(os.path.join(layer_path, "prepare"), "registry-labels"):
+            prefetch_registry_labels(tasks, dry_run)
+
+        # Groups whose inputs did not change since their last successful
+        # processing and whose outputs exist are skipped, unless they depend
+        # on rebuilt groups
+        fingerprints, changed = get_changed_groups(groupdirs, tasks, build_type)
+        rebuilt = get_rebuilt_groups(tasks, changed)
+        for groupdir in groupdirs:
+            if groupdir not in rebuilt:
+                common.print_msg(f"Skipping {common.basename(groupdir)} group with unchanged inputs")
+                common.record_junit(groupdir, "process-group", "SKIPPED")
+        # The images of the skipped groups were built in earlier runs
+        tasks = [t for t in tasks if t.groupdir in rebuilt]
+        names = {t.name for t in tasks}
+        for task in tasks:
+            task.deps &= names
+
+        with common.trace_phase(os.path.join(layer_path, "prepare"), "pull-images"):
+            pull_task_images(tasks, dry_run)
+        run_tasks(tasks, dry_run)
+        if not dry_run:
+            save_group_fingerprints({g: fingerprints[g] for g in rebuilt if fingerprints[g]})
     finally:
-        # Close junit file
+        # Close junit files
         common.close_junit()
+        if not dry_run:
+            update_task_durations(trace_path)
+
+
+def get_task_order(tasks):
+    """Return the tasks sorted so that each task follows its dependencies"""
+    by_name = {task.name: task for task in tasks}
+    ordered = []
+    visited = set()
+
+    def visit(task):
+        if task.name in visited:
+            return
+        visited.add(task.name)
+        for dep in sorted(task.deps):
+            visit(by_name[dep])
+        ordered.append(task)
+
+    for task in sorted(tasks, key=lambda t: t.order):
+        visit(task)
+    return ordered
+
+
+def plan_task(task, rebuilt):
+    """Evaluate the skip conditions of the task without building anything.
+    Return whether the task is predicted to build and the reason."""
+    if FORCE_REBUILD:
+        return True, "forced rebuild"
+    outfile = os.path.join(BOOTC_IMAGE_DIR, task.file)
+    targetimg = f"{MIRROR_REGISTRY}/{task.name}:latest"
+    # Rebuilt images change the cache keys and digests of the images using them
+    rebuilt_deps = sorted(task.deps & rebuilt)
+    try:
+        if task.func == process_container_encapsulate:
+            src_ref = get_ostree_rev(common.read_file(outfile).strip(), False)
+            if get_registry_labels(targetimg).get("ostree.commit") == src_ref:
+                return False, "ostree commit in registry"
+            return True, "ostree commit not in registry"
+        if rebuilt_deps:
+            return True, f"rebuilt images {rebuilt_deps}"
+        if task.func == process_containerfile:
+            key = get_containerfile_cache_key(outfile, False)
+            if key and get_registry_labels(targetimg).get(CACHE_KEY_LABEL) == key:
+                return False, "cache key in registry"
+            return True, "cache key not in registry"
+        imgref = common.read_file(outfile).strip()
+        key = get_iso_key(get_image_key(imgref, False), get_image_key(BIB_IMAGE, False))
+        current = get_iso_manifest(os.path.join(VM_DISK_BASEDIR, f"{task.name}.iso"))
+        if current and current.get("key") == key:
+            return False, "ISO up to date"
+        if get_iso_manifest(os.path.join(ISO_STORE_DIR, f"{key}.iso")):
+            return False, "ISO reused from store"
+        return True, "ISO missing or image digests changed"
+    except Exception as e:
+        return True, f"cannot evaluate skip conditions: {e}"
+
+
+def predict_duration(task, history):
+    path = os.path.join(task.groupdir, task.file)
+    if path in history:
+        return history[path]["seconds"]
+    # Use the average duration of the tasks of the same type
+    kind = [h["seconds"] for h in history.values() if h["kind"] == task.kind]
+    if kind:
+        return sum(kind) / len(kind)
+    return DEFAULT_TASK_DURATIONS[task.kind]
+
+
+def simulate_tasks(tasks, durations, budget):
+    """Return the predicted wall clock time of running the tasks with the
+    predicted durations in the order and with the resources of the scheduler"""
+    pending = {task.name: task for task in tasks}
+    running = []
+    completed = set()
+    now = 0
+    while pending or running:
+        ready = [t for t in pending.values() if t.deps <= completed]
+        for task in sorted(ready, key=lambda t: t.order):
+            if budget.blocked_by(task):
+                continue
+            budget.acquire(task)
+            heapq.heappush(running, (now + durations[task.name], task.order, task))
+            del pending[task.name]
+        if not running:
+            raise Exception(f"Unresolvable dependencies of tasks: {sorted(pending)}")
+        now, _, task = heapq.heappop(running)
+        budget.release(task)
+        completed.add(task.name)
+    return now
+
+
+def get_longest_chains(tasks, durations, count=3):
+    """Return the chains of dependent tasks with the longest predicted durations,
+    ending at distinct tasks no other task depends on"""
+    chains = {}
+    for task in get_task_order(tasks):
+        chain, seconds = [], 0
+        for dep in task.deps:
+            if chains[dep][1] > seconds:
+                chain, seconds = chains[dep]
+        chains[task.name] = (chain + [task.name], seconds + durations[task.name])
+    deps = set().union(*(task.deps for task in tasks))
+    longest = sorted((c for name, c in chains.items() if name not in deps), key=lambda c: -c[1])
+    return [c for c in longest if c[1] > 0][:count]
+
+
+def plan_groups(groupdirs, build_type):
+    """Predict the tasks to be built and the build time of the groups
+    without building anything"""
+    tasks, templates = get_tasks_and_templates(groupdirs, build_type)
+    render_templates(templates, False)
+    set_task_dependencies(tasks)
+    prefetch_registry_labels(tasks, False)
+    history = load_task_durations()
+    _, changed = get_changed_groups(groupdirs, tasks, build_type)
+    rebuilt_groups = get_rebuilt_groups(tasks, changed)
+
+    rebuilt = set()
+    durations = {}
+    print(f"{'task':<64} {'action':<6} {'seconds':>8}  reason")
+    for task in get_task_order(tasks):
+        if task.groupdir in rebuilt_groups:
+            build, reason = plan_task(task, rebuilt)
+        else:
+            build, reason = False, "group inputs unchanged"
+        durations[task.name] = predict_duration(task, history) if build else 0
+        if build:
+            rebuilt.add(task.name)
+        print(f"{str(task):<64} {'build' if build else 'skip':<6} {durations[task.name]:>8.0f}  {reason}")
+
+    total = sum(durations.values())
+    budget = ResourceBudget(TASK_RESOURCES)
+    wall = simulate_tasks(tasks, durations, budget)
+    print(f"\nPredicted work: {len(rebuilt)}/{len(tasks)} task(s), {total / 60:.1f} minutes of task time")
+    print(f"Predicted wall clock time: {wall / 60:.1f} minutes with {budget.cpus} CPUs and {budget.memory} GiB memory budget")
+    for chain, seconds in get_longest_chains(tasks, durations):
+        print(f"Chain of {seconds / 60:.1f} minutes: {' -> '.join(chain)}")
+
+
+def set_task_resources(spec):
+    kind, _, values = spec.partition("=")
+    if kind not in TASK_RESOURCES:
+        raise Exception(f"Invalid build type '{kind}' in '{spec}' task resources")
+    try:
+        cpus, memory, limit = (int(v) for v in values.split(":"))
+    except ValueError:
+        raise Exception(f"Invalid '{spec}' task resources, expected TYPE=CPUS:MEMORY:LIMIT")
+    TASK_RESOURCES[kind] = {"cpus": cpus, "memory": memory, "limit": limit}
 
 
 def main():
@@ -490,7 +1587,16 @@ def main():
     parser = argparse.ArgumentParser(description="Build image layers using Bootc Image Builder and Podman.")
     parser.add_argument("-d", "--dry-run", action="store_true", help="Dry run: skip executing build commands.")
     parser.add_argument("-f", "--force-rebuild", action="store_true", help="Force rebuilding images that already exist.")
+    parser.add_argument("-c", "--layer-cache", action="store_true",
+                        help="Reuse and store the intermediate container build layers in the mirror registry.")
+    parser.add_argument("-p", "--plan", action="store_true",
+                        help="Evaluate the skip conditions and predict the build work and time without building anything.")
     parser.add_argument("-E", "--no-extract-images", action="store_true", help="Skip container image extraction.")
+    parser.add_argument("-t", "--log-tail", type=int, default=0,
+                        help="Only display the last LOG_TAIL lines of failed commands instead of streaming all command logs.")
+    parser.add_argument("-r", "--task-resources", action="append", default=[], metavar="TYPE=CPUS:MEMORY:LIMIT",
+                        help="Resources reserved for each task of the build type: CPUs, memory in GiB and maximum " +
+                             "number of running tasks of the type (0 for no limit). Can be specified multiple times.")
     parser.add_argument("-b", "--build-type",
                         choices=["image-bootc", "containerfile", "container-encapsulate"],
                         help="Only build images of the specified type.")
@@ -511,13 +1617,29 @@ def main():
         # Make sure the input directory exists
         if not os.path.isdir(dir2process):
             raise Exception(f"The input directory '{dir2process}' does not exist")
+        # Make sure the release info RPM payloads can be read before building anything
+        if not rpm_utils.zstd_supported() and not shutil.which("rpm2cpio"):
+            raise Exception("Reading zstd compressed RPM payloads requires the 'zstandard' Python module, "
+                            "or the 'zstd' or 'rpm2cpio' tool")
         # Make sure the local RPM repository exists
-        if not os.path.isdir(LOCAL_REPO):
+        if not os.path.isdir(LOCAL_REPO) and not args.plan:
             common.run_command([f"{SCRIPTDIR}/build_rpms.sh"], args.dry_run)
         # Initialize force rebuild option
         global FORCE_REBUILD
         if args.force_rebuild:
             FORCE_REBUILD = True
+        # Initialize the layer cache option
+        global LAYER_CACHE
+        LAYER_CACHE = args.layer_cache
+        # Initialize the console log tail option
+        global LOG_TAIL
+        LOG_TAIL = args.log_tail
+        # Initialize the image pulls shared by the tasks
+        global PULL_COORDINATOR
+        PULL_COORDINATOR = PullCoordinator(tempfile.mkdtemp(prefix="image-pulls-"))
+        # Initialize the task resources option
+        for spec in args.task_resources:
+            set_task_resources(spec)
         # Fetch gomplate if necessary
         if not os.path.exists(GOMPLATE):
             gomplate_args = [
@@ -529,34 +1651,48 @@ def main():
         # Determine versions of RPM packages
         set_rpm_version_info_vars()
         # Prepare container image lists for mirroring registries
-        common.delete_file(CONTAINER_LIST)
-        if args.no_extract_images:
+        if args.plan:
+            common.print_msg("Skipping container image extraction and mirror registry setup in plan mode")
+        elif args.no_extract_images:
+            common.delete_file(CONTAINER_LIST)
             common.print_msg("Skipping container image extraction")
         else:
-            extract_container_images(SOURCE_VERSION, LOCAL_REPO, CONTAINER_LIST, args.dry_run)
-            # The following images are specific to layers that use fake rpms built from source
-            extract_container_images(f"4.{FAKE_NEXT_MINOR_VERSION}.*", NEXT_REPO, CONTAINER_LIST, args.dry_run)
-            extract_container_images(PREVIOUS_RELEASE_VERSION, PREVIOUS_RELEASE_REPO, CONTAINER_LIST, args.dry_run)
-            extract_container_images(YMINUS2_RELEASE_VERSION, YMINUS2_RELEASE_REPO, CONTAINER_LIST, args.dry_run)
+            common.delete_file(CONTAINER_LIST)
+            extract_all_container_images([
+                (SOURCE_VERSION, LOCAL_REPO),
+                # The following images are specific to layers that use fake rpms built from source
+                (f"4.{FAKE_NEXT_MINOR_VERSION}.*", NEXT_REPO),
+                (PREVIOUS_RELEASE_VERSION, PREVIOUS_RELEASE_REPO),
+                (YMINUS2_RELEASE_VERSION, YMINUS2_RELEASE_REPO),
+            ], CONTAINER_LIST, args.dry_run)
         # Run the mirror registry
-        common.run_command([f"{SCRIPTDIR}/mirror_registry.sh"], args.dry_run)
+        if not args.plan:
+            common.run_command([f"{SCRIPTDIR}/mirror_registry.sh"], args.dry_run)
         # Process package source templates
         ipkgdir = f"{SCRIPTDIR}/../package-sources-bootc"
+        templates = []
         for ifile in os.listdir(ipkgdir):
             # Create full path for output and input file names
             ofile = os.path.join(BOOTC_IMAGE_DIR, ifile)
             ifile = os.path.join(ipkgdir, ifile)
-            run_template_cmd(ifile, ofile, args.dry_run)
+            templates.append((ifile, ofile))
+        render_templates(templates, args.dry_run)
         # Process individual group directory
         if args.group_dir:
-            process_group(args.group_dir, args.build_type, args.dry_run)
+            groupdirs = [args.group_dir]
         else:
-            # Process layer directory contents sorted by length and then alphabetically
+            # Process layer directory contents sorted by length and then alphabetically.
+            # The groups are processed together in the order of their task dependencies.
+            groupdirs = []
             for item in sorted(os.listdir(args.layer_dir), key=lambda i: (len(i), i)):
                 item_path = os.path.join(args.layer_dir, item)
                 # Check if this item is a directory
                 if os.path.isdir(item_path):
-                    process_group(item_path, args.build_type, args.dry_run)
+                    groupdirs.append(item_path)
+        if args.plan:
+            plan_groups(groupdirs, args.build_type)
+        else:
+            process_groups(groupdirs, args.build_type, args.dry_run)
         # Toggle the success flag
         success_message = True
     except Exception as e:
@@ -564,7 +1700,12 @@ def main():
         traceback.print_exc()
         sys.exit(1)
     finally:
-        cleanup_atexit(args.dry_run)
+        # Nothing is started in the plan mode, while the cleanup would stop
+        # the bootc image builder containers of other builds
+        if not args.plan:
+            cleanup_atexit(args.dry_run)
+        if PULL_COORDINATOR:
+            PULL_COORDINATOR.close()
         # Exit status message
         common.print_msg("Build " + ("OK" if success_message else "FAILED"))
 
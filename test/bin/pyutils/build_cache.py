@@ -0,0 +1,607 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import configparser
+import contextlib
+import datetime
+import glob
+import hashlib
+import hmac
+import http.client
+import json
+import os
+import queue
+import re
+import shutil
+import sys
+import time
+import urllib.parse
+import uuid
+import xml.etree.ElementTree as ET
+
+import common
+
+# Object listing the files of a cache entry with their sizes and checksums.
+# It is uploaded after all the files, so its presence marks a complete entry.
+MANIFEST_NAME = "manifest.json"
+# Size of the parts of the multipart uploads and ranged downloads. The S3
+# multipart uploads require parts of at least 5 MiB, except the last one.
+PART_SIZE = 32 * 1024 * 1024
+MIN_PART_SIZE = 5 * 1024 * 1024
+READ_CHUNK_SIZE = 1024 * 1024
+# Number of attempts of transferring an object or a part
+MAX_ATTEMPTS = 3
+# Object metadata storing the SHA-256 checksum of the whole file
+CHECKSUM_HEADER = "x-amz-meta-sha256"
+S3_NS = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+# EC2 instance metadata service providing the instance role credentials
+IMDS_HOST = "169.254.169.254"
+# Profile settings of the AWS CLI credential providers which are not supported
+UNSUPPORTED_PROFILE_SETTINGS = ["sso_session", "sso_start_url", "role_arn", "credential_process", "web_identity_token_file"]
+
+
+class BuildCacheError(Exception):
+    """Unexpected response from the cache storage or invalid cache contents"""
+
+
+def get_file_checksum(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class DirectoryBackend:
+    """Cache storage in a local directory, used for testing the cache client
+    and for sharing the cache on a file system. The checksums of the objects
+    are computed from their contents."""
+    def __init__(self, root: str):
+        self.root = os.path.normpath(root)
+        self.uploads = os.path.join(self.root, ".uploads")
+
+    def _path(self, key: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, key))
+        if path != self.root and not path.startswith(os.path.join(self.root, "")):
+            raise BuildCacheError(f"The '{key}' key is outside of the '{self.root}' directory")
+        return path
+
+    def head(self, key: str) -> dict:
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        return {"size": os.path.getsize(path), "sha256": get_file_checksum(path)}
+
+    def get(self, key: str, start: int = None, end: int = None) -> bytes:
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            if start is None:
+                return f.read()
+            f.seek(start)
+            return f.read(end - start + 1)
+
+    def put(self, key: str, data: bytes, sha256: str = None):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def create_multipart(self, key: str, sha256: str = None) -> str:
+        upload_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.uploads, upload_id))
+        return upload_id
+
+    def upload_part(self, key: str, upload_id: str, number: int, data: bytes) -> str:
+        with open(os.path.join(self.uploads, upload_id, str(number)), 'wb') as f:
+            f.write(data)
+        return hashlib.md5(data).hexdigest()
+
+    def complete_multipart(self, key: str, upload_id: str, etags: list):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = os.path.join(self.uploads, upload_id, "object")
+        with open(tmp_path, 'wb') as f:
+            for number in range(1, len(etags) + 1):
+                with open(os.path.join(self.uploads, upload_id, str(number)), 'rb') as part:
+                    shutil.copyfileobj(part, f)
+        os.replace(tmp_path, path)
+        self.abort_multipart(key, upload_id)
+
+    def abort_multipart(self, key: str, upload_id: str):
+        shutil.rmtree(os.path.join(self.uploads, upload_id), ignore_errors=True)
+
+    def list(self, prefix: str) -> dict:
+        """Return the sizes of the objects with the key prefix"""
+        objects = {}
+        for dirpath, dirnames, filenames in os.walk(self._path(prefix)):
+            if dirpath == self.root:
+                dirnames[:] = [d for d in dirnames if d != ".uploads"]
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                objects[os.path.relpath(path, self.root)] = os.path.getsize(path)
+        return objects
+
+
+def get_aws_config(file: str, section: str) -> dict:
+    config = configparser.ConfigParser()
+    config.read(os.path.expanduser(file))
+    return dict(config[section]) if config.has_section(section) else {}
+
+
+def get_aws_profile_config(profile: str) -> dict:
+    section = profile if profile == "default" else f"profile {profile}"
+    return get_aws_config(os.environ.get("AWS_CONFIG_FILE", "~/.aws/config"), section)
+
+
+def get_aws_credentials():
+    """Return the access key, secret key and session token, in the order used by
+    the AWS CLI, from:
+    - the AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY and AWS_SESSION_TOKEN variables
+    - the static keys of the AWS_PROFILE profile in the shared credentials or config file
+    - the EC2 instance role
+    The profiles using SSO, assumed roles, web identities or credential processes
+    are not supported, their credentials must be exported to the environment."""
+    if os.environ.get("AWS_ACCESS_KEY_ID"):
+        return (os.environ["AWS_ACCESS_KEY_ID"], os.environ.get("AWS_SECRET_ACCESS_KEY"),
+                os.environ.get("AWS_SESSION_TOKEN"))
+
+    profile = os.environ.get("AWS_PROFILE", "default")
+    profile_config = get_aws_profile_config(profile)
+    for config in [get_aws_config(os.environ.get("AWS_SHARED_CREDENTIALS_FILE", "~/.aws/credentials"), profile),
+                   profile_config]:
+        if config.get("aws_access_key_id"):
+            return config["aws_access_key_id"], config.get("aws_secret_access_key"), config.get("aws_session_token")
+    unsupported = [s for s in UNSUPPORTED_PROFILE_SETTINGS if s in profile_config]
+    if unsupported:
+        raise BuildCacheError(f"The credentials of the '{profile}' AWS profile using {unsupported} are not supported, "
+                              f"export them with 'aws configure export-credentials --profile {profile} --format env'")
+
+    try:
+        conn = http.client.HTTPConnection(IMDS_HOST, timeout=2)
+        conn.request("PUT", "/latest/api/token", headers={"X-aws-ec2-metadata-token-ttl-seconds": "300"})
+        token = conn.getresponse().read().decode()
+        headers = {"X-aws-ec2-metadata-token": token}
+        conn.request("GET", "/latest/meta-data/iam/security-credentials/", headers=headers)
+        role = conn.getresponse().read().decode().splitlines()[0]
+        conn.request("GET", f"/latest/meta-data/iam/security-credentials/{role}", headers=headers)
+        creds = json.loads(conn.getresponse().read())
+        conn.close()
+        return creds["AccessKeyId"], creds["SecretAccessKey"], creds.get("Token")
+    except Exception as e:
+        raise BuildCacheError(f"Failed to find AWS credentials: {e}")
+
+
+def get_aws_region() -> str:
+    region = os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION")
+    if not region:
+        region = get_aws_profile_config(os.environ.get("AWS_PROFILE", "default")).get("region")
+    # Requests for buckets in other regions are redirected to their region
+    return region or "us-east-1"
+
+
+def sign_v4(credentials, region: str, method: str, path: str, query: dict, headers: dict,
+            payload_hash: str, amz_date: str) -> dict:
+    """Return the request headers with the AWS signature version 4 authorization
+    for the S3 service. The path and the query are not URL encoded."""
+    access_key, secret_key, token = credentials
+    headers = {k.lower(): str(v).strip() for k, v in headers.items()}
+    headers.update({"x-amz-date": amz_date, "x-amz-content-sha256": payload_hash})
+    if token:
+        headers["x-amz-security-token"] = token
+    signed_headers = ";".join(sorted(headers))
+    canonical_request = "\n".join([
+        method,
+        urllib.parse.quote(path, safe="/-_.~"),
+        urllib.parse.urlencode(sorted(query.items()), quote_via=urllib.parse.quote),
+        "".join(f"{k}:{headers[k]}\n" for k in sorted(headers)),
+        signed_headers,
+        payload_hash,
+    ])
+    scope = f"{amz_date[:8]}/{region}/s3/aws4_request"
+    string_to_sign = "\n".join([
+        "AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()
+    ])
+    key = f"AWS4{secret_key}".encode()
+    for part in [amz_date[:8], region, "s3", "aws4_request"]:
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+    headers["authorization"] = (f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, "
+                                f"SignedHeaders={signed_headers}, Signature={signature}")
+    return headers
+
+
+class S3Backend:
+    """Cache storage in an S3 bucket accessed over a pool of persistent
+    connections with signed requests, so that the transfers do not depend on
+    external tools or modules. S3 compatible services like MinIO are accessed
+    at the endpoint URL with path style requests."""
+    def __init__(self, bucket: str, endpoint_url: str = None, max_connections: int = 16, timeout: int = 60):
+        self.bucket = bucket
+        self.credentials = get_aws_credentials()
+        self.region = get_aws_region()
+        self.endpoint_url = endpoint_url
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.pool = queue.LifoQueue()
+        self._set_host()
+
+    def _set_host(self):
+        if self.endpoint_url:
+            url = urllib.parse.urlsplit(self.endpoint_url)
+            self.secure = url.scheme == "https"
+            self.host = url.netloc
+            self.path_style = True
+        else:
+            self.secure = True
+            # Virtual hosted style requests do not work for bucket names with dots over TLS
+            self.path_style = "." in self.bucket
+            host = f"s3.{self.region}.amazonaws.com"
+            self.host = host if self.path_style else f"{self.bucket}.{host}"
+
+    def close(self):
+        while not self.pool.empty():
+            self.pool.get_nowait().close()
+
+    @contextlib.contextmanager
+    def _connection(self):
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn_class = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+            conn = conn_class(self.host, timeout=self.timeout)
+        try:
+            yield conn
+        except Exception:
+            conn.close()
+            raise
+        # Keep at most the maximum number of idle connections
+        if self.pool.qsize() < self.max_connections:
+            self.pool.put(conn)
+        else:
+            conn.close()
+
+    def _request(self, method: str, key: str, query: dict = None, headers: dict = None, body: bytes = None):
+        """Send a signed request for the key and return the response status, headers and body"""
+        query = query or {}
+        payload_hash = hashlib.sha256(body or b"").hexdigest()
+        for attempt in range(3):
+            path = f"/{self.bucket}/{key}" if self.path_style else f"/{key}"
+            amz_date = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+            signed = sign_v4(self.credentials, self.region, method, path, query,
+                             dict(headers or {}, host=self.host), payload_hash, amz_date)
+            url = urllib.parse.quote(path, safe="/-_.~")
+            if query:
+                url += "?" + urllib.parse.urlencode(sorted(query.items()), quote_via=urllib.parse.quote)
+            with self._connection() as conn:
+                try:
+                    conn.request(method, url, body=body, headers=signed)
+                    response = conn.getresponse()
+                    data = response.read()
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    # The storage may close idle keep-alive connections at any time
+                    if attempt:
+                        raise
+                    conn.close()
+                    continue
+                if response.will_close:
+                    conn.close()
+            # Requests for buckets in other regions fail with their region in the response
+            region = response.headers.get("x-amz-bucket-region")
+            if response.status in [301, 400] and region and region != self.region and not attempt:
+                self.region = region
+                self.close()
+                self._set_host()
+                continue
+            return response.status, response.headers, data
+        raise BuildCacheError(f"Failed to send {method} request for '{key}' to '{self.host}'")
+
+    def _check(self, status: int, data: bytes, action: str):
+        if status >= 300:
+            code = None
+            with contextlib.suppress(ET.ParseError):
+                code = ET.fromstring(data).findtext("Code") if data else None
+            raise BuildCacheError(f"Failed to {action} in '{self.bucket}' bucket: HTTP {status} {code or ''}".strip())
+
+    def head(self, key: str) -> dict:
+        status, headers, data = self._request("HEAD", key)
+        if status == 404:
+            return None
+        self._check(status, data, f"get '{key}' object metadata")
+        return {"size": int(headers["Content-Length"]), "sha256": headers.get(CHECKSUM_HEADER)}
+
+    def get(self, key: str, start: int = None, end: int = None) -> bytes:
+        headers = {"range": f"bytes={start}-{end}"} if start is not None else {}
+        status, _, data = self._request("GET", key, headers=headers)
+        if status == 404 and start is None:
+            return None
+        self._check(status, data, f"get '{key}' object")
+        return data
+
+    def put(self, key: str, data: bytes, sha256: str = None):
+        headers = {CHECKSUM_HEADER: sha256} if sha256 else {}
+        status, _, body = self._request("PUT", key, headers=headers, body=data)
+        self._check(status, body, f"put '{key}' object")
+
+    def create_multipart(self, key: str, sha256: str = None) -> str:
+        headers = {CHECKSUM_HEADER: sha256} if sha256 else {}
+        status, _, data = self._request("POST", key, query={"uploads": ""}, headers=headers)
+        self._check(status, data, f"start '{key}' multipart upload")
+        return ET.fromstring(data).findtext(f"{S3_NS}UploadId")
+
+    def upload_part(self, key: str, upload_id: str, number: int, data: bytes) -> str:
+        query = {"partNumber": str(number), "uploadId": upload_id}
+        status, headers, body = self._request("PUT", key, query=query, body=data)
+        self._check(status, body, f"upload '{key}' part {number}")
+        return headers["ETag"]
+
+    def complete_multipart(self, key: str, upload_id: str, etags: list):
+        parts = "".join(f"<Part><PartNumber>{n}</PartNumber><ETag>{etag}</ETag></Part>"
+                        for n, etag in enumerate(etags, start=1))
+        body = f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>".encode()
+        status, _, data = self._request("POST", key, query={"uploadId": upload_id}, body=body)
+        # Errors may be reported after the response status is sent
+        if status == 200 and b"<Error>" in data:
+            status = 500
+        self._check(status, data, f"complete '{key}' multipart upload")
+
+    def abort_multipart(self, key: str, upload_id: str):
+        self._request("DELETE", key, query={"uploadId": upload_id})
+
+    def list(self, prefix: str) -> dict:
+        """Return the sizes of the objects with the key prefix"""
+        objects = {}
+        query = {"list-type": "2", "prefix": f"{prefix}/" if prefix else ""}
+        while True:
+            status, _, data = self._request("GET", "", query=query)
+            self._check(status, data, f"list '{prefix}' objects")
+            result = ET.fromstring(data)
+            for item in result.iter(f"{S3_NS}Contents"):
+                objects[item.findtext(f"{S3_NS}Key")] = int(item.findtext(f"{S3_NS}Size"))
+            if result.findtext(f"{S3_NS}IsTruncated") != "true":
+                return objects
+            query["continuation-token"] = result.findtext(f"{S3_NS}NextContinuationToken")
+
+
+def get_backend(location: str):
+    """Return the storage backend and the key prefix of the cache location,
+    either an s3://<bucket>/<prefix> URL or a local directory path"""
+    if location.startswith("s3://"):
+        bucket, _, prefix = location.removeprefix("s3://").partition("/")
+        endpoint_url = os.environ.get("AWS_ENDPOINT_URL_S3") or os.environ.get("AWS_ENDPOINT_URL")
+        return S3Backend(bucket, endpoint_url), prefix.strip("/")
+    return DirectoryBackend(location.removeprefix("file://")), ""
+
+
+class BuildCache:
+    """Client transferring the files of a cache entry concurrently, splitting
+    large files into parts transferred in parallel. The files are skipped when
+    the destination already has them with the same checksum."""
+    def __init__(self, backend, prefix: str, max_workers: int = 8, part_size: int = PART_SIZE):
+        if part_size < MIN_PART_SIZE:
+            raise BuildCacheError(f"The part size must be at least {MIN_PART_SIZE} bytes")
+        self.backend = backend
+        self.prefix = prefix
+        self.max_workers = max_workers
+        self.part_size = part_size
+
+    def _key(self, relpath: str) -> str:
+        return f"{self.prefix}/{relpath}" if self.prefix else relpath
+
+    def _parts(self, size: int):
+        return [(n, offset, min(self.part_size, size - offset))
+                for n, offset in enumerate(range(0, size, self.part_size), start=1)]
+
+    def get_manifest(self) -> dict:
+        data = self.backend.get(self._key(MANIFEST_NAME))
+        return json.loads(data) if data is not None else None
+
+    def get_files(self) -> dict:
+        """Return the sizes and checksums of the files in the cache entry from
+        its manifest, or from the object listing for entries without manifest"""
+        manifest = self.get_manifest()
+        if manifest is not None:
+            return manifest["files"]
+        start = len(self._key(""))
+        return {key[start:]: {"size": size, "sha256": None} for key, size in self.backend.list(self.prefix).items()}
+
+    def _upload_part(self, path: str, key: str, upload_id: str, number: int, offset: int, length: int) -> str:
+        with open(path, 'rb') as f:
+            data = os.pread(f.fileno(), length, offset)
+        return self.backend.upload_part(key, upload_id, number, data)
+
+    def _upload_file(self, path: str, relpath: str, executor) -> tuple:
+        """Upload the file unless it exists with the same checksum, and return
+        its size, checksum and whether it was transferred"""
+        key = self._key(relpath)
+        size = os.path.getsize(path)
+        sha256 = get_file_checksum(path)
+        current = common.retry_on_exception(MAX_ATTEMPTS, self.backend.head, key)
+        if current and current["size"] == size and current["sha256"] == sha256:
+            return size, sha256, False
+
+        if size <= self.part_size:
+            with open(path, 'rb') as f:
+                common.retry_on_exception(MAX_ATTEMPTS, self.backend.put, key, f.read(), sha256)
+            return size, sha256, True
+
+        upload_id = common.retry_on_exception(MAX_ATTEMPTS, self.backend.create_multipart, key, sha256)
+        futures = [
+            executor.submit(common.retry_on_exception, MAX_ATTEMPTS, self._upload_part,
+                            path, key, upload_id, n, offset, length)
+            for n, offset, length in self._parts(size)
+        ]
+        try:
+            etags = [f.result() for f in futures]
+            common.retry_on_exception(MAX_ATTEMPTS, self.backend.complete_multipart, key, upload_id, etags)
+        except Exception:
+            for f in futures:
+                f.cancel()
+            self.backend.abort_multipart(key, upload_id)
+            raise
+        return size, sha256, True
+
+    def upload(self, src_dir: str, patterns: list) -> dict:
+        """Upload the files matching the glob patterns relative to the source
+        directory, followed by the manifest of the entry"""
+        relpaths = sorted({
+            os.path.relpath(path, src_dir)
+            for pattern in patterns
+            for path in glob.glob(os.path.join(src_dir, pattern))
+            if os.path.isfile(path)
+        })
+        if not relpaths:
+            raise BuildCacheError(f"No files matching {patterns} in '{src_dir}'")
+
+        start = time.monotonic()
+        files = {}
+        transferred = 0
+        # Files wait for their parts, so the parts use a separate pool
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as parts_executor, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=min(len(relpaths), self.max_workers)) as executor:
+            futures = {
+                executor.submit(self._upload_file, os.path.join(src_dir, r), r, parts_executor): r
+                for r in relpaths
+            }
+            for f in concurrent.futures.as_completed(futures):
+                size, sha256, uploaded = f.result()
+                files[futures[f]] = {"size": size, "sha256": sha256}
+                common.print_msg(f"{'Uploaded' if uploaded else 'Skipped unchanged'} '{futures[f]}'")
+                transferred += size if uploaded else 0
+
+        manifest = {"files": dict(sorted(files.items()))}
+        self.backend.put(self._key(MANIFEST_NAME), json.dumps(manifest, indent=2).encode())
+        common.print_msg(f"Uploaded {transferred / 2**30:.2f} GiB of {len(files)} file(s) "
+                         f"in {time.monotonic() - start:.0f}s")
+        return manifest
+
+    def _download_part(self, fd: int, key: str, offset: int, length: int):
+        data = self.backend.get(key, offset, offset + length - 1)
+        if data is None or len(data) != length:
+            raise BuildCacheError(f"Short read of '{key}' at offset {offset}")
+        os.pwrite(fd, data, offset)
+
+    def _download_file(self, path: str, relpath: str, info: dict, executor) -> bool:
+        """Download the file unless it exists with the same checksum, and return
+        whether it was transferred"""
+        key = self._key(relpath)
+        if (info["sha256"] and os.path.isfile(path) and os.path.getsize(path) == info["size"]
+                and get_file_checksum(path) == info["sha256"]):
+            return False
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.download"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, info["size"])
+            futures = [
+                executor.submit(common.retry_on_exception, MAX_ATTEMPTS, self._download_part, fd, key, offset, length)
+                for _, offset, length in self._parts(info["size"])
+            ]
+            try:
+                for f in futures:
+                    f.result()
+            except Exception:
+                for f in futures:
+                    f.cancel()
+                # Wait for the running parts before closing the file
+                concurrent.futures.wait(futures)
+                raise
+        finally:
+            os.close(fd)
+        if info["sha256"] and get_file_checksum(tmp_path) != info["sha256"]:
+            os.remove(tmp_path)
+            raise BuildCacheError(f"Checksum mismatch of the downloaded '{relpath}' file")
+        os.replace(tmp_path, path)
+        return True
+
+    def download(self, dst_dir: str) -> dict:
+        """Download the files of the cache entry to the destination directory"""
+        files = self.get_files()
+        if not files:
+            raise BuildCacheError(f"No files in the '{self.prefix}' cache entry")
+
+        start = time.monotonic()
+        transferred = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as parts_executor, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=min(len(files), self.max_workers)) as executor:
+            futures = {
+                executor.submit(self._download_file, os.path.join(dst_dir, r), r, info, parts_executor): r
+                for r, info in files.items()
+            }
+            for f in concurrent.futures.as_completed(futures):
+                downloaded = f.result()
+                common.print_msg(f"{'Downloaded' if downloaded else 'Skipped unchanged'} '{futures[f]}'")
+                transferred += files[futures[f]]["size"] if downloaded else 0
+        common.print_msg(f"Downloaded {transferred / 2**30:.2f} GiB of {len(files)} file(s) "
+                         f"in {time.monotonic() - start:.0f}s")
+        return files
+
+    def verify(self, required: list, deep: bool = False) -> list:
+        """Return the problems of the cache entry: the required regular expressions
+        without matching files and, in the deep mode, the files whose objects are
+        missing or differ from the manifest"""
+        files = self.get_files()
+        problems = [f"No file matching '{r}'" for r in required if not any(re.search(r, name) for name in files)]
+        if deep:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                objects = dict(zip(files, executor.map(lambda r: self.backend.head(self._key(r)), files)))
+            for relpath, info in files.items():
+                current = objects[relpath]
+                if current is None:
+                    problems.append(f"Missing '{relpath}' object")
+                elif current["size"] != info["size"] or (info["sha256"] and current["sha256"] != info["sha256"]):
+                    problems.append(f"The '{relpath}' object differs from the manifest")
+        return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload, download and verify build cache entries.")
+    parser.add_argument("action", choices=["upload", "download", "verify"], help="Cache operation.")
+    parser.add_argument("-l", "--location", required=True,
+                        help="Cache entry location: s3://<bucket>/<prefix> URL or a local directory path.")
+    parser.add_argument("-d", "--dir", help="Local directory to upload from or download to.")
+    parser.add_argument("-i", "--include", action="append", default=[],
+                        help="Glob pattern of the files to upload relative to the local directory (repeatable).")
+    parser.add_argument("-r", "--require", action="append", default=[],
+                        help="Regular expression of a file which must exist in the cache entry (repeatable).")
+    parser.add_argument("--deep", action="store_true",
+                        help="Verify that all the objects in the manifest exist with the same size and checksum.")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="Number of concurrent transfers.")
+    parser.add_argument("--part-size", type=int, default=PART_SIZE // 2**20,
+                        help="Size of the parts of large files transferred in parallel, in MiB.")
+    args = parser.parse_args()
+
+    backend = None
+    try:
+        if args.action in ["upload", "download"] and not args.dir:
+            raise BuildCacheError(f"The local directory is mandatory for the '{args.action}' operation")
+        if args.action == "upload" and not args.include:
+            raise BuildCacheError("At least one include pattern is mandatory for the 'upload' operation")
+
+        backend, prefix = get_backend(args.location)
+        cache = BuildCache(backend, prefix, args.jobs, args.part_size * 2**20)
+        if args.action == "upload":
+            cache.upload(args.dir, args.include)
+        elif args.action == "download":
+            cache.download(args.dir)
+        else:
+            problems = cache.verify(args.require, args.deep)
+            for problem in problems:
+                common.print_msg(f"Cache entry '{args.location}': {problem}")
+            if problems:
+                sys.exit(1)
+    except Exception as e:
+        common.print_msg(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        if isinstance(backend, S3Backend):
+            backend.close()
+
+
+if __name__ == "__main__":
+    main()
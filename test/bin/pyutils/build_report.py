@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import sys
+
+
+def load_trace(trace_path):
+    """Load the events of a JSON lines trace written by build_bootc_images.py"""
+    with open(trace_path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def get_phase_totals(events):
+    """Return the number of events and their total duration for each phase"""
+    totals = {}
+    for e in events:
+        # Tasks contain the other phases
+        if e["phase"] == "task":
+            continue
+        count, duration = totals.get(e["phase"], (0, 0))
+        totals[e["phase"]] = (count + 1, duration + e["end"] - e["start"])
+    return dict(sorted(totals.items(), key=lambda i: -i[1][1]))
+
+
+def get_utilization(events):
+    """Return the wall clock time of the trace, and the average and peak number
+    of tasks running in parallel"""
+    if not events:
+        return 0, 0, 0
+    wall = max(e["end"] for e in events) - min(e["start"] for e in events)
+    tasks = [e for e in events if e["phase"] == "task"]
+    busy = sum(e["end"] - e["start"] for e in tasks)
+    # Sweep over the task start and end times, ends first for equal times
+    changes = sorted([(e["start"], 1) for e in tasks] + [(e["end"], -1) for e in tasks])
+    running = peak = 0
+    for _, change in changes:
+        running += change
+        peak = max(peak, running)
+    return wall, busy / wall if wall > 0 else 0, peak
+
+
+def get_critical_path(events):
+    """Return the chain of dependent tasks with the longest total duration
+    and its duration. Faster tasks outside the chain cannot shorten the build."""
+    tasks = {e["object"]: e for e in events if e["phase"] == "task"}
+    longest = {}
+
+    def visit(object, visiting):
+        if object in longest:
+            return longest[object]
+        if object in visiting:
+            raise Exception(f"Dependency cycle through '{object}'")
+        visiting.add(object)
+        task = tasks[object]
+        chain, duration = [], 0
+        for dep in (task.get("args") or {}).get("deps", []):
+            if dep in tasks:
+                dep_chain, dep_duration = visit(dep, visiting)
+                if dep_duration > duration:
+                    chain, duration = dep_chain, dep_duration
+        visiting.discard(object)
+        longest[object] = (chain + [object], duration + task["end"] - task["start"])
+        return longest[object]
+
+    best = ([], 0)
+    for object in tasks:
+        result = visit(object, set())
+        if result[1] > best[1]:
+            best = result
+    return best
+
+
+def get_task_phases(events, object):
+    return {e["phase"]: e["end"] - e["start"] for e in events if e["object"] == object and e["phase"] != "task"}
+
+
+def print_report(events):
+    wall, average, peak = get_utilization(events)
+    print(f"Wall clock time: {wall:.1f}s")
+    print(f"Parallel utilization: average {average:.2f} tasks, peak {peak} tasks")
+
+    chain, duration = get_critical_path(events)
+    print(f"\nCritical path: {duration:.1f}s in {len(chain)} task(s)")
+    for object in chain:
+        phases = get_task_phases(events, object)
+        details = ", ".join(f"{phase}={seconds:.1f}s" for phase, seconds in phases.items())
+        print(f"  {os.path.basename(object)}: {details}")
+
+    print("\nPhase totals:")
+    print(f"  {'phase':<28} {'count':>6} {'total_s':>10} {'average_s':>10}")
+    for phase, (count, total) in get_phase_totals(events).items():
+        print(f"  {phase:<28} {count:>6} {total:>10.1f} {total / count:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the critical path, phase totals and parallel utilization of an image layer build trace.")
+    parser.add_argument("trace", help="Path to the trace.jsonl file in the build logs directory.")
+    parser.add_argument("-j", "--json", action="store_true", help="Print the report as JSON.")
+    args = parser.parse_args()
+
+    try:
+        events = load_trace(args.trace)
+        if args.json:
+            wall, average, peak = get_utilization(events)
+            chain, duration = get_critical_path(events)
+            report = {
+                "wall_seconds": wall,
+                "average_parallel_tasks": average,
+                "peak_parallel_tasks": peak,
+                "critical_path": {"seconds": duration, "tasks": chain},
+                "phases": {phase: {"count": c, "seconds": t} for phase, (c, t) in get_phase_totals(events).items()}
+            }
+            print(json.dumps(report, indent=2))
+        else:
+            print_report(events)
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,74 +1,323 @@
 #!/usr/bin/env python3
 
+import collections
+import contextlib
+import json
+import multiprocessing
 import os
 import pathlib
 import psutil
+import queue
+import signal
 import sys
 import subprocess
 import time
 import threading
 from typing import List
+from xml.sax.saxutils import quoteattr
 
 
 PUSHD_DIR_STACK = []
-JUNIT_LOGFILE = None
-JUNIT_LOCK = threading.Lock()
+JUNIT_COLLECTOR = None
+# Seconds to wait for the results of the worker processes when closing the junit files
+RESULT_COLLECTOR_TIMEOUT = 60
+# Set in worker processes to send results to the collector in the parent process
+JUNIT_QUEUE = None
+
+
+class JUnitWriter:
+    """Write junit test cases to a file kept open until the writer is closed.
+    Each test case is rendered in memory and written with a single append
+    operation, so records from different threads do not interleave.
+    """
+    def __init__(self, path: str, suite: str):
+        self.path = path
+        self.suite = suite
+        self.lock = threading.Lock()
+        self.fd = None
+
+    def open(self):
+        """Create a new junit file with the suite name and timestamp header"""
+        create_dir(os.path.dirname(self.path))
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+        timestamp = get_timestamp("%Y-%m-%dT%H:%M:%S")
+        self._write(f'''<?xml version="1.0" encoding="UTF-8"?>
+<testsuite name={quoteattr(self.suite)} timestamp="{timestamp}">
+''')
+
+    def close(self):
+        """Write the footer and close the junit file"""
+        if self.fd is None:
+            raise Exception("Attempt to close junit without opening it first")
+        self._write('</testsuite>\n')
+        os.close(self.fd)
+        self.fd = None
+
+    def record(self, object, step, status, duration=None, timestamp=None, properties=None):
+        """Add a test case for the specified object and step with OK, SKIP or FAIL status.
+        The optional duration in seconds and start timestamp are stored as the
+        'time' and 'timestamp' test case attributes, and the optional properties
+        dictionary as the test case properties.
+        """
+        attrs = f'classname={quoteattr(str(object))} name={quoteattr(step)}'
+        if duration is not None:
+            attrs += f' time="{duration:.3f}"'
+        if timestamp is not None:
+            attrs += f' timestamp="{timestamp}"'
+        # Add a message according to the status
+        if status == "OK":
+            message = ''
+        elif status.startswith("SKIP"):
+            message = f'<skipped message={quoteattr(status)} type="{step}-skipped" />'
+        elif status.startswith("FAIL"):
+            message = f'<failure message={quoteattr(status)} type="{step}-failure" />'
+        else:
+            raise Exception(f"Invalid junit status '{status}'")
+        if properties:
+            props = ''.join(f'<property name={quoteattr(k)} value={quoteattr(str(v))} />' for k, v in properties.items())
+            message = f'<properties>{props}</properties>{message}'
+        self._write(f'<testcase {attrs}>{message}</testcase>\n')
+
+    def _write(self, content: str):
+        data = content.encode()
+        with self.lock:
+            if self.fd is None:
+                raise Exception(f"The '{self.path}' junit file is not open")
+            # A single write call on a file opened in append mode
+            os.write(self.fd, data)
+
+
+class ResultCollector:
+    """Collect step results in the parent process, which is the only writer
+    of the junit and metrics files. Worker processes send their results
+    through a multiprocessing queue drained by a thread in the parent.
+    Results are routed to the junit file of the group the object belongs to.
+    """
+    def __init__(self):
+        self.groups = {}
+        self.trace = []
+        self.trace_path = None
+        self.lock = threading.Lock()
+        self.queue = multiprocessing.Queue()
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.stopping = threading.Event()
+
+    def start(self):
+        self.thread.start()
+
+    def add_group(self, group: str, junit_path: str, metrics_path: str):
+        writer = JUnitWriter(junit_path, f"microshift-test-framework:{group}")
+        writer.open()
+        with self.lock:
+            self.groups[group] = {"writer": writer, "metrics_path": metrics_path, "results": []}
+
+    def stop(self, timeout=RESULT_COLLECTOR_TIMEOUT):
+        """Drain the remaining results and close the junit and metrics files"""
+        # The sentinel is queued after results of all the finished workers
+        self.queue.put(None)
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            # A worker killed while writing to the queue may hold its lock, so that
+            # the sentinel never arrives. Drain the results left in the queue instead.
+            print_msg(f"Warning: Results of the worker processes not drained after {timeout}s, some may be missing")
+            self.queue.cancel_join_thread()
+            self.stopping.set()
+            self.thread.join(timeout)
+        for group in self.groups.values():
+            group["writer"].close()
+            write_file_atomic(group["metrics_path"], json.dumps(group["results"], indent=2))
+        if self.trace_path:
+            write_trace_files(self.trace_path, self.trace)
+
+    def add(self, result: dict):
+        with self.lock:
+            # Objects are either the files of a group or the group directory
+            group = self.groups.get(basename(os.path.dirname(result["object"])))
+            if group is None:
+                group = self.groups.get(basename(result["object"]))
+            if group is None and len(self.groups) == 1:
+                group = next(iter(self.groups.values()))
+        if group is None:
+            raise Exception(f"Cannot find junit group for '{result['object']}'")
+        group["writer"].record(**result)
+        with self.lock:
+            group["results"].append(result)
+
+    def add_trace(self, event: dict):
+        with self.lock:
+            self.trace.append(event)
+
+    def _drain(self):
+        while True:
+            try:
+                result = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.stopping.is_set():
+                    break
+                continue
+            if result is None:
+                break
+            try:
+                if "trace" in result:
+                    self.add_trace(result["trace"])
+                else:
+                    self.add(result)
+            except Exception as e:
+                print_msg(f"Error: Failed to record {result}: {e}")
 
 
 def start_junit(groupdir):
-    """Create a new junit file with the group name and timestampt header"""
-    # Initialize the junit log file path
-    global JUNIT_LOGFILE
+    """Create a new junit file with the group name and timestampt header.
+    Several groups may be started, their objects are recorded in separate files.
+    """
+    global JUNIT_COLLECTOR
     group = basename(groupdir)
-    JUNIT_LOGFILE = os.path.join(get_env_var('IMAGEDIR'), "build-logs", group, "junit.xml")
-
-    print_msg(f"Creating '{JUNIT_LOGFILE}'")
-    # Create the output directory
-    create_dir(os.path.dirname(JUNIT_LOGFILE))
-    # Create a new junit file with a header
-    delete_file(JUNIT_LOGFILE)
-    timestamp = get_timestamp("%Y-%m-%dT%H:%M:%S")
-    append_file(JUNIT_LOGFILE, f'''<?xml version="1.0" encoding="UTF-8"?>
-<testsuite name="microshift-test-framework:{group}" timestamp="{timestamp}">''')
+    logdir = os.path.join(get_env_var('IMAGEDIR'), "build-logs", group)
+    junit_logfile = os.path.join(logdir, "junit.xml")
+
+    print_msg(f"Creating '{junit_logfile}'")
+    if not JUNIT_COLLECTOR:
+        JUNIT_COLLECTOR = ResultCollector()
+        JUNIT_COLLECTOR.start()
+    JUNIT_COLLECTOR.add_group(group, junit_logfile, os.path.join(logdir, "metrics.json"))
+
+
+def start_trace(trace_path):
+    """Write the trace events of the started junit groups to the JSON lines file
+    and its Chrome trace format counterpart when the junit files are closed"""
+    if not JUNIT_COLLECTOR:
+        raise Exception("Attempt to start trace without starting junit first")
+    print_msg(f"Tracing build phases to '{trace_path}'")
+    JUNIT_COLLECTOR.trace_path = trace_path
+
+
+def write_trace_files(trace_path, events):
+    """Write the events to a JSON lines file, and to a Chrome trace format file
+    with the same name and .json extension, showing one row per object"""
+    events = sorted(events, key=lambda e: e["start"])
+    create_dir(os.path.dirname(trace_path))
+    write_file_atomic(trace_path, ''.join(json.dumps(e) + '\n' for e in events))
+
+    origin = events[0]["start"] if events else 0
+    objects = {}
+    groups = {}
+    chrome_events = []
+    for e in events:
+        group = basename(os.path.dirname(e["object"])) or e["object"]
+        pid = groups.setdefault(group, len(groups) + 1)
+        tid = objects.setdefault(e["object"], len(objects) + 1)
+        chrome_events.append({
+            "name": e["phase"],
+            "cat": group,
+            "ph": "X",
+            "ts": round((e["start"] - origin) * 1e6),
+            "dur": round((e["end"] - e["start"]) * 1e6),
+            "pid": pid,
+            "tid": tid,
+            "args": dict(e.get("args") or {}, object=e["object"], status=e["status"])
+        })
+    # Name the process and thread rows after the groups and objects
+    for group, pid in groups.items():
+        chrome_events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": group}})
+    for object, tid in objects.items():
+        pid = groups[basename(os.path.dirname(object)) or object]
+        chrome_events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": basename(object)}})
+    write_file_atomic(os.path.splitext(trace_path)[0] + ".json", json.dumps({"traceEvents": chrome_events}))
 
 
 def close_junit():
-    """Close the junit file"""
-    global JUNIT_LOGFILE
-    if not JUNIT_LOGFILE:
+    """Close the junit files of all the started groups"""
+    global JUNIT_COLLECTOR
+    if not JUNIT_COLLECTOR:
         raise Exception("Attempt to close junit without starting it first")
-    # Close the unit
-    append_file(JUNIT_LOGFILE, '</testsuite>')
-    # Reset the junit log directory
-    JUNIT_LOGFILE = None
+    JUNIT_COLLECTOR.stop()
+    JUNIT_COLLECTOR = None
+
+
+def get_junit_queue():
+    """Return the queue to be passed to worker processes in init_junit_worker"""
+    if not JUNIT_COLLECTOR:
+        raise Exception("Attempt to get junit queue without starting junit first")
+    return JUNIT_COLLECTOR.queue
 
 
-def record_junit(object, step, status):
+def init_junit_worker(queue):
+    """Process pool initializer redirecting junit records to the parent process"""
+    global JUNIT_QUEUE
+    JUNIT_QUEUE = queue
+
+
+def record_junit(object, step, status, duration=None, timestamp=None, properties=None):
     """Add a message for the specified object and step with OK, SKIP or FAIL status.
-    Recording messages is synchronized and it can be called from different threads.
+    Recording messages is synchronized and it can be called from different threads
+    and worker processes initialized with init_junit_worker.
+    """
+    result = {
+        "object": str(object),
+        "step": step,
+        "status": status,
+        "duration": duration,
+        "timestamp": timestamp,
+        "properties": properties
+    }
+    if JUNIT_QUEUE is not None:
+        JUNIT_QUEUE.put(result)
+        return
+    if not JUNIT_COLLECTOR:
+        raise Exception("Attempt to record junit without starting it first")
+    JUNIT_COLLECTOR.add(result)
+
+
+def record_trace(object, phase, start, end, status="OK", args=None):
+    """Add a trace event for the specified object and phase with start and end
+    times of the monotonic clock, which is shared by all the processes.
+    Recording events can be called from the same contexts as record_junit.
     """
+    event = {
+        "object": str(object),
+        "phase": phase,
+        "start": start,
+        "end": end,
+        "status": status,
+        "pid": os.getpid(),
+        "args": args
+    }
+    if JUNIT_QUEUE is not None:
+        JUNIT_QUEUE.put({"trace": event})
+        return
+    if not JUNIT_COLLECTOR:
+        raise Exception("Attempt to record trace without starting junit first")
+    JUNIT_COLLECTOR.add_trace(event)
+
+
+@contextlib.contextmanager
+def trace_phase(object, phase):
+    """Record the enclosed block as a trace event, with FAILED status on exceptions"""
+    start = time.monotonic()
     try:
-        # BEGIN CRITICAL SECTION
-        JUNIT_LOCK.acquire()
+        yield
+    except Exception:
+        record_trace(object, phase, start, time.monotonic(), "FAILED")
+        raise
+    record_trace(object, phase, start, time.monotonic())
 
-        append_file(JUNIT_LOGFILE, f'<testcase classname="{object}" name="{step}">')
-        # Add a message according to the status
-        if status == "OK":
-            pass
-        elif status.startswith("SKIP"):
-            append_file(JUNIT_LOGFILE, f'<skipped message="{status}" type="{step}-skipped" />')
-        elif status.startswith("FAIL"):
-            append_file(JUNIT_LOGFILE, f'<failure message="{status}" type="${step}-failure" />')
-        else:
-            raise Exception(f"Invalid junit status '{status}'")
-        # Close the test case block
-        append_file(JUNIT_LOGFILE, '</testcase>')
+
+@contextlib.contextmanager
+def junit_step(object, step):
+    """Time the enclosed block and record it with OK status on success.
+    Failures propagate to the caller, which is responsible for recording them.
+    The block is also recorded as a trace event in both cases.
+    """
+    timestamp = get_timestamp("%Y-%m-%dT%H:%M:%S")
+    start = time.monotonic()
+    try:
+        yield
     except Exception:
-        # Propagate the exception to the caller
+        record_trace(object, step, start, time.monotonic(), "FAILED")
         raise
-    finally:
-        # END CRITICAL SECTION
-        JUNIT_LOCK.release()
+    end = time.monotonic()
+    record_junit(object, step, "OK", end - start, timestamp)
+    record_trace(object, step, start, end)
 
 
 def get_timestamp(format: str = "%H:%M:%S"):
@@ -111,9 +360,13 @@ def run_command(command: List[str], dry_run: bool):
 
 
 def run_command_in_shell(command: List[str], dry_run: bool = False,
-                         stdout=subprocess.PIPE, stderr=sys.stderr):
+                         stdout=subprocess.PIPE, stderr=sys.stderr,
+                         log_prefix: str = None, log_tail: int = 0):
     """Run the command through shell and return its standard output"""
     """If output file descriptors are specified, the appropriate output is redirected"""
+    """If the log prefix is specified, the combined output is written to the stdout
+    file and streamed to the console with the prefix on each line as it is produced.
+    When log_tail is positive, only the last log_tail lines are printed on failure."""
     # Convert command to a string if necessary
     if isinstance(command, list):
         command = ' '.join(command)
@@ -122,6 +375,9 @@ def run_command_in_shell(command: List[str], dry_run: bool = False,
         return ""
 
     print_msg(f"[SHELL] {command}")
+    if log_prefix is not None:
+        stream_command_output(command, stdout, log_prefix, log_tail)
+        return ""
     # Run the command and return its output
     result = subprocess.run(
         command,
@@ -131,6 +387,44 @@ def run_command_in_shell(command: List[str], dry_run: bool = False,
     return result.stdout.strip() if result.stdout else ""
 
 
+def print_prefixed(prefix: str, lines: List[str]):
+    """Print lines on the console with a prefix. Each line is written with a
+    single write system call, which the kernel does not interleave with writes
+    of other threads and worker processes to the same pipe for lines up to
+    PIPE_BUF (4 KiB) in size."""
+    # Keep the order with the output buffered by the print function
+    sys.stdout.flush()
+    for line in lines:
+        data = f"{prefix}: {line}" if line.endswith('\n') else f"{prefix}: {line}\n"
+        data = data.encode(errors="replace")
+        while data:
+            written = os.write(sys.stdout.fileno(), data)
+            data = data[written:]
+
+
+def stream_command_output(command: str, logfile, prefix: str, tail: int = 0):
+    """Run the command through shell, writing its combined output to the log file
+    and the prefixed console stream line by line. If tail is positive, only the
+    last tail lines are kept in memory and printed if the command fails."""
+    ring = collections.deque(maxlen=tail) if tail > 0 else None
+    with subprocess.Popen(
+            command,
+            shell=True, text=True, errors="replace",
+            env=os.environ.copy(),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as proc:
+        for line in proc.stdout:
+            logfile.write(line)
+            logfile.flush()
+            if ring is None:
+                print_prefixed(prefix, [line])
+            else:
+                ring.append(line)
+    if proc.returncode != 0:
+        if ring:
+            print_prefixed(prefix, [f"Last {len(ring)} lines of the output:\n"] + list(ring))
+        raise subprocess.CalledProcessError(proc.returncode, command)
+
+
 def create_dir(dir: str):
     """Attempt recursive directory creation ignoring errors if it already exists"""
     path = pathlib.Path(dir)
@@ -166,6 +460,14 @@ def append_file(file_path: str, content: str):
         file.write(content)
 
 
+def write_file_atomic(file_path: str, content: str):
+    """Write the content to a temporary file and rename it to the target file"""
+    tmp_path = f"{file_path}.tmp.{os.getpid()}"
+    with open(tmp_path, 'w') as file:
+        file.write(content)
+    os.replace(tmp_path, file_path)
+
+
 def delete_file(file_path: str):
     """Attempt file deletion ignoring errors when a file does not exist"""
     try:
@@ -179,6 +481,13 @@ def basename(path: str):
     return pathlib.Path(path).name
 
 
+def get_host_resources():
+    """Return the number of CPUs and the available memory in GiB of the host"""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    memory = psutil.virtual_memory().available // (1024 ** 3)
+    return cpus, max(1, memory)
+
+
 def find_subprocesses(ppid=None):
     """Find and return a list of all the sub-processes of a parent PID"""
     # Get current process if not specified
@@ -193,29 +502,45 @@ def find_subprocesses(ppid=None):
     return pids
 
 
-def terminate_process(pid, wait=True):
-    """Terminate a process, waiting for 10s until it exits"""
-    try:
-        proc = psutil.Process(pid)
-        # Check if the process runs elevated
-        if proc.uids().effective == 0:
-            run_command(["sudo", "kill", "-TERM", f"{pid}"], False)
-        else:
-            proc.terminate()
-        if not wait:
-            return
-
-        # Wait for process to terminate
+def terminate_processes(pids, timeout=10):
+    """Terminate processes all at once, waiting with a single deadline of timeout
+    seconds for all of them to exit, and killing the ones still running after it"""
+    procs = []
+    for pid in pids:
         try:
-            proc.wait(timeout=10)
-        except psutil.TimeoutExpired:
-            print_msg(f"The {pid} PID did not exit after 10s")
-    except psutil.NoSuchProcess:
-        # Ignore non-existent processes
-        pass
-    except Exception:
-        # Propagate the exception to the caller
-        raise
+            procs.append(psutil.Process(pid))
+        except psutil.NoSuchProcess:
+            # Ignore non-existent processes
+            pass
+
+    def signal_all(procs, sig):
+        elevated = []
+        for proc in procs:
+            try:
+                # Check if the process runs elevated
+                if proc.uids().effective == 0:
+                    elevated.append(proc)
+                else:
+                    proc.send_signal(sig)
+            except psutil.NoSuchProcess:
+                pass
+        if elevated:
+            # Signal all the elevated processes with a single command, ignoring
+            # errors caused by processes that have exited in the meantime
+            kill_args = ["sudo", "kill", f"-{sig.name.removeprefix('SIG')}"] + [str(p.pid) for p in elevated]
+            print_msg(f"[RUN] {' '.join(kill_args)}")
+            subprocess.run(kill_args, check=False)
+
+    signal_all(procs, signal.SIGTERM)
+    _, alive = psutil.wait_procs(procs, timeout=timeout)
+    if not alive:
+        return
+
+    print_msg(f"The {[p.pid for p in alive]} PIDs did not exit after {timeout}s, killing them")
+    signal_all(alive, signal.SIGKILL)
+    _, alive = psutil.wait_procs(alive, timeout=timeout)
+    if alive:
+        print_msg(f"The {[p.pid for p in alive]} PIDs did not exit after SIGKILL")
 
 
 def retry_on_exception(max_attempts, func, *args, **kwargs):
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import contextlib
+import http.client
+import json
+import platform
+import queue
+import urllib.parse
+
+MANIFEST_TYPES = [
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+]
+INDEX_TYPES = [
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+]
+# Registry platform names of the machine architectures
+ARCHITECTURES = {"x86_64": "amd64", "aarch64": "arm64"}
+
+
+class RegistryError(Exception):
+    """Unexpected response from the registry"""
+
+
+def parse_image_ref(imgref: str):
+    """Split an image reference into registry, repository and tag or digest"""
+    registry, _, path = imgref.partition("/")
+    if "@" in path:
+        repository, _, reference = path.partition("@")
+    elif ":" in path.split("/")[-1]:
+        repository, _, reference = path.rpartition(":")
+    else:
+        repository, reference = path, "latest"
+    return registry, repository, reference
+
+
+class RegistryClient:
+    """Client of the registry v2 API keeping a pool of persistent connections,
+    so that probing many images does not pay the process startup and connection
+    setup costs of an external tool for each of them. Only anonymous access is
+    supported, which is what the mirror registry provides."""
+    def __init__(self, registry: str, secure: bool = False, max_connections: int = 8, timeout: int = 30):
+        self.registry = registry
+        self.secure = secure
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.pool = queue.LifoQueue()
+
+    def close(self):
+        while not self.pool.empty():
+            self.pool.get_nowait().close()
+
+    @contextlib.contextmanager
+    def _connection(self):
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn_class = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+            conn = conn_class(self.registry, timeout=self.timeout)
+        try:
+            yield conn
+        except Exception:
+            conn.close()
+            raise
+        # Keep at most the maximum number of idle connections
+        if self.pool.qsize() < self.max_connections:
+            self.pool.put(conn)
+        else:
+            conn.close()
+
+    def _request(self, method: str, path: str, headers: dict):
+        """Send a request and return the response status, headers and body"""
+        for attempt in range(2):
+            with self._connection() as conn:
+                try:
+                    conn.request(method, path, headers=headers)
+                    response = conn.getresponse()
+                    body = response.read()
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    # The registry may close idle keep-alive connections at any time
+                    if attempt:
+                        raise
+                    conn.close()
+                    continue
+                if response.will_close:
+                    conn.close()
+                return response.status, response.headers, body
+
+    def _get_blob(self, repository: str, digest: str) -> bytes:
+        status, headers, body = self._request("GET", f"/v2/{repository}/blobs/{digest}", {})
+        if status in [301, 302, 307, 308]:
+            # Storage backends may redirect blob downloads to another host
+            location = urllib.parse.urlsplit(headers["Location"])
+            conn_class = http.client.HTTPSConnection if location.scheme == "https" else http.client.HTTPConnection
+            conn = conn_class(location.netloc, timeout=self.timeout)
+            try:
+                conn.request("GET", urllib.parse.urlunsplit(("", "", location.path, location.query, "")))
+                response = conn.getresponse()
+                status, body = response.status, response.read()
+            finally:
+                conn.close()
+        if status != 200:
+            raise RegistryError(f"Failed to get '{repository}@{digest}' blob from '{self.registry}': HTTP {status}")
+        return body
+
+    def get_manifest(self, repository: str, reference: str = "latest", arch: str = None):
+        """Return the digest and contents of the image manifest, selecting the
+        manifest of the architecture from manifest lists, or None if the image
+        does not exist"""
+        headers = {"Accept": ", ".join(MANIFEST_TYPES + INDEX_TYPES)}
+        status, resp_headers, body = self._request("GET", f"/v2/{repository}/manifests/{reference}", headers)
+        if status == 404:
+            return None
+        if status != 200:
+            raise RegistryError(f"Failed to get '{repository}:{reference}' manifest from '{self.registry}': HTTP {status}")
+
+        manifest = json.loads(body)
+        media_type = manifest.get("mediaType", resp_headers.get("Content-Type"))
+        if media_type in INDEX_TYPES:
+            arch = arch or ARCHITECTURES.get(platform.machine(), platform.machine())
+            for m in manifest["manifests"]:
+                if m.get("platform", {}).get("architecture") == arch:
+                    return self.get_manifest(repository, m["digest"])
+            return None
+        return resp_headers.get("Docker-Content-Digest"), manifest
+
+    def get_labels(self, imgref: str) -> dict:
+        """Return the labels of the image configuration, or None if the image does not exist"""
+        registry, repository, reference = parse_image_ref(imgref)
+        if registry != self.registry:
+            raise RegistryError(f"The '{imgref}' image is not in the '{self.registry}' registry")
+        result = self.get_manifest(repository, reference)
+        if result is None:
+            return None
+        _, manifest = result
+        config = json.loads(self._get_blob(repository, manifest["config"]["digest"]))
+        return config.get("config", {}).get("Labels") or {}
+
+    def get_labels_many(self, imgrefs, max_workers: int = 8) -> dict:
+        """Return the labels of the images probed concurrently over the pooled
+        connections, with None for images which do not exist or cannot be read"""
+        def probe(imgref):
+            try:
+                return self.get_labels(imgref)
+            except Exception:
+                return None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip(imgrefs, executor.map(probe, imgrefs)))
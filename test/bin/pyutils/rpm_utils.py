@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+import bz2
+import fnmatch
+import functools
+import glob
+import gzip
+import hashlib
+import json
+import lzma
+import os
+import re
+import shutil
+import struct
+import subprocess
+import xml.etree.ElementTree as ET
+
+# The zstd compression is only available in the standard library of Python 3.14
+# and newer, and in the optional zstandard module for older versions. Without
+# them, the payloads are decompressed by the zstd tool.
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+RPM_LEAD_SIZE = 96
+RPM_HEADER_MAGIC = b"\x8e\xad\xe8\x01"
+
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_EPOCH = 1003
+RPMTAG_ARCH = 1022
+RPMTAG_PAYLOADCOMPRESSOR = 1125
+
+# Signature header tag with the SHA-256 digest of the main header, which
+# covers the digests of all the payload files and the build time
+RPMSIGTAG_SHA256 = 273
+
+RPM_INT32_TYPE = 4
+RPM_STRING_TYPE = 6
+
+REPOMD_NS = "{http://linux.duke.edu/metadata/repo}"
+PRIMARY_NS = "{http://linux.duke.edu/metadata/common}"
+
+# Version segments compared by rpm: digits, letters, or the special tilde and caret
+RPM_VERSION_SEGMENT = re.compile(r"[0-9]+|[a-zA-Z]+|~|\^")
+
+CPIO_HEADER_SIZE = 110
+CPIO_MAGICS = [b"070701", b"070702"]
+CPIO_TRAILER = "TRAILER!!!"
+
+
+class UnsupportedPayload(Exception):
+    """The RPM payload compression cannot be handled in Python"""
+
+
+def read_header(file, align: bool = False) -> dict:
+    """Read an RPM header structure from the file and return its integer and
+    string tags. The signature header is followed by padding to 8 bytes."""
+    intro = file.read(16)
+    if len(intro) != 16 or intro[:4] != RPM_HEADER_MAGIC:
+        raise Exception(f"Invalid RPM header in '{file.name}'")
+    nindex, hsize = struct.unpack(">II", intro[8:16])
+    index = file.read(16 * nindex)
+    store = file.read(hsize)
+    if align:
+        file.read(-(16 + 16 * nindex + hsize) % 8)
+
+    tags = {}
+    for i in range(nindex):
+        tag, type, offset, count = struct.unpack_from(">IIII", index, i * 16)
+        if type == RPM_STRING_TYPE:
+            tags[tag] = store[offset:store.index(b"\0", offset)].decode()
+        elif type == RPM_INT32_TYPE:
+            tags[tag] = list(struct.unpack_from(f">{count}I", store, offset))
+    return tags
+
+
+def get_header_digest(rpm_path: str) -> str:
+    """Return the SHA-256 header digest of the RPM identifying its build,
+    or None for packages built without it"""
+    with open(rpm_path, 'rb') as f:
+        f.seek(RPM_LEAD_SIZE)
+        return read_header(f, align=True).get(RPMSIGTAG_SHA256)
+
+
+def decompress(data: bytes, compressor: str) -> bytes:
+    if compressor == "gzip":
+        return gzip.decompress(data)
+    if compressor in ["xz", "lzma"]:
+        return lzma.decompress(data)
+    if compressor == "bzip2":
+        return bz2.decompress(data)
+    if compressor == "zstd" and zstd is not None:
+        # The zstandard module requires a streaming object for frames without content size
+        if hasattr(zstd, "ZstdDecompressor"):
+            return zstd.ZstdDecompressor().decompressobj().decompress(data)
+        return zstd.decompress(data)
+    if compressor == "zstd" and shutil.which("zstd"):
+        return subprocess.run(["zstd", "-dc"], input=data, capture_output=True, check=True).stdout
+    raise UnsupportedPayload(f"Unsupported '{compressor}' RPM payload compression")
+
+
+def zstd_supported() -> bool:
+    """Return whether zstd compressed payloads, the default of RHEL 9 RPMs, can be decompressed"""
+    return zstd is not None or shutil.which("zstd") is not None
+
+
+def decompress_file(path: str) -> bytes:
+    """Read a repository metadata file decompressing it according to its extension"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    compressors = {".gz": "gzip", ".xz": "xz", ".bz2": "bzip2", ".zst": "zstd"}
+    compressor = compressors.get(os.path.splitext(path)[1])
+    return decompress(data, compressor) if compressor else data
+
+
+def read_cpio_member(data: bytes, match) -> bytes:
+    """Return the contents of the first cpio (newc format) archive member with
+    a name accepted by the match function, or None if there is no such member"""
+    pos = 0
+    while pos + CPIO_HEADER_SIZE <= len(data):
+        header = data[pos:pos + CPIO_HEADER_SIZE]
+        if header[:6] not in CPIO_MAGICS:
+            raise Exception(f"Invalid cpio header at offset {pos}")
+        filesize = int(header[54:62], 16)
+        namesize = int(header[94:102], 16)
+        name = data[pos + CPIO_HEADER_SIZE:pos + CPIO_HEADER_SIZE + namesize - 1].decode()
+        # The name and the contents are padded to 4 bytes
+        pos += CPIO_HEADER_SIZE + namesize
+        pos += -pos % 4
+        if name == CPIO_TRAILER:
+            break
+        if match(name):
+            return data[pos:pos + filesize]
+        pos += filesize
+        pos += -pos % 4
+    return None
+
+
+def read_payload_file(rpm_path: str, match) -> bytes:
+    """Return the contents of the first file in the RPM payload with a name
+    accepted by the match function, or None if there is no such file"""
+    with open(rpm_path, 'rb') as f:
+        f.seek(RPM_LEAD_SIZE)
+        read_header(f, align=True)
+        tags = read_header(f)
+        payload = f.read()
+    compressor = tags.get(RPMTAG_PAYLOADCOMPRESSOR, "gzip")
+    return read_cpio_member(decompress(payload, compressor), match)
+
+
+def rpmvercmp(a: str, b: str) -> int:
+    """Compare two version or release strings the way rpm does, returning
+    a negative, zero or positive number if a is older, equal or newer than b"""
+    if a == b:
+        return 0
+    sa = RPM_VERSION_SEGMENT.findall(a)
+    sb = RPM_VERSION_SEGMENT.findall(b)
+    for i in range(max(len(sa), len(sb))):
+        x = sa[i] if i < len(sa) else None
+        y = sb[i] if i < len(sb) else None
+        # Tilde sorts before anything, including the end of the version
+        if x == "~" or y == "~":
+            if x != y:
+                return -1 if x == "~" else 1
+            continue
+        # Caret sorts after the end of the version, but before anything else
+        if x == "^" or y == "^":
+            if x is None:
+                return -1
+            if y is None:
+                return 1
+            if x != y:
+                return -1 if x == "^" else 1
+            continue
+        if x is None or y is None:
+            return -1 if x is None else 1
+        # Numeric segments are newer than alphabetic ones
+        if x.isdigit() != y.isdigit():
+            return 1 if x.isdigit() else -1
+        if x.isdigit():
+            x = x.lstrip("0")
+            y = y.lstrip("0")
+            if len(x) != len(y):
+                return len(x) - len(y)
+        if x != y:
+            return -1 if x < y else 1
+    return 0
+
+
+def compare_packages(a: dict, b: dict) -> int:
+    """Compare the epoch, version and release of two packages"""
+    if a["epoch"] != b["epoch"]:
+        return a["epoch"] - b["epoch"]
+    return rpmvercmp(a["version"], b["version"]) or rpmvercmp(a["release"], b["release"])
+
+
+class RepoIndex:
+    """Index of the packages in a local RPM repository read from its primary
+    metadata, or from the package headers when the directory has no metadata.
+    The metadata index is cached per repomd.xml checksum in the cache directory."""
+    def __init__(self, repo_path: str, cache_dir: str = None):
+        self.repo_path = repo_path
+        repomd_path = os.path.join(repo_path, "repodata", "repomd.xml")
+        if os.path.exists(repomd_path):
+            self.packages = self._load_metadata(repomd_path, cache_dir)
+        else:
+            self.packages = self._load_headers()
+
+    def latest(self, name: str, version: str = "") -> dict:
+        """Return the latest package with the name and a version-release
+        matching the version prefix (wildcards allowed), or None if none does"""
+        matches = [
+            p for p in self.packages
+            if p["name"] == name and fnmatch.fnmatchcase(f"{p['version']}-{p['release']}", f"{version}*")
+        ]
+        if not matches:
+            return None
+        return max(matches, key=functools.cmp_to_key(compare_packages))
+
+    def _load_metadata(self, repomd_path: str, cache_dir: str) -> list:
+        with open(repomd_path, 'rb') as f:
+            repomd = f.read()
+        cache_file = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            cache_file = os.path.join(cache_dir, f"{hashlib.sha256(repomd).hexdigest()}.json")
+            if os.path.exists(cache_file):
+                with open(cache_file, 'r') as f:
+                    packages = json.load(f)
+                return [dict(p, path=os.path.join(self.repo_path, p["path"])) for p in packages]
+
+        location = None
+        for data in ET.fromstring(repomd).iter(f"{REPOMD_NS}data"):
+            if data.get("type") == "primary":
+                location = data.find(f"{REPOMD_NS}location").get("href")
+        if location is None:
+            raise Exception(f"No primary metadata in '{repomd_path}'")
+
+        packages = []
+        primary = ET.fromstring(decompress_file(os.path.join(self.repo_path, location)))
+        for package in primary.iter(f"{PRIMARY_NS}package"):
+            if package.get("type") != "rpm":
+                continue
+            version = package.find(f"{PRIMARY_NS}version")
+            packages.append({
+                "name": package.findtext(f"{PRIMARY_NS}name"),
+                "arch": package.findtext(f"{PRIMARY_NS}arch"),
+                "epoch": int(version.get("epoch") or 0),
+                "version": version.get("ver"),
+                "release": version.get("rel"),
+                "path": package.find(f"{PRIMARY_NS}location").get("href"),
+            })
+        if cache_file:
+            tmp_file = f"{cache_file}.tmp.{os.getpid()}"
+            with open(tmp_file, 'w') as f:
+                json.dump(packages, f)
+            os.replace(tmp_file, cache_file)
+        return [dict(p, path=os.path.join(self.repo_path, p["path"])) for p in packages]
+
+    def _load_headers(self) -> list:
+        packages = []
+        for path in glob.glob(f"{self.repo_path}/**/*.rpm", recursive=True):
+            with open(path, 'rb') as f:
+                f.seek(RPM_LEAD_SIZE)
+                read_header(f, align=True)
+                tags = read_header(f)
+            packages.append({
+                "name": tags[RPMTAG_NAME],
+                "arch": tags.get(RPMTAG_ARCH),
+                "epoch": tags.get(RPMTAG_EPOCH, [0])[0],
+                "version": tags[RPMTAG_VERSION],
+                "release": tags[RPMTAG_RELEASE],
+                "path": path,
+            })
+        return packages
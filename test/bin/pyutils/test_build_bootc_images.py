@@ -0,0 +1,131 @@
+import concurrent.futures
+import multiprocessing
+import os
+import tempfile
+
+import pytest
+
+# The module reads its configuration from the environment when imported
+TEST_DIR = tempfile.mkdtemp(prefix="test-build-bootc-images-")
+for var in ["SCRIPTDIR", "IMAGEDIR", "BOOTC_IMAGE_DIR", "BOOTC_ISO_DIR", "VM_DISK_BASEDIR", "CONTAINER_LIST",
+            "LOCAL_REPO", "BASE_REPO", "NEXT_REPO", "GOMPLATE"]:
+    os.environ.setdefault(var, os.path.join(TEST_DIR, var.lower()))
+os.environ.setdefault("UNAME_M", "x86_64")
+os.environ.setdefault("MIRROR_REGISTRY_URL", "localhost:5000")
+
+import build_bootc_images  # noqa: E402
+
+FAKE_SUDO = """#!/bin/bash
+echo "$*" >> "${FAKE_SUDO_LOG}"
+# Give the concurrent requesters the time to wait for the pull
+[[ "$*" != *pull* ]] || sleep 0.5
+[[ "$*" != *missing* ]]
+"""
+
+
+@pytest.fixture
+def fake_sudo(tmp_path, monkeypatch):
+    """Records the commands run with sudo instead of running them"""
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    (bindir / "sudo").write_text(FAKE_SUDO)
+    (bindir / "sudo").chmod(0o755)
+    log = tmp_path / "sudo.log"
+    log.touch()
+    monkeypatch.setenv("PATH", f"{bindir}:{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_SUDO_LOG", str(log))
+    return log
+
+
+def pull_image(pull_coordinator, imgref):
+    try:
+        return pull_coordinator.pull(imgref, False)
+    except Exception as e:
+        return str(e)
+
+
+def test_pulls_shared_by_worker_processes(fake_sudo, tmp_path):
+    coordinator = build_bootc_images.PullCoordinator(str(tmp_path / "pulls"))
+    imgrefs = ["quay.io/image:1", "quay.io/image:1", "quay.io/image:2", "quay.io/image:1"]
+    # The coordinator is passed to the workers, not inherited from the parent
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=2, mp_context=multiprocessing.get_context("spawn")) as executor:
+        results = list(executor.map(pull_image, [coordinator] * len(imgrefs), imgrefs))
+    assert results == imgrefs
+
+    pulls = fake_sudo.read_text().splitlines()
+    assert sorted(p.split()[-1] for p in pulls) == ["quay.io/image:1", "quay.io/image:2"]
+    coordinator.close()
+    assert not os.path.exists(coordinator.state_dir)
+
+
+def test_failed_pull_is_not_attempted_again(fake_sudo, tmp_path):
+    coordinator = build_bootc_images.PullCoordinator(str(tmp_path / "pulls"))
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=2, mp_context=multiprocessing.get_context("spawn")) as executor:
+        results = list(executor.map(pull_image, [coordinator] * 2, ["quay.io/missing:1"] * 2))
+    assert all("Command" in r for r in results)
+    assert sum("earlier in the run" in r for r in results) == 1
+    # Attempts of the first requester only
+    assert len(fake_sudo.read_text().splitlines()) == 3
+
+
+def test_missing_outputs(fake_sudo, tmp_path, monkeypatch):
+    groupdir = str(tmp_path / "group")
+    tasks = [
+        build_bootc_images.BuildTask(groupdir, "vm.image-bootc", "image-bootc", build_bootc_images.process_image_bootc, 0),
+        build_bootc_images.BuildTask(groupdir, "base.containerfile", "containerfile", build_bootc_images.process_containerfile, 0),
+        build_bootc_images.BuildTask(groupdir, "missing.container-encapsulate", "container-encapsulate",
+                                     build_bootc_images.process_container_encapsulate, 0),
+    ]
+    registry = build_bootc_images.MIRROR_REGISTRY
+    monkeypatch.setattr(build_bootc_images, "VM_DISK_BASEDIR", str(tmp_path))
+    monkeypatch.setattr(build_bootc_images, "REGISTRY_LABELS", {f"{registry}/base:latest": {}})
+
+    assert build_bootc_images.get_missing_outputs(tasks) == [
+        str(tmp_path / "vm.iso"), f"{registry}/missing:latest", "localhost/missing:latest"]
+
+    # The ISO image is only complete with its manifest
+    (tmp_path / "vm.iso").write_text("iso")
+    assert str(tmp_path / "vm.iso") in build_bootc_images.get_missing_outputs(tasks)
+    (tmp_path / "vm.iso.json").write_text('{"iso": "vm.iso"}')
+    build_bootc_images.REGISTRY_LABELS[f"{registry}/missing:latest"] = {"ostree.commit": "abc"}
+    # The images of the skipped groups must exist in the local containers storage
+    assert build_bootc_images.get_missing_outputs(tasks) == ["localhost/missing:latest"]
+
+
+def test_group_fingerprint_upstream_digests(tmp_path, monkeypatch):
+    os.makedirs(os.path.join(build_bootc_images.SCRIPTDIR, "..", "package-sources-bootc"), exist_ok=True)
+    groupdir = tmp_path / "group"
+    groupdir.mkdir()
+    (groupdir / "fp-base.containerfile").write_text("FROM quay.io/base:latest\nRUN true\n")
+    (groupdir / "fp-vm.image-bootc").write_text("localhost/fp-base:latest\n")
+    tasks = build_bootc_images.get_group_tasks(str(groupdir), 0, None)
+
+    digests = {"quay.io/base:latest": "sha256:1", build_bootc_images.BIB_IMAGE: "sha256:2"}
+    resolved = []
+
+    def get_image_digest(imgref, dry_run):
+        resolved.append(imgref)
+        return digests[imgref]
+
+    monkeypatch.setattr(build_bootc_images, "get_image_digest", get_image_digest)
+    monkeypatch.setattr(build_bootc_images, "UPSTREAM_DIGESTS", {})
+
+    fingerprint = build_bootc_images.get_group_fingerprint(str(groupdir), tasks, None)
+    assert fingerprint is not None
+    # The local images are not resolved and the upstream ones only once per run
+    assert build_bootc_images.get_group_fingerprint(str(groupdir), tasks, None) == fingerprint
+    assert sorted(resolved) == sorted(digests)
+
+    # Both the base and the builder image updates change the fingerprint
+    for imgref, digest in list(digests.items()):
+        monkeypatch.setattr(build_bootc_images, "UPSTREAM_DIGESTS", {})
+        digests[imgref] = "sha256:updated"
+        assert build_bootc_images.get_group_fingerprint(str(groupdir), tasks, None) != fingerprint
+        digests[imgref] = digest
+
+    # The inputs are unknown without the digest of an upstream image
+    monkeypatch.setattr(build_bootc_images, "UPSTREAM_DIGESTS", {})
+    del digests["quay.io/base:latest"]
+    assert build_bootc_images.get_group_fingerprint(str(groupdir), tasks, None) is None
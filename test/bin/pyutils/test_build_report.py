@@ -0,0 +1,76 @@
+import json
+import sys
+
+import pytest
+
+import build_report
+
+# Two chains of dependent tasks and a task overlapping with both of them:
+#   base (0-10) -> app (10-30) -> vm (30-60)
+#   other (0-20) -> other-vm (20-35)
+#   lone (5-25)
+TASKS = [
+    ("layer/group1/base.containerfile", 0, 10, []),
+    ("layer/group2/app.containerfile", 10, 30, ["layer/group1/base.containerfile"]),
+    ("layer/group3/vm.image-bootc", 30, 60, ["layer/group2/app.containerfile"]),
+    ("layer/group1/other.containerfile", 0, 20, []),
+    ("layer/group2/other-vm.image-bootc", 20, 35, ["layer/group1/other.containerfile"]),
+    ("layer/group1/lone.container-encapsulate", 5, 25, []),
+]
+
+
+def get_events():
+    events = [{"object": "layer/prepare", "phase": "render-templates", "start": -2, "end": 0, "status": "OK", "args": None}]
+    for object, start, end, deps in TASKS:
+        events.append({"object": object, "phase": "task", "start": start, "end": end, "status": "OK",
+                       "args": {"kind": object.rsplit(".", 1)[1], "deps": deps}})
+        # The builds take the whole task except for one second of queue wait
+        events.append({"object": object, "phase": "queue-wait", "start": start - 1, "end": start, "status": "OK", "args": None})
+        events.append({"object": object, "phase": "build", "start": start, "end": end, "status": "OK", "args": None})
+    return events
+
+
+@pytest.fixture
+def trace(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    path.write_text("".join(json.dumps(e) + "\n" for e in get_events()) + "\n")
+    return path
+
+
+def test_critical_path():
+    chain, duration = build_report.get_critical_path(get_events())
+    assert chain == ["layer/group1/base.containerfile", "layer/group2/app.containerfile", "layer/group3/vm.image-bootc"]
+    assert duration == 60
+
+
+def test_dependency_cycle():
+    events = get_events()
+    events[1]["args"]["deps"] = ["layer/group3/vm.image-bootc"]
+    with pytest.raises(Exception, match="Dependency cycle"):
+        build_report.get_critical_path(events)
+
+
+def test_utilization():
+    wall, average, peak = build_report.get_utilization(get_events())
+    assert wall == 62
+    assert average == pytest.approx(115 / 62)
+    # The tasks ending when others start are not running in parallel with them
+    assert peak == 3
+    assert build_report.get_utilization([]) == (0, 0, 0)
+
+
+def test_phase_totals():
+    assert build_report.get_phase_totals(get_events()) == {
+        "build": (6, 115),
+        "queue-wait": (6, 6),
+        "render-templates": (1, 2),
+    }
+
+
+def test_json_report(trace, monkeypatch, capsys):
+    monkeypatch.setattr(sys, "argv", ["build_report.py", "--json", str(trace)])
+    build_report.main()
+    report = json.loads(capsys.readouterr().out)
+    assert report["peak_parallel_tasks"] == 3
+    assert report["critical_path"] == {"seconds": 60, "tasks": [t[0] for t in TASKS[:3]]}
+    assert report["phases"]["build"] == {"count": 6, "seconds": 115}
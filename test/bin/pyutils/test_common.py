@@ -0,0 +1,60 @@
+import json
+import multiprocessing
+import os
+import signal
+import time
+
+import common
+
+
+def send_results(queue, object, count):
+    for n in range(count):
+        queue.put({"object": object, "step": f"step-{n}", "status": "OK",
+                   "duration": None, "timestamp": None, "properties": None})
+
+
+def send_results_and_die(queue, object):
+    send_results(queue, object, 1)
+    # Flush the result and die holding the queue write lock, like a worker killed
+    # while sending a result
+    queue.close()
+    queue.join_thread()
+    queue._wlock.acquire()
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def start_collector(tmp_path):
+    collector = common.ResultCollector()
+    collector.start()
+    collector.add_group("group", str(tmp_path / "junit.xml"), str(tmp_path / "metrics.json"))
+    return collector
+
+
+def test_results_of_workers(tmp_path):
+    collector = start_collector(tmp_path)
+    workers = [multiprocessing.Process(target=send_results, args=(collector.queue, f"group/file{n}", 10))
+               for n in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    collector.stop()
+
+    results = json.loads((tmp_path / "metrics.json").read_text())
+    assert len(results) == 40
+    assert (tmp_path / "junit.xml").read_text().count("<testcase") == 40
+
+
+def test_producer_dies_mid_run(tmp_path):
+    collector = start_collector(tmp_path)
+    worker = multiprocessing.Process(target=send_results_and_die, args=(collector.queue, "group/file"))
+    worker.start()
+    worker.join()
+    assert worker.exitcode == -signal.SIGKILL
+
+    start = time.monotonic()
+    collector.stop(timeout=1)
+    assert time.monotonic() - start < 5
+    # The result sent before the worker died is kept
+    results = json.loads((tmp_path / "metrics.json").read_text())
+    assert [r["object"] for r in results] == ["group/file"]
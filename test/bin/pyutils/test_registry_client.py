@@ -0,0 +1,125 @@
+import http.server
+import json
+import platform
+import threading
+
+import pytest
+
+import registry_client
+
+INDEX_TYPE = "application/vnd.oci.image.index.v1+json"
+MANIFEST_TYPE = "application/vnd.oci.image.manifest.v1+json"
+
+
+class FakeRegistryHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        # Close the connection without telling the client, like registries closing idle connections
+        if self.server.drop_connections:
+            self.close_connection = True
+
+    def do_GET(self):
+        objects = self.server.objects
+        if self.path.startswith("/storage/"):
+            return self.send(200, objects["blobs"][self.path.removeprefix("/storage/")])
+        _, _, repository, kind, reference = self.path.split("/", 4)
+        if repository != "repo":
+            return self.send(404)
+        if kind == "manifests" and reference in objects["manifests"]:
+            media_type, body = objects["manifests"][reference]
+            return self.send(200, body, {"Content-Type": media_type, "Docker-Content-Digest": reference})
+        if kind == "blobs" and reference in objects["blobs"]:
+            # Blobs are served by a storage backend
+            host, port = self.server.server_address
+            return self.send(307, headers={"Location": f"http://{host}:{port}/storage/{reference}"})
+        self.send(404)
+
+
+@pytest.fixture
+def registry():
+    """Fake registry with a manifest list of two architectures"""
+    objects = {"manifests": {}, "blobs": {}}
+    index = {"mediaType": INDEX_TYPE, "manifests": []}
+    for arch in ["amd64", "arm64"]:
+        config = f"sha256:config-{arch}"
+        objects["blobs"][config] = json.dumps({"config": {"Labels": {"arch": arch}}}).encode()
+        manifest = {"mediaType": MANIFEST_TYPE, "config": {"digest": config}}
+        objects["manifests"][f"sha256:{arch}"] = (MANIFEST_TYPE, json.dumps(manifest).encode())
+        index["manifests"].append({"digest": f"sha256:{arch}", "platform": {"architecture": arch}})
+    objects["manifests"]["latest"] = (INDEX_TYPE, json.dumps(index).encode())
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeRegistryHandler)
+    server.objects = objects
+    server.connections = 0
+    server.drop_connections = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(registry):
+    host, port = registry.server_address
+    client = registry_client.RegistryClient(f"{host}:{port}")
+    yield client
+    client.close()
+
+
+def test_manifest_list_architecture(client):
+    digest, manifest = client.get_manifest("repo", "latest", arch="arm64")
+    assert digest == "sha256:arm64"
+    assert manifest["config"]["digest"] == "sha256:config-arm64"
+    assert client.get_manifest("repo", "latest", arch="s390x") is None
+
+
+def test_missing_image(client):
+    assert client.get_manifest("repo", "missing") is None
+    assert client.get_labels(f"{client.registry}/other:latest") is None
+
+
+def test_labels_from_redirected_blob(client):
+    arch = registry_client.ARCHITECTURES.get(platform.machine(), platform.machine())
+    if arch not in ["amd64", "arm64"]:
+        pytest.skip(f"No image for the '{arch}' architecture")
+    assert client.get_labels(f"{client.registry}/repo:latest") == {"arch": arch}
+    assert client.get_labels(f"{client.registry}/repo@sha256:amd64") == {"arch": "amd64"}
+
+
+def test_image_from_other_registry(client):
+    with pytest.raises(registry_client.RegistryError):
+        client.get_labels("quay.io/repo:latest")
+
+
+def test_reconnect_after_server_closes_connection(registry, client):
+    registry.drop_connections = True
+    for _ in range(3):
+        digest, _ = client.get_manifest("repo", "sha256:amd64")
+        assert digest == "sha256:amd64"
+    # Each request after the first one is retried on a new connection
+    assert registry.connections == 3
+
+
+def test_get_labels_many(client):
+    imgrefs = [f"{client.registry}/repo@sha256:amd64", f"{client.registry}/repo@sha256:arm64",
+               f"{client.registry}/repo:missing", "quay.io/repo:latest"]
+    assert client.get_labels_many(imgrefs, max_workers=4) == {
+        imgrefs[0]: {"arch": "amd64"},
+        imgrefs[1]: {"arch": "arm64"},
+        imgrefs[2]: None,
+        imgrefs[3]: None,
+    }